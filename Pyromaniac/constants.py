@@ -61,12 +61,14 @@ class FanConstants(object):
 
     # Fan speed
     FanSpeed_Accuracy_Unknown = 0
+    FanSpeed_Automatic = 101
 
     # Fan capabilties:
     FanCapability_SupportsManual = (1<<0)
     FanCapability_SupportsAutomatic = (1<<1)
     FanCapability_SupportsMove = (1<<2)
     FanCapability_CanFail = (1<<3)
+    FanCapability_MultipleFans = (1<<4)
     FanCapability_Type_Fan = 0
     FanCapability_Type_Piezoelectric = 1
     FanCapability_Type_Peltier = 2
@@ -85,6 +87,9 @@ class FanConstants(object):
     FanDriver_GetControlMode = 2
     FanDriver_SetControlMode = 3
     FanDriver_SetLocation = 4
+    # Operations on a list of fans, if FanCapability_MultipleFans is set
+    FanDriver_GetSpeeds = 5
+    FanDriver_SetSpeeds = 6
 
     # Configuration of the fan control
     FanControl_Invalid = -1
@@ -103,6 +108,31 @@ class FanConstants(object):
     FanController_Configure_Control = 0
     FanController_Configure_Location = 1
 
+    # FanController_DriverStats flags
+    FanController_DriverStats_Driver = (1<<0)
+    FanController_DriverStats_Reset = (1<<1)
+
+    # FanController_Group reasons
+    FanController_Group_Define = 0
+    FanController_Group_Remove = 1
+    FanController_Group_SetSpeed = 2
+    FanController_Group_SetControl = 3
+
+    # FanController_Calibrate reason codes
+    FanController_Calibrate_Start = 0
+    FanController_Calibrate_Progress = 1
+    FanController_Calibrate_ReadTable = 2
+    FanController_Calibrate_Abort = 3
+
+    # FanController_Lease reason codes
+    FanController_Lease_Acquire = 0
+    FanController_Lease_Renew = 1
+    FanController_Lease_Release = 2
+    FanController_Lease_Read = 3
+
+    # FanController_Stats flags
+    FanController_Stats_Fan = (1<<0)
+
     # Service calls - Registered
     Service_FanControllerStarted = 0x810C0
     Service_FanControllerDying = 0x810C1
@@ -118,8 +148,16 @@ class FanConstants(object):
     ErrorNumber_BadControlMode = ErrorBase_FanController + 2
     ErrorNumber_RegisterFailed = ErrorBase_FanController + 3
     ErrorNumber_InitFailed = ErrorBase_FanController + 4
+    ErrorNumber_TaskPollWordFailed = ErrorBase_FanController + 5
+    ErrorNumber_DriverUnavailable = ErrorBase_FanController + 6
+    ErrorNumber_BadGroup = ErrorBase_FanController + 7
+    ErrorNumber_ChurnFailed = ErrorBase_FanController + 8
+    ErrorNumber_CalibrationRunning = ErrorBase_FanController + 9
+    ErrorNumber_CannotCalibrate = ErrorBase_FanController + 10
+    ErrorNumber_BadLease = ErrorBase_FanController + 11
     ErrorNumber_CannotSetSpeed = ErrorBase_FanController + 16
     ErrorNumber_CannotSetLocation = ErrorBase_FanController + 17
+    ErrorNumber_GroupNotApplied = ErrorBase_FanController + 18
 
     # SWI numbers
     SWIFanController_0 = 0x5A1C0
@@ -128,5 +166,32 @@ class FanConstants(object):
     SWIFanController_Info = SWIFanController_0 + 2
     SWIFanController_Speed = SWIFanController_0 + 3
     SWIFanController_Configure = SWIFanController_0 + 4
+    SWIFanController_TaskPollWord = SWIFanController_0 + 5
+    SWIFanController_DriverStats = SWIFanController_0 + 6
+    SWIFanController_EnumerateUnhealthy = SWIFanController_0 + 7
+    SWIFanController_Group = SWIFanController_0 + 8
+    SWIFanController_StatusTable = SWIFanController_0 + 9
+    SWIFanController_Calibrate = SWIFanController_0 + 10
+    SWIFanController_Lease = SWIFanController_0 + 11
+    SWIFanController_Stats = SWIFanController_0 + 12
     SWIFanController_Register = SWIFanController_0 + 16
     SWIFanController_Deregister = SWIFanController_0 + 17
+
+    # OS SWIs and reasons used directly
+    SWIOS_Write0 = 0x02
+    SWIOS_Byte = 0x06
+    SWIOS_ReadVduVariables = 0x31
+    SWIOS_ReadMonotonicTime = 0x42
+    SWIOS_DynamicArea = 0x66
+    OSByte_AcknowledgeEscape = 126
+    OSByte_ReadKey = 129
+    OSByte_ReadKey_Escape = 0x1B
+    VduVariable_TWLCol = 132
+    VduVariable_TWBRow = 133
+    VduVariable_TWRCol = 134
+    VduVariable_TWTRow = 135
+    ErrorNumber_Escape = 17
+    OSDynamicArea_Create = 0
+    OSDynamicArea_Remove = 1
+    OSDynamicArea_UserReadOnly = 1
+    OSDynamicArea_NotDraggable = 1 << 7
@@ -0,0 +1,159 @@
+"""
+Streaming detection of anomalous fan speeds.
+
+For each fan an exponentially weighted moving mean and variance of its speed
+are kept. A sample which is too many deviations from the mean marks the fan
+as behaving erratically; a mean which has settled too far from the speed the
+fan was last set to marks it as drifting. Each sample costs a constant amount
+of work, and no history is stored; the state of every fan lives in a few
+arrays indexed by a slot number allocated to the fan.
+"""
+
+import array
+import math
+
+from .constants import FanConstants
+
+
+class AnomalyDetector(object):
+    """
+    Tracks the speed of each fan, flagging those which look unhealthy.
+    """
+    # Flags for the anomalies found
+    Anomaly_Erratic = 1 << 0
+    Anomaly_Drift = 1 << 1
+
+    def __init__(self, window=32, threshold=4, drift=20, warmup=None):
+        """
+        @param window:      number of samples the moving averages are taken over
+        @param threshold:   number of standard deviations from the mean at which a sample is erratic
+        @param drift:       percentage of the commanded speed that the mean may drift from it, or 0
+                            to not check for drift
+        @param warmup:      number of samples before anything is flagged, after the fan is first seen
+                            or its speed is set (defaults to the window)
+        """
+        self.alpha = 2.0 / (window + 1)
+        self.threshold = threshold
+        self.drift = drift
+        self.warmup = window if warmup is None else warmup
+
+        # Slot for each fan, keyed by fan_id, and the slots which may be reused
+        self.slots = {}
+        self.free_slots = []
+        self.mean = array.array('d')
+        self.variance = array.array('d')
+        # Samples since the fan was first seen or commanded, capped at the warmup
+        self.settled = array.array('l')
+        # Speed the fan was commanded to, or -1 if it has not been set
+        self.commanded = array.array('l')
+        self.flags = array.array('B')
+
+        self.samples = 0
+        self.anomalies = 0
+
+    def __repr__(self):
+        return "<{}({} fans, {} samples, {} anomalies)>".format(self.__class__.__name__, len(self.slots),
+                                                               self.samples, self.anomalies)
+
+    def slot(self, fan_id):
+        slot = self.slots.get(fan_id, None)
+        if slot is not None:
+            return slot
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.mean[slot] = 0
+            self.variance[slot] = 0
+            self.settled[slot] = 0
+            self.commanded[slot] = -1
+            self.flags[slot] = 0
+        else:
+            slot = len(self.mean)
+            self.mean.append(0)
+            self.variance.append(0)
+            self.settled.append(0)
+            self.commanded.append(-1)
+            self.flags.append(0)
+        self.slots[fan_id] = slot
+        return slot
+
+    def forget(self, fan_id):
+        slot = self.slots.pop(fan_id, None)
+        if slot is not None:
+            self.free_slots.append(slot)
+
+    def sample(self, fan, speed):
+        """
+        Update the state of a fan with a sample of its speed.
+
+        @param fan:     FanDescriptor
+        @param speed:   speed read (signed), which is ignored if it is a negative state
+
+        @return: the anomaly flags for the fan
+        """
+        slot = self.slot(fan.fan_id)
+        if speed < 0 or speed == FanConstants.FanSpeed_Automatic:
+            # Failed fans are reported through their state, and automatic fans have no speed to track
+            return self.flags[slot]
+
+        self.samples += 1
+        commanded = -1 if fan.applied_speed is None else fan.applied_speed
+        if commanded != self.commanded[slot]:
+            # The fan has been told to change, so it has to settle before we judge it
+            self.commanded[slot] = commanded
+            self.settled[slot] = 0
+            self.flags[slot] = 0
+
+        settled = self.settled[slot]
+        mean = self.mean[slot]
+        if settled == 0:
+            mean = speed
+            variance = 0.0
+            diff = 0.0
+        else:
+            diff = speed - mean
+            variance = self.variance[slot]
+
+        flags = self.flags[slot]
+        if settled >= self.warmup:
+            # Allow the fan its accuracy, so that steady fans are not flagged for tiny changes
+            deviation = math.sqrt(variance) + max(fan.accuracy, 1)
+            limit = self.threshold * deviation
+            if flags & self.Anomaly_Erratic:
+                # Only clear when comfortably back to normal, so that we don't flap
+                limit /= 2
+            if abs(diff) > limit:
+                flags |= self.Anomaly_Erratic
+            else:
+                flags &= ~self.Anomaly_Erratic
+
+        increment = self.alpha * diff
+        mean += increment
+        variance = (1 - self.alpha) * (variance + diff * increment)
+        self.mean[slot] = mean
+        self.variance[slot] = variance
+
+        if settled >= self.warmup and self.drift and commanded >= 0 and \
+           (commanded <= 100) == (speed <= 100):
+            # The commanded speed is in the same units as the reading, so we can compare them
+            limit = max(commanded * self.drift / 100.0, fan.accuracy)
+            if abs(mean - commanded) > limit:
+                flags |= self.Anomaly_Drift
+            else:
+                flags &= ~self.Anomaly_Drift
+
+        if settled < self.warmup:
+            self.settled[slot] = settled + 1
+        if flags and not self.flags[slot]:
+            self.anomalies += 1
+        flags &= 0xFF
+        self.flags[slot] = flags
+        return flags
+
+    def anomaly(self, fan_id):
+        """
+        @return: the anomaly flags for a fan
+        """
+        slot = self.slots.get(fan_id, None)
+        if slot is None:
+            return 0
+        return self.flags[slot]
@@ -0,0 +1,76 @@
+"""
+Calls to a driver for many of its fans at once.
+
+Drivers which set FanCapability_MultipleFans on their fans accept the
+FanDriver_GetSpeeds and FanDriver_SetSpeeds reasons:
+
+    =>  R0 = reason (FanDriver_GetSpeeds or FanDriver_SetSpeeds)
+        R1 = pointer to a list of fan ids
+        R2 = number of fans in the list
+        R3 = pointer to a list of speeds, one for each fan:
+                GetSpeeds: filled in by the driver
+                SetSpeeds: the speeds to set
+        R12 = driver workspace
+    <=  the list at R3 holds the speed (or a negative FanState) of each fan
+"""
+
+from .constants import FanConstants
+
+
+class DriverBatch(object):
+    """
+    Makes the multiple fan calls to a driver, through a buffer kept for the purpose.
+    """
+
+    def __init__(self, rma):
+        """
+        @param rma:     RMAAccount to allocate the buffer in
+        """
+        self.rma = rma
+        self.block = None
+        self.capacity = 0
+        self.calls = 0
+        self.fans = 0
+
+    def __repr__(self):
+        return "<{}({} calls for {} fans)>".format(self.__class__.__name__, self.calls, self.fans)
+
+    def free(self):
+        if self.block:
+            self.rma.free(self.block)
+            self.block = None
+            self.capacity = 0
+
+    def call(self, reason, fans, speeds):
+        """
+        Call the driver for a list of its fans.
+
+        @param reason:  FanDriver_GetSpeeds or FanDriver_SetSpeeds
+        @param fans:    list of FanDescriptors, all on the same driver
+        @param speeds:  list of the speeds to pass for each fan
+
+        @return: list of the speeds returned for each fan, negative for a FanState, as
+                 FanDescriptor reports them
+        """
+        count = len(fans)
+        if count > self.capacity:
+            self.free()
+            self.block = self.rma.allocate(count * 8, 'batch buffer')
+            self.capacity = count
+
+        self.block.write_words([fan.fan_id for fan in fans] + [speed & 0xFFFFFFFF for speed in speeds])
+        fans[0].execute_driver(reason,
+                               rin={1: self.block.address,
+                                    2: count,
+                                    3: self.block.address + count * 4},
+                               rout=[],
+                               fans=fans)
+        self.calls += 1
+        self.fans += count
+        return [self.block[(count + index) * 4].signedword for index in range(count)]
+
+    def get_speeds(self, fans):
+        return self.call(FanConstants.FanDriver_GetSpeeds, fans, [0] * len(fans))
+
+    def set_speeds(self, fans, speeds):
+        return self.call(FanConstants.FanDriver_SetSpeeds, fans, speeds)
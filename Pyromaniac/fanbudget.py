@@ -0,0 +1,393 @@
+"""
+Allocation of speeds to the automatically controlled fans, within a budget.
+
+When a noise or power budget is configured, fans which are selected for
+FanControl_AutomaticNoise or FanControl_AutomaticPerformance (and which can
+be set manually) are driven by FanController, rather than by their driver.
+The fans are divided into zones by their device and location. Every fan in a
+zone runs at no less than the zone's cooling requirement; noise fans stay at
+that speed, and performance fans are raised together to the highest level
+that keeps the estimated noise and power of all the fans within the budget.
+
+The estimates follow the fan laws: the power of a fan grows with the cube of
+its speed, and its sound power with the fifth power of its speed.
+
+The fans in each zone are summarised by sorted arrays of their lowest and
+highest speeds, with running sums of their costs, so that the cost of a zone
+at any level can be found without visiting its fans. Only the zones whose
+fans have changed are summarised again; the level for the whole chassis is
+then searched for using the summaries, with NumPy evaluating many levels at
+once if it is available.
+"""
+
+import bisect
+import itertools
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .constants import FanConstants
+
+
+def snap_speed(fan, speed, up):
+    """
+    Round a speed to one which the fan accepts.
+
+    @param fan:     FanDescriptor
+    @param speed:   speed to round
+    @param up:      True to round up, False to round down
+
+    @return: speed that the fan may be set to
+    """
+    maximum = fan.maximum or 100
+    if fan.speeds:
+        allowed = sorted(allowed for allowed in fan.speeds
+                         if allowed <= maximum and allowed != FanConstants.FanSpeed_Automatic)
+        if up:
+            higher = [allowed_speed for allowed_speed in allowed if allowed_speed >= speed]
+            return higher[0] if higher else allowed[-1]
+        lower = [allowed_speed for allowed_speed in allowed if allowed_speed <= speed]
+        return lower[-1] if lower else allowed[0]
+
+    accuracy = fan.accuracy or 1
+    if up:
+        speed = int(-(-speed // accuracy) * accuracy)
+    else:
+        speed = int(speed // accuracy * accuracy)
+    speed = min(speed, maximum - maximum % accuracy)
+    if maximum > 100:
+        # Speeds below 200 would be taken as percentages
+        speed = max(speed, int(-(-200 // accuracy) * accuracy))
+    return speed
+
+
+class BudgetFan(object):
+    """
+    The speeds a fan in a zone may be allocated.
+    """
+    __slots__ = ('fan', 'maximum', 'low_speed', 'high_speed', 'low', 'high', 'performance')
+
+    def __init__(self, fan, requirement):
+        self.fan = fan
+        self.maximum = float(fan.maximum or 100)
+        self.high_speed = snap_speed(fan, self.maximum, up=False)
+        self.low_speed = min(snap_speed(fan, self.maximum * requirement / 100.0, up=True), self.high_speed)
+        # The same speeds, as fractions of the maximum
+        self.low = self.low_speed / self.maximum
+        self.high = self.high_speed / self.maximum
+        self.performance = fan.control_mode == FanConstants.FanControl_AutomaticPerformance
+
+    def speed(self, level):
+        """
+        @return: the speed to set for the fan at a level
+        """
+        if not self.performance or level <= self.low:
+            return self.low_speed
+        return max(self.low_speed, min(self.high_speed, snap_speed(self.fan, level * self.maximum, up=False)))
+
+
+class ZoneSummary(object):
+    """
+    Summary of the costs of the fans in a zone, at any level.
+    """
+    # Exponents of the speed for the power and noise costs
+    exponents = (3, 5)
+
+    def __init__(self, key, fans, requirement):
+        self.key = key
+        self.requirement = requirement
+        self.fans = [BudgetFan(fan, requirement) for fan in fans]
+
+        performance = [budget_fan for budget_fan in self.fans if budget_fan.performance]
+        lows = sorted(budget_fan.low for budget_fan in performance)
+        highs = sorted(budget_fan.high for budget_fan in performance)
+        self.count = len(performance)
+        # The costs of the fans held at their lowest speeds, which do not depend on the level
+        self.fixed = [sum(budget_fan.low ** exponent for budget_fan in self.fans if not budget_fan.performance)
+                      for exponent in self.exponents]
+        if numpy:
+            self.lows = numpy.array(lows)
+            self.highs = numpy.array(highs)
+            self.low_sums = [numpy.concatenate(([0.0], numpy.cumsum(self.lows ** exponent)))
+                             for exponent in self.exponents]
+            self.high_sums = [numpy.concatenate(([0.0], numpy.cumsum(self.highs ** exponent)))
+                              for exponent in self.exponents]
+        else:
+            self.lows = lows
+            self.highs = highs
+            self.low_sums = [[0.0] + list(itertools.accumulate(low ** exponent for low in lows))
+                             for exponent in self.exponents]
+            self.high_sums = [[0.0] + list(itertools.accumulate(high ** exponent for high in highs))
+                              for exponent in self.exponents]
+
+    def __repr__(self):
+        return "<{}(&{:06x}, {} fans, {} performance)>".format(self.__class__.__name__, self.key,
+                                                               len(self.fans), self.count)
+
+    def costs(self, levels):
+        """
+        Find the power and noise costs of the zone at a number of levels.
+
+        Fans whose lowest speed is above the level run at their lowest speed, those whose
+        highest speed is below the level run at their highest, and the rest run at the level.
+
+        @param levels:  levels to evaluate, as fractions of the maximum speeds (a numpy array
+                        if numpy is available)
+
+        @return: list of the costs at each level, for each exponent
+        """
+        if numpy:
+            above = self.count - numpy.searchsorted(self.lows, levels, side='right')
+            capped = numpy.searchsorted(self.highs, levels, side='right')
+            at_level = self.count - above - capped
+            return [fixed + (low_sums[-1] - low_sums[self.count - above]) + high_sums[capped]
+                    + at_level * levels ** exponent
+                    for exponent, fixed, low_sums, high_sums in zip(self.exponents, self.fixed,
+                                                                    self.low_sums, self.high_sums)]
+
+        results = []
+        for exponent, fixed, low_sums, high_sums in zip(self.exponents, self.fixed,
+                                                        self.low_sums, self.high_sums):
+            costs = []
+            for level in levels:
+                below = bisect.bisect_right(self.lows, level)
+                capped = bisect.bisect_right(self.highs, level)
+                at_level = below - capped
+                costs.append(fixed + (low_sums[-1] - low_sums[below]) + high_sums[capped]
+                             + at_level * level ** exponent)
+            results.append(costs)
+        return results
+
+
+class FanBudget(object):
+    """
+    Allocates speeds to the fans in the automatic modes, keeping within a noise and power budget.
+    """
+    # Number of levels tried in each round of the search, and the resolution we search to
+    search_points = 16
+    resolution = 0.001
+
+    def __init__(self, clock, noise=0, power=0, fan_noise=30, fan_power=2000,
+                 requirement=30, requirements=None, time_budget=0.01):
+        """
+        @param clock:           function returning the time in seconds, to measure the solves by
+        @param noise:           largest total noise of the fans, in dBA, or 0 for no limit
+        @param power:           largest total power of the fans, in mW, or 0 for no limit
+        @param fan_noise:       noise of one fan at its maximum speed, in dBA
+        @param fan_power:       power of one fan at its maximum speed, in mW
+        @param requirement:     lowest speed of the fans in a zone, as a percentage of their maximum
+        @param requirements:    dictionary of the requirement for zones of particular device types
+        @param time_budget:     time, in seconds, that each solve should take at most
+        """
+        self.noise = noise
+        self.power = power
+        self.fan_noise = fan_noise
+        self.fan_power = fan_power
+        self.requirement = requirement
+        self.requirements = requirements or {}
+        self.time_budget = time_budget
+        self.clock = clock
+
+        # Limits on the sums of the (fractional) speeds raised to each ZoneSummary exponent
+        self.limits = [power / float(fan_power) if power else None,
+                       10 ** ((noise - fan_noise) / 10.0) if noise else None]
+
+        # Managed fans in each zone, keyed by the zone and then the fan_id
+        self.zones = {}
+        # The zone that each managed fan is in, keyed by fan_id
+        self.zone_of = {}
+        self.summaries = {}
+        self.dirty = set()
+        # The level that the performance fans were last set to
+        self.level = None
+        self.over_budget = False
+
+        self.solves = 0
+        self.solve_time = 0.0
+        self.last_solve_time = 0.0
+        self.max_solve_time = 0.0
+        # Number of solves which ran out of time, leaving zones to be summarised later
+        self.overruns = 0
+
+    def __repr__(self):
+        return "<{}({} zones, {} fans, level={})>".format(self.__class__.__name__, len(self.zones),
+                                                         len(self.zone_of), self.level)
+
+    @staticmethod
+    def zone_key(fan):
+        """
+        Zone that a fan is in: its device and location, without its sequence number.
+        """
+        mask = (FanConstants.FanType_Device_Mask << FanConstants.FanType_Device_Shift) | \
+               (FanConstants.FanType_Location_Mask << FanConstants.FanType_Location_Shift)
+        return fan.location_id & mask
+
+    def zone_requirement(self, key):
+        device = (key >> FanConstants.FanType_Device_Shift) & FanConstants.FanType_Device_Mask
+        return self.requirements.get(device, self.requirement)
+
+    @staticmethod
+    def manages(fan, control):
+        """
+        Whether a fan given a control mode will be driven by the budget.
+        """
+        return control in (FanConstants.FanControl_AutomaticNoise,
+                           FanConstants.FanControl_AutomaticPerformance) and \
+               bool(fan.capabilities & FanConstants.FanCapability_SupportsManual)
+
+    def changed(self, fan):
+        """
+        Note that a fan's control mode or location may have changed.
+        """
+        key = self.zone_key(fan) if fan.budget_managed else None
+        old_key = self.zone_of.get(fan.fan_id, None)
+        if old_key is not None and old_key != key:
+            self.remove(fan.fan_id)
+        if key is not None:
+            self.zones.setdefault(key, {})[fan.fan_id] = fan
+            self.zone_of[fan.fan_id] = key
+            self.dirty.add(key)
+
+    def failed(self, fan):
+        """
+        Note that a fan could not be set to the speed it was allocated.
+
+        Its zone is summarised again on the next solve, which allocates the fan's speed again.
+        """
+        key = self.zone_of.get(fan.fan_id, None)
+        if key is not None:
+            self.dirty.add(key)
+
+    def remove(self, fan_id):
+        """
+        Stop managing a fan.
+        """
+        key = self.zone_of.pop(fan_id, None)
+        if key is None:
+            return
+        zone = self.zones[key]
+        del zone[fan_id]
+        if not zone:
+            del self.zones[key]
+        self.dirty.add(key)
+
+    def totals(self, levels):
+        """
+        @return: list of the total costs at each level, for each exponent
+        """
+        totals = None
+        for summary in self.summaries.values():
+            costs = summary.costs(levels)
+            if totals is None:
+                totals = costs
+            elif numpy:
+                totals = [total + cost for total, cost in zip(totals, costs)]
+            else:
+                totals = [[a + b for a, b in zip(total, cost)] for total, cost in zip(totals, costs)]
+        return totals
+
+    def within(self, totals, index):
+        return all(limit is None or total[index] <= limit
+                   for total, limit in zip(totals, self.limits))
+
+    def search(self, deadline):
+        """
+        Find the highest level for the performance fans which keeps within the budget.
+
+        @return: level, as a fraction of the maximum speeds
+        """
+        self.over_budget = False
+        if not self.summaries:
+            return 0.0
+        make_levels = numpy.array if numpy else list
+
+        totals = self.totals(make_levels([0.0, 1.0]))
+        if not self.within(totals, 0):
+            # Cooling comes first; the fans stay at the zone requirements
+            self.over_budget = True
+            return 0.0
+        if self.within(totals, 1):
+            return 1.0
+
+        low, high = 0.0, 1.0
+        while high - low > self.resolution and self.clock() < deadline:
+            step = (high - low) / self.search_points
+            levels = make_levels([low + step * index for index in range(1, self.search_points)])
+            totals = self.totals(levels)
+            feasible = [index for index in range(len(levels)) if self.within(totals, index)]
+            best = feasible[-1] if feasible else -1
+            if best >= 0:
+                low = float(levels[best])
+            if best + 1 < len(levels):
+                high = float(levels[best + 1])
+        return low
+
+    def estimate(self, level):
+        """
+        @return: tuple of the estimated (power in mW, noise in dBA) of the fans at a level
+        """
+        totals = self.totals(numpy.array([level]) if numpy else [level])
+        if totals is None:
+            return (0, 0)
+        power = float(totals[0][0]) * self.fan_power
+        noise = float(totals[1][0])
+        noise = self.fan_noise + 10 * math.log10(noise) if noise > 0 else 0
+        return (power, noise)
+
+    def solve(self):
+        """
+        Summarise the zones which have changed, and find the speeds for the fans.
+
+        @return: list of (fan, speed) for the fans whose speed should change
+        """
+        start = self.clock()
+        deadline = start + self.time_budget
+
+        resolved = []
+        removed = False
+        for key in list(self.dirty):
+            if resolved and self.clock() >= deadline:
+                # The remaining zones keep their old summary until the next solve
+                self.overruns += 1
+                break
+            self.dirty.discard(key)
+            zone = self.zones.get(key, None)
+            if zone:
+                self.summaries[key] = ZoneSummary(key, zone.values(), self.zone_requirement(key))
+                resolved.append(key)
+            else:
+                self.summaries.pop(key, None)
+                removed = True
+
+        if any(key not in self.summaries for key in self.dirty):
+            # Until every zone has been summarised, we can't tell what the budget allows
+            level = self.level or 0.0
+        elif resolved or removed or self.level is None:
+            level = self.search(deadline)
+        else:
+            level = self.level
+        if level != self.level:
+            # Every zone moves to the new level
+            self.level = level
+            resolved = list(self.summaries)
+
+        changes = []
+        for key in resolved:
+            for budget_fan in self.summaries[key].fans:
+                fan = budget_fan.fan
+                if self.zone_of.get(fan.fan_id, None) != key:
+                    # Removed, or moved to another zone, since the zone was summarised
+                    continue
+                speed = budget_fan.speed(level)
+                if speed != fan.applied_speed:
+                    changes.append((fan, speed))
+
+        elapsed = self.clock() - start
+        self.solves += 1
+        self.solve_time += elapsed
+        self.last_solve_time = elapsed
+        self.max_solve_time = max(self.max_solve_time, elapsed)
+        return changes
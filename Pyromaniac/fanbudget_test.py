@@ -0,0 +1,117 @@
+"""
+Test that the fan budget allocates speeds properly.
+"""
+
+import random
+import unittest
+
+from . import fanbudget
+from .constants import FanConstants
+
+
+class FakeFan(object):
+    """
+    The parts of a FanDescriptor which the budget uses.
+    """
+
+    def __init__(self, fan_id, maximum, performance, accuracy=1):
+        self.fan_id = fan_id
+        self.location_id = FanConstants.FanType_Device_CPU << FanConstants.FanType_Device_Shift
+        self.maximum = maximum
+        self.speeds = None
+        self.accuracy = accuracy
+        self.capabilities = FanConstants.FanCapability_SupportsManual
+        self.control_mode = FanConstants.FanControl_AutomaticPerformance if performance \
+                                else FanConstants.FanControl_AutomaticNoise
+        self.budget_managed = True
+        self.applied_speed = None
+
+
+def make_fans(seed, count):
+    rng = random.Random(seed)
+    return [FakeFan(fan_id, rng.choice((100, 2400, 5000)), rng.random() < 0.7,
+                    accuracy=rng.choice((1, 5, 50)))
+            for fan_id in range(1, count + 1)]
+
+
+def brute_costs(summary, levels):
+    """
+    The costs of a zone at each level, found by visiting every fan.
+    """
+    return [[sum(min(max(budget_fan.low, level), budget_fan.high) ** exponent
+                 if budget_fan.performance else budget_fan.low ** exponent
+                 for budget_fan in summary.fans)
+             for level in levels]
+            for exponent in summary.exponents]
+
+
+class TestZoneSummary(unittest.TestCase):
+
+    levels = [0.0, 0.1, 0.25, 0.3, 0.5, 0.75, 0.9, 1.0]
+
+    def summary(self, fans):
+        return fanbudget.ZoneSummary(0, fans, 30)
+
+    def costs(self, fans, use_numpy, levels=None):
+        levels = levels or self.levels
+        saved = fanbudget.numpy
+        if not use_numpy:
+            fanbudget.numpy = None
+        try:
+            summary = self.summary(fans)
+            levels = fanbudget.numpy.array(levels) if fanbudget.numpy else list(levels)
+            return (summary, [[float(cost) for cost in costs] for costs in summary.costs(levels)])
+        finally:
+            fanbudget.numpy = saved
+
+    def assertCostsEqual(self, first, second):
+        for first_costs, second_costs in zip(first, second):
+            for first_cost, second_cost in zip(first_costs, second_costs):
+                self.assertAlmostEqual(first_cost, second_cost, places=9)
+
+    def test_pure_python_matches_fans(self):
+        for seed in range(5):
+            (summary, costs) = self.costs(make_fans(seed, 200), use_numpy=False)
+            self.assertCostsEqual(costs, brute_costs(summary, self.levels))
+
+    @unittest.skipUnless(fanbudget.numpy, "NumPy is not installed")
+    def test_numpy_matches_pure_python(self):
+        for seed in range(5):
+            fans = make_fans(seed, 200)
+            (_, python_costs) = self.costs(fans, use_numpy=False)
+            (_, numpy_costs) = self.costs(fans, use_numpy=True)
+            self.assertCostsEqual(numpy_costs, python_costs)
+
+    @unittest.skipUnless(fanbudget.numpy, "NumPy is not installed")
+    def test_numpy_at_the_limits(self):
+        # Levels which fall exactly on the lowest and highest speeds of the fans
+        fans = make_fans(1, 50)
+        summary = self.summary(fans)
+        levels = sorted(set([budget_fan.low for budget_fan in summary.fans] +
+                            [budget_fan.high for budget_fan in summary.fans]))
+        (_, python_costs) = self.costs(fans, use_numpy=False, levels=levels)
+        (_, numpy_costs) = self.costs(fans, use_numpy=True, levels=levels)
+        self.assertCostsEqual(numpy_costs, python_costs)
+
+
+class TestFanBudget(unittest.TestCase):
+
+    def test_failed_write_is_allocated_again(self):
+        fans = make_fans(2, 20)
+        budget = fanbudget.FanBudget(power=10000, clock=lambda: 0.0)
+        for fan in fans:
+            budget.changed(fan)
+        changes = budget.solve()
+        self.assertTrue(changes)
+        (failed_fan, speed) = changes[0]
+        for fan, fan_speed in changes[1:]:
+            fan.applied_speed = fan_speed
+
+        # Nothing has changed, so the failure has to be noted for the fan to be allocated again
+        self.assertEqual(budget.solve(), [])
+        budget.failed(failed_fan)
+        self.assertEqual(budget.solve(), [(failed_fan, speed)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+"""
+Calibration of fans which are set by percentage but report RPM.
+
+A calibration run steps each fan through the speeds it may be set to, waits
+for the fan to settle at each, and records the RPM it reports. All the fans
+are calibrated at once, with no more than a limited number of fans on each
+driver being calibrated at the same time, so that a run takes about as long
+as the slowest fan.
+
+While a fan is being calibrated it is marked as calibrating, and nothing
+else may change its speed or control mode until it has been put back.
+
+The result is a table for each fan, which maps a target RPM to the speed
+that the fan should be set to.
+"""
+
+import bisect
+
+from riscos.errors import RISCOSError
+
+from .constants import FanConstants
+
+
+class CalibrationTable(object):
+    """
+    The RPM measured at each speed a fan was set to.
+    """
+
+    def __init__(self, points):
+        """
+        @param points:  list of (speed, rpm) tuples
+        """
+        self.points = sorted(points)
+
+    def __repr__(self):
+        return "<{}({} points)>".format(self.__class__.__name__, len(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        return iter(self.points)
+
+    @property
+    def rpm_range(self):
+        rpms = [rpm for speed, rpm in self.points]
+        return (min(rpms), max(rpms))
+
+    def speed_for_rpm(self, rpm, fan):
+        """
+        Find the speed to set a fan to, for it to run at an RPM.
+
+        The speed is interpolated between the calibrated points, and then rounded
+        up to a speed that the fan accepts.
+
+        @param rpm:     target RPM
+        @param fan:     FanDescriptor that the table is for
+
+        @return: speed to set
+        """
+        # Fans may not speed up monotonically, so use the points in order of RPM
+        by_rpm = sorted((point_rpm, speed) for speed, point_rpm in self.points)
+        rpms = [point_rpm for point_rpm, speed in by_rpm]
+        index = bisect.bisect_left(rpms, rpm)
+        if index == 0:
+            speed = by_rpm[0][1]
+        elif index == len(by_rpm):
+            speed = by_rpm[-1][1]
+        else:
+            (low_rpm, low_speed) = by_rpm[index - 1]
+            (high_rpm, high_speed) = by_rpm[index]
+            speed = low_speed + (high_speed - low_speed) * (rpm - low_rpm) / float(high_rpm - low_rpm)
+
+        if fan.speeds:
+            higher = [allowed for allowed in fan.speeds if allowed >= speed]
+            return min(higher) if higher else max(fan.speeds)
+        accuracy = fan.accuracy or 1
+        speed = int(-(-speed // accuracy) * accuracy)
+        maximum = fan.maximum or 100
+        return min(speed, maximum - maximum % accuracy)
+
+
+class FanCalibration(object):
+    """
+    The progress of the calibration of one fan.
+    """
+    # Largest number of steps to calibrate a fan at, when it accepts arbitrary speeds
+    max_steps = 20
+    # Number of readings we take, at most, waiting for the fan to settle at each step
+    max_reads = 5
+    # Number of times, at most, we try again to read a fan whose driver is not responding
+    max_retries = 20
+
+    State_Queued = 0
+    State_Running = 1
+    State_Done = 2
+    State_Failed = 3
+
+    def __init__(self, fan):
+        self.fan = fan
+        self.steps = self.calibration_steps(fan)
+        self.index = 0
+        self.state = self.State_Queued
+        # Time (from the run's clock) at which the fan is next read
+        self.deadline = None
+        self.last_rpm = None
+        self.reads = 0
+        self.retries = 0
+        self.points = []
+        self.error = None
+        # What to put back when we're done
+        self.original_control = None
+        self.original_speed = None
+
+    def __repr__(self):
+        return "<{}(fan={}, step {}/{}, state={})>".format(self.__class__.__name__, self.fan.fan_id,
+                                                           self.index, len(self.steps), self.state)
+
+    @classmethod
+    def calibration_steps(cls, fan):
+        """
+        List the speeds to calibrate a fan at.
+        """
+        if fan.speeds:
+            return sorted(speed for speed in fan.speeds if 0 <= speed <= 100)
+        accuracy = fan.accuracy or 1
+        maximum = fan.maximum or 100
+        steps = list(range(accuracy, min(maximum, 100) + 1, accuracy))
+        if len(steps) > cls.max_steps:
+            # Take evenly spaced steps, always including the highest
+            stride = -(-len(steps) // cls.max_steps)
+            steps = steps[::-1][::stride][::-1]
+        return steps
+
+    @staticmethod
+    def can_calibrate(fan):
+        """
+        Whether a fan can be calibrated: it must be set manually by percentage.
+        """
+        if not fan.capabilities & FanConstants.FanCapability_SupportsManual:
+            return False
+        if fan.maximum > 100:
+            # The fan is already set by RPM
+            return False
+        return bool(FanCalibration.calibration_steps(fan))
+
+    @property
+    def finished(self):
+        return self.state in (self.State_Done, self.State_Failed)
+
+
+class CalibrationRun(object):
+    """
+    Calibrates a number of fans at once.
+    """
+
+    def __init__(self, registry, fans, clock, settle=2.0, concurrency=4, finished=None):
+        """
+        @param registry:    the Fans registry
+        @param fans:        the fans to calibrate
+        @param clock:       function returning the time in seconds
+        @param settle:      time, in seconds, to let a fan settle at each step
+        @param concurrency: largest number of fans on each driver to calibrate at once
+        @param finished:    function called with each fan which has been put back after its
+                            calibration, or None
+        """
+        self.registry = registry
+        self.finished_fan = finished
+        self.settle = settle
+        self.concurrency = max(1, concurrency)
+        self.clock = clock
+        self.calibrations = [FanCalibration(fan) for fan in fans]
+        # Number of fans being calibrated on each driver, keyed by (driver, workspace)
+        self.active = {}
+        self.started = clock()
+        self.duration = None
+
+    def __repr__(self):
+        return "<{}({} fans, {} remaining)>".format(self.__class__.__name__, len(self.calibrations),
+                                                    self.remaining)
+
+    @property
+    def remaining(self):
+        return sum(1 for calibration in self.calibrations if not calibration.finished)
+
+    @property
+    def finished(self):
+        return self.remaining == 0
+
+    @staticmethod
+    def driver_key(fan):
+        return (fan.driver, fan.driver_ws)
+
+    def start(self, calibration, now):
+        fan = calibration.fan
+        calibration.state = FanCalibration.State_Running
+        fan.calibrating = True
+        calibration.original_speed = fan.applied_speed
+        key = self.driver_key(fan)
+        self.active[key] = self.active.get(key, 0) + 1
+        try:
+            calibration.original_control = fan.get_control()
+            if calibration.original_control != FanConstants.FanControl_Manual:
+                fan.set_control(FanConstants.FanControl_Manual, checked=True)
+            self.set_step(calibration, now)
+        except RISCOSError as exc:
+            self.fail(calibration, exc.errmess)
+
+    def set_step(self, calibration, now):
+        calibration.fan.set_speed(calibration.steps[calibration.index], checked=True)
+        calibration.deadline = now + self.settle
+        calibration.last_rpm = None
+        calibration.reads = 0
+
+    def finish(self, calibration, state):
+        """
+        Stop calibrating a fan, putting back its control mode and speed.
+        """
+        fan = calibration.fan
+        calibration.state = state
+        key = self.driver_key(fan)
+        self.active[key] -= 1
+        try:
+            if calibration.original_speed is not None:
+                fan.set_speed(calibration.original_speed, checked=True)
+            if calibration.original_control not in (None, fan.control_mode):
+                fan.set_control(calibration.original_control, checked=True)
+        except RISCOSError:
+            # Nothing more that we can do; the fan is left at the last step.
+            pass
+        fan.calibrating = False
+        if state == FanCalibration.State_Done:
+            fan.calibration = CalibrationTable(calibration.points)
+        if self.finished_fan:
+            self.finished_fan(fan)
+
+    def deregistered(self, calibration):
+        """
+        Stop calibrating a fan which has gone away.
+        """
+        calibration.error = "Fan was deregistered"
+        calibration.state = FanCalibration.State_Failed
+        calibration.fan.calibrating = False
+        self.active[self.driver_key(calibration.fan)] -= 1
+
+    def fail(self, calibration, message):
+        calibration.error = message
+        self.finish(calibration, FanCalibration.State_Failed)
+
+    def step(self):
+        """
+        Advance the calibration of every fan.
+
+        @return: True if the run has finished
+        """
+        now = self.clock()
+
+        # Start the fans which have a free slot on their driver
+        for calibration in self.calibrations:
+            if calibration.state == FanCalibration.State_Queued:
+                if self.registry.fans.get(calibration.fan.fan_id, None) is not calibration.fan:
+                    calibration.error = "Fan was deregistered"
+                    calibration.state = FanCalibration.State_Failed
+                elif self.active.get(self.driver_key(calibration.fan), 0) < self.concurrency:
+                    self.start(calibration, now)
+
+        due = [calibration for calibration in self.calibrations
+               if calibration.state == FanCalibration.State_Running and calibration.deadline <= now]
+        if due:
+            readings = self.registry.get_speeds([calibration.fan for calibration in due])
+            for calibration, (fan, rpm, error) in zip(due, readings):
+                if self.registry.fans.get(fan.fan_id, None) is not fan:
+                    self.deregistered(calibration)
+                elif error:
+                    self.fail(calibration, error.errmess)
+                elif fan.stale:
+                    # The driver is not responding, and we were given the last speed we knew
+                    calibration.retries += 1
+                    if calibration.retries > FanCalibration.max_retries:
+                        self.fail(calibration, "Fan's driver is not responding")
+                    else:
+                        calibration.deadline = now + self.settle / 4
+                else:
+                    self.reading(calibration, rpm, now)
+
+        if self.finished and self.duration is None:
+            self.duration = now - self.started
+        return self.finished
+
+    def reading(self, calibration, rpm, now):
+        """
+        Process a reading of a fan being calibrated.
+        """
+        rpm &= 0xFFFFFFFF
+        if rpm & 0x80000000:
+            self.fail(calibration, "Fan reported state {}".format(rpm - 0x100000000))
+            return
+        calibration.reads += 1
+        last_rpm = calibration.last_rpm
+        settled = last_rpm is not None and abs(rpm - last_rpm) <= max(rpm // 50, 20)
+        if not settled and calibration.reads < FanCalibration.max_reads:
+            # Read again shortly, to see if it has stopped changing
+            calibration.last_rpm = rpm
+            calibration.deadline = now + self.settle / 4
+            return
+
+        speed = calibration.steps[calibration.index]
+        if rpm != 0 and rpm < 200:
+            self.fail(calibration, "Fan does not report its speed in RPM")
+            return
+        calibration.points.append((speed, rpm))
+        calibration.index += 1
+        if calibration.index == len(calibration.steps):
+            self.finish(calibration, FanCalibration.State_Done)
+            return
+        try:
+            self.set_step(calibration, now)
+        except RISCOSError as exc:
+            self.fail(calibration, exc.errmess)
+
+    def abort(self):
+        """
+        Stop the run, putting back every fan that was being calibrated.
+        """
+        for calibration in self.calibrations:
+            if calibration.state == FanCalibration.State_Running:
+                if self.registry.fans.get(calibration.fan.fan_id, None) is calibration.fan:
+                    self.fail(calibration, "Calibration aborted")
+                else:
+                    self.deregistered(calibration)
+            elif calibration.state == FanCalibration.State_Queued:
+                calibration.error = "Calibration aborted"
+                calibration.state = FanCalibration.State_Failed
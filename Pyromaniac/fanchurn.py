@@ -0,0 +1,225 @@
+"""
+Churn stress test for the fan modules.
+
+The harness repeatedly kills the fan driver module and FanController and
+loads them again (so that the fans are deregistered and registered again,
+and every block the modules hold is freed and allocated again), and calls
+FanController_Info and FanController_Enumerate on the registered fans. It
+checks that the number of live RMA blocks in every account, and the size of
+the Python heap, is no larger at the end than it was after a warm-up pass.
+
+Optionally, host threads read the published snapshots of the running
+FanController's registry while the churn runs, checking that every snapshot
+they see holds the number of fans the registry had at its generation, that
+only one snapshot is made of each generation, and that the snapshots never
+go backwards.
+"""
+
+import gc
+import threading
+import time
+import tracemalloc
+
+from .constants import FanConstants
+from .fanrma import RMAAccount
+
+
+class ChurnResult(object):
+    """
+    The outcome of a churn run.
+    """
+
+    def __init__(self):
+        self.operations = 0
+        self.reloads = 0
+        self.duration = 0
+        # Change in the live blocks in each account, keyed by owner
+        self.live_growth = {}
+        # Number of RMA allocations made by each account during the run, keyed by owner
+        self.allocations = {}
+        self.heap_growth = 0
+        # Snapshots read by the reader threads, and the number which were inconsistent
+        self.snapshot_reads = 0
+        self.snapshot_errors = 0
+
+    def __repr__(self):
+        return "<{}({} operations, {} reloads, heap growth {} bytes)>".format(self.__class__.__name__,
+                                                                              self.operations,
+                                                                              self.reloads,
+                                                                              self.heap_growth)
+
+    def passed(self, heap_tolerance):
+        return self.leaked_blocks == 0 and self.heap_growth <= heap_tolerance and self.snapshot_errors == 0
+
+    @property
+    def leaked_blocks(self):
+        return sum(growth for growth in self.live_growth.values() if growth > 0)
+
+    def allocations_per_operation(self, owner):
+        total = self.operations + self.reloads
+        if not total:
+            return 0
+        return self.allocations.get(owner, 0) / total
+
+
+class ChurnHarness(object):
+    """
+    Drives the fan modules through the SWI interfaces.
+    """
+    # Growth of the Python heap (in bytes) that we accept as noise
+    heap_tolerance = 64 * 1024
+
+    controller_module = 'FanController'
+
+    def __init__(self, ro, driver_module='FanDriverPyromaniac', registry=None):
+        """
+        @param ro:              RISC OS instance
+        @param driver_module:   name of the driver module to reload
+        @param registry:        function returning the Fans registry whose snapshots the reader
+                                threads check, or None whilst FanController is not running
+        """
+        self.ro = ro
+        self.driver_module = driver_module
+        self.registry = registry
+
+    def __repr__(self):
+        return "<{}(driver={})>".format(self.__class__.__name__, self.driver_module)
+
+    def reload_modules(self):
+        """
+        Kill the driver and FanController, and load them again.
+
+        The modules are built in, so RMReInit is how they are loaded again once killed.
+        """
+        self.ro.kernel.api.os_cli("RMKill {}".format(self.driver_module))
+        self.ro.kernel.api.os_cli("RMKill {}".format(self.controller_module))
+        self.ro.kernel.api.os_cli("RMReInit {}".format(self.controller_module))
+        self.ro.kernel.api.os_cli("RMReInit {}".format(self.driver_module))
+
+    def enumerate_and_info(self):
+        """
+        Walk the fans with FanController_Enumerate, reading each with FanController_Info.
+
+        @return: number of SWIs called
+        """
+        calls = 0
+        fan_id = 0
+        while True:
+            rout = self.ro.kernel.api.swi(FanConstants.SWIFanController_Enumerate,
+                                          regs={0: fan_id})
+            calls += 1
+            if rout[0] == 0xFFFFFFFF or rout[0] == -1:
+                return calls
+            fan_id = rout[0]
+            self.ro.kernel.api.swi(FanConstants.SWIFanController_Info,
+                                   regs={0: fan_id})
+            calls += 1
+
+    def read_snapshots(self, stop, result, lock):
+        """
+        Host thread reading the registry snapshots until told to stop.
+        """
+        reads = 0
+        errors = 0
+        registry = None
+        last = None
+        while not stop.is_set():
+            current = self.registry()
+            if current is None:
+                # FanController is being reloaded
+                continue
+            if current is not registry:
+                # A new registry starts its generations again
+                registry = current
+                last = None
+            # The snapshot is made by whichever thread reads it first, so this races with
+            # the registrations on the emulation thread.
+            snapshot = registry.snapshot
+            if not snapshot.consistent():
+                errors += 1
+            if last and (snapshot.generation < last.generation or
+                         (snapshot.generation == last.generation and snapshot is not last)):
+                # Generations went backwards, or two different snapshots were made of one
+                errors += 1
+            last = snapshot
+            for record in snapshot:
+                if snapshot.get(record.fan_id) is not record:
+                    errors += 1
+            reads += 1
+        with lock:
+            result.snapshot_reads += reads
+            result.snapshot_errors += errors
+
+    def cycle(self, reloads, operations):
+        """
+        Perform one cycle of churn.
+
+        @return: tuple of (reloads performed, SWI operations performed)
+        """
+        done = 0
+        for _ in range(reloads):
+            self.reload_modules()
+        while done < operations:
+            done += self.enumerate_and_info()
+        return (reloads, done)
+
+    def run(self, reloads=1000, operations=1000000, readers=0):
+        """
+        Run the churn, checking for growth in the RMA and Python heap.
+
+        @param reloads:     number of times to kill and load the modules
+        @param operations:  number of Enumerate/Info SWIs to call
+        @param readers:     number of host threads to read the registry snapshots
+
+        @return: ChurnResult
+        """
+        result = ChurnResult()
+
+        # Warm up, so that anything allocated once (and caches) are already present
+        self.cycle(1, 100)
+
+        accounts = RMAAccount.all(self.ro)
+        live_before = dict((account.owner, account.live) for account in accounts)
+        allocations_before = dict((account.owner, account.allocations) for account in accounts)
+
+        stop = threading.Event()
+        lock = threading.Lock()
+        threads = []
+        if self.registry:
+            for _ in range(readers):
+                thread = threading.Thread(target=self.read_snapshots, args=(stop, result, lock))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            gc.collect()
+            (heap_before, _) = tracemalloc.get_traced_memory()
+
+            start = time.perf_counter()
+            # Interleave the registrations with the reads, so that we read fans which come and go
+            steps = max(1, min(reloads, 100))
+            for step in range(steps):
+                (done_reloads, done_operations) = self.cycle(reloads // steps + (1 if step < reloads % steps else 0),
+                                                            operations // steps)
+                result.reloads += done_reloads
+                result.operations += done_operations
+            result.duration = time.perf_counter() - start
+
+            gc.collect()
+            (heap_after, _) = tracemalloc.get_traced_memory()
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        result.heap_growth = heap_after - heap_before
+        for account in RMAAccount.all(self.ro):
+            result.live_growth[account.owner] = account.live - live_before.get(account.owner, 0)
+            result.allocations[account.owner] = account.allocations - allocations_before.get(account.owner, 0)
+        return result
@@ -0,0 +1,196 @@
+"""
+Clocks for the fan modules.
+
+Everything in the fan modules which depends on the passage of time reads it
+from the clock of the RISC OS instance, so that the host clock can be
+replaced by a virtual one. The virtual clock only moves when it is told to:
+it runs the events scheduled on it in time order, jumping straight from one
+to the next, and calls which would sleep just move it on. A simulation of
+many hours of fan behaviour can therefore run in however long the events
+themselves take, and gives the same results each time it is run with the
+same seed.
+"""
+
+import heapq
+import random
+import time
+import weakref
+
+
+# Clocks for each RISC OS instance
+_clocks = weakref.WeakKeyDictionary()
+
+
+class Clock(object):
+    """
+    The time, as seen by the fan modules.
+    """
+    virtual = False
+
+    def __init__(self, seed=0):
+        """
+        @param seed:    seed for the random numbers drawn by users of the clock
+        """
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def __repr__(self):
+        return "<{}()>".format(self.__class__.__name__)
+
+    @classmethod
+    def get(cls, ro):
+        """
+        Find the clock for a RISC OS instance, using the host clock if none was installed.
+        """
+        clock = _clocks.get(ro, None)
+        if not clock:
+            clock = HostClock()
+            _clocks[ro] = clock
+        return clock
+
+    @staticmethod
+    def install(ro, clock):
+        """
+        Use a clock for everything in a RISC OS instance.
+        """
+        _clocks[ro] = clock
+
+    def time(self):
+        """
+        @return: the time since the epoch, in seconds
+        """
+        raise NotImplementedError("{}.time() is not implemented".format(self.__class__.__name__))
+
+    def monotonic(self):
+        """
+        @return: a time in seconds which never goes backwards
+        """
+        raise NotImplementedError("{}.monotonic() is not implemented".format(self.__class__.__name__))
+
+    def perf_counter(self):
+        return self.monotonic()
+
+    def perf_counter_ns(self):
+        return int(self.perf_counter() * 1000000000)
+
+    def sleep(self, duration):
+        raise NotImplementedError("{}.sleep() is not implemented".format(self.__class__.__name__))
+
+
+class HostClock(Clock):
+    """
+    The host's own clock.
+    """
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def perf_counter_ns(self):
+        return time.perf_counter_ns()
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+
+class ClockEvent(object):
+    """
+    An event scheduled on the virtual clock.
+    """
+    __slots__ = ('when', 'sequence', 'callback', 'interval', 'cancelled')
+
+    def __init__(self, when, sequence, callback, interval):
+        self.when = when
+        self.sequence = sequence
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<{}(t={}, every {})>".format(self.__class__.__name__, self.when, self.interval)
+
+    def __lt__(self, other):
+        # Events at the same time run in the order they were scheduled
+        return (self.when, self.sequence) < (other.when, other.sequence)
+
+
+class VirtualClock(Clock):
+    """
+    Discrete event clock, whose time only moves when it is run.
+    """
+    virtual = True
+    # Time since the epoch that the clock starts at (1 Jan 2000), so that runs are repeatable
+    epoch = 946684800.0
+
+    def __init__(self, seed=0):
+        super(VirtualClock, self).__init__(seed)
+        self.now = 0.0
+        self.queue = []
+        self.sequence = 0
+        # Number of events which have been run
+        self.events = 0
+
+    def __repr__(self):
+        return "<{}(t={}, {} events pending)>".format(self.__class__.__name__, self.now, len(self.queue))
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, duration):
+        if duration > 0:
+            self.now += duration
+
+    def schedule(self, delay, callback, interval=None):
+        """
+        Schedule a function to be called.
+
+        @param delay:       time, in seconds, from now until it is called
+        @param callback:    function to call, with no arguments
+        @param interval:    time, in seconds, between repeated calls, or None to only call once
+
+        @return: the ClockEvent, which may be cancelled
+        """
+        self.sequence += 1
+        event = ClockEvent(self.now + delay, self.sequence, callback, interval)
+        heapq.heappush(self.queue, event)
+        return event
+
+    def every(self, interval, callback):
+        return self.schedule(interval, callback, interval=interval)
+
+    @staticmethod
+    def cancel(event):
+        event.cancelled = True
+
+    def run(self, duration):
+        """
+        Run the events due in the next period of time, moving the clock to each in turn.
+
+        @param duration:    time, in seconds, to run for
+
+        @return: number of events which were run
+        """
+        end = self.now + duration
+        count = 0
+        while self.queue and self.queue[0].when <= end:
+            event = heapq.heappop(self.queue)
+            if event.cancelled:
+                continue
+            # Sleeps within earlier events may have taken us past this one
+            self.now = max(self.now, event.when)
+            if event.interval:
+                event.when += event.interval
+                heapq.heappush(self.queue, event)
+            event.callback()
+            count += 1
+        self.now = max(self.now, end)
+        self.events += count
+        return count
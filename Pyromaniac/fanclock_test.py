@@ -0,0 +1,160 @@
+"""
+Test that simulations on the virtual clock are repeatable.
+"""
+
+import unittest
+
+from .constants import FanConstants
+from .fanclock import VirtualClock
+from .fanhealth import DriverHealth
+from .fanleases import FanLeases
+from .fanqueue import DriverQueue
+from .fansampling import AdaptiveSampling
+from .fansketch import FanSketches
+
+
+class SimulatedFan(object):
+    """
+    A fan which ramps towards the speed it is set to, with the state that the sampler keeps.
+    """
+
+    def __init__(self, fan_id, location_id, ramp_rate):
+        self.fan_id = fan_id
+        self.location_id = location_id
+        self.accuracy = 10
+        self.ramp_rate = ramp_rate
+        self.speed = 1000
+        self.target = 1000
+        self.ramp_time = 0.0
+
+        self.sample_next = 0
+        self.sample_period = 1
+        self.sample_speed = None
+        self.sample_since = None
+        self.samples = 0
+
+    def current_speed(self, now):
+        step = self.ramp_rate * (now - self.ramp_time)
+        if self.target > self.speed:
+            return int(min(self.speed + step, self.target))
+        return int(max(self.speed - step, self.target))
+
+    def set_target(self, speed, now):
+        self.speed = self.current_speed(now)
+        self.target = speed
+        self.ramp_time = now
+
+
+class FleetSimulation(object):
+    """
+    A fleet of fans on the virtual clock, sampled, sketched and leased as FanController does.
+    """
+    sample_interval = 60.0
+    retarget_interval = 600.0
+    lease_interval = 300.0
+
+    def __init__(self, seed, fans):
+        self.clock = VirtualClock(seed=seed)
+        rng = self.clock.random
+        self.fans = []
+        for fan_id in range(1, fans + 1):
+            device = rng.choice((FanConstants.FanType_Device_CPU, FanConstants.FanType_Device_GPU,
+                                 FanConstants.FanType_Device_PSU))
+            location_id = (device << FanConstants.FanType_Device_Shift) | \
+                          ((fan_id & FanConstants.FanType_Sequence_Mask) << FanConstants.FanType_Sequence_Shift)
+            # Each fan's ramp rate varies, as the driver's ramp_jitter makes it
+            self.fans.append(SimulatedFan(fan_id, location_id, 50 * (1 + rng.uniform(-0.2, 0.2))))
+
+        self.sampling = AdaptiveSampling()
+        self.sketches = FanSketches()
+        self.health = DriverHealth(self.clock.monotonic)
+        self.queue = DriverQueue(self.clock.monotonic, calls_per_tick=20, tick_time=1.0)
+        self.leases = FanLeases(self.clock.monotonic, tick_time=10.0)
+
+        self.clock.every(self.sample_interval, self.sample)
+        self.clock.every(self.retarget_interval, self.retarget)
+        self.clock.every(self.lease_interval, self.lease)
+        self.clock.every(1.0, self.run_queue)
+
+    def read(self, fans):
+        now = self.clock.monotonic()
+        for fan in fans:
+            if not self.health.allow():
+                self.sampling.failed(fan)
+                continue
+            # A few of the calls fail, and a few take longer than the breaker allows
+            self.queue.called()
+            failed = self.clock.random.random() < 0.005
+            self.health.result(failed, self.clock.random.expovariate(5.0))
+            if failed:
+                self.sampling.failed(fan)
+                continue
+            speed = fan.current_speed(now)
+            self.sampling.sampled(fan, now, speed)
+            self.sketches.sample(fan, now, speed)
+
+    def sample(self):
+        due = self.sampling.due(self.fans)
+        for start in range(0, len(due), 50):
+            self.queue.submit(DriverQueue.Class_Sampling, self.read, due[start:start + 50], read=True)
+
+    def run_queue(self):
+        self.queue.run()
+
+    def retarget(self):
+        now = self.clock.monotonic()
+        rng = self.clock.random
+        for fan in rng.sample(self.fans, max(1, len(self.fans) // 20)):
+            fan.set_target(rng.randrange(400, 5000, 10), now)
+
+    def lease(self):
+        rng = self.clock.random
+        for fan in rng.sample(self.fans, max(1, len(self.fans) // 100)):
+            self.leases.acquire(fan, rng.randrange(400, 5000, 10), rng.uniform(60, 3600), rng.randint(0, 3))
+        self.leases.advance()
+        for fan in self.leases.take_expired():
+            lease = self.leases.winner(fan.fan_id)
+            if lease:
+                fan.set_target(lease.speed, self.clock.monotonic())
+
+    def run(self, duration):
+        """
+        @return: tuple describing everything the simulation did
+        """
+        events = self.clock.run(duration)
+        now = self.clock.monotonic()
+        zones = tuple(sorted((key, sketch.rpm.count, sketch.rpm.quantile(0.5), sketch.rpm.quantile(0.99))
+                             for key, sketch in self.sketches.grouped(FanSketches.Field_Device, now).items()))
+        return (events, self.clock.now, self.clock.time(),
+                self.sampling.sampled_count, self.sampling.skipped_count,
+                tuple((stats.run, stats.deferred, stats.merged) for stats in self.queue.stats),
+                self.leases.granted, self.leases.expired, len(self.leases),
+                self.health.consecutive_errors, self.health.refused,
+                zones,
+                tuple(fan.current_speed(now) for fan in self.fans))
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def test_events_in_order(self):
+        clock = VirtualClock()
+        calls = []
+        clock.schedule(2.0, lambda: calls.append(('b', clock.monotonic())))
+        clock.schedule(1.0, lambda: calls.append(('a', clock.monotonic())))
+        clock.schedule(2.0, lambda: calls.append(('c', clock.monotonic())))
+        self.assertEqual(clock.run(5.0), 3)
+        self.assertEqual(calls, [('a', 1.0), ('b', 2.0), ('c', 2.0)])
+        self.assertEqual(clock.monotonic(), 5.0)
+
+    def test_day_is_repeatable(self):
+        # A simulated day of a fleet gives the same results each time for the same seed
+        first = FleetSimulation(seed=1234, fans=1000).run(86400)
+        second = FleetSimulation(seed=1234, fans=1000).run(86400)
+        self.assertEqual(first, second)
+
+        other = FleetSimulation(seed=4321, fans=1000).run(86400)
+        self.assertNotEqual(first, other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,379 @@
 FanController module.
 """
 
-from riscos.errors import RISCOSSyntheticError
+import bisect
+import threading
+import time
+import weakref
+
+from pyromaniac.config import Configuration
+
+from riscos.errors import RISCOSSyntheticError, RISCOSError
 
 from riscos.modules.pymodules import PyModule
 from riscos.readargs import read_args
 
 from .constants import FanConstants
+from .fananomaly import AnomalyDetector
+from .fanbatch import DriverBatch
+from .fanbudget import FanBudget, snap_speed
+from .fancalibrate import CalibrationRun, FanCalibration
+from .fanclock import Clock, VirtualClock
+from .fanchurn import ChurnHarness
+from .fangroups import FanGroup, FanGroups
+from .fanleases import FanLeases
+from .fanqueue import DriverQueue
+from .fanhealth import DriverHealth
+from .fanrma import RMAAccount
+from .fansampling import AdaptiveSampling
+from .fansketch import FanSketches
+from .fansnapshot import FanSnapshot
+from .fanstatus import FanStatusTable
+from .fanstats import CallStats, DriverStats
+from .fanserver import FanEvent, TelemetryServer
+from .fantelemetry import TelemetryStore
+from .fantrace import TraceBuffer
+from .fanwarm import WarmStart
+from .fanwatch import FanWatch
+from .fanwrites import WriteBehind
+
+
+class FanControllerConfig(Configuration):
+    _types = {
+            'slow_driver_threshold': int,
+            'trace_records': int,
+            'breaker_errors': int,
+            'breaker_backoff': int,
+            'breaker_backoff_max': int,
+            'breaker_timeout': int,
+            'sample_interval': int,
+            'sample_backoff_max': int,
+            'anomaly_window': int,
+            'anomaly_threshold': int,
+            'anomaly_drift': int,
+            'calibrate_settle': int,
+            'calibrate_concurrency': int,
+            'budget_noise': int,
+            'budget_power': int,
+            'budget_fan_noise': int,
+            'budget_fan_power': int,
+            'budget_requirement': int,
+            'budget_requirements': str,
+            'budget_interval': int,
+            'budget_time': int,
+            'lease_interval': int,
+            'lease_revert_control': int,
+            'lease_safe_speed': int,
+            'sketch_window': int,
+            'sketch_windows': int,
+            'sketch_accuracy': int,
+            'clock': 'enum:host,virtual',
+            'clock_seed': int,
+            'telemetry_dir': str,
+            'telemetry_socket': str,
+            'telemetry_socket_queue': int,
+            'write_behind': int,
+            'queue_calls': int,
+            'queue_interval': int,
+            'state_file': str,
+            'state_restore': int,
+            'status_table': int,
+            'write_deadband': int,
+    }
+    _help = {
+            'slow_driver_threshold': """
+Configures the 99th percentile latency, in microseconds, above which a fan
+driver is considered to be slow. When a driver becomes slow (or recovers)
+the FanController_FanChangedState service is issued for each of its fans.
+Use 0 to disable the check.
+""",
+
+            'trace_records': """
+Configures the number of records held by the trace buffer used by *FanTrace.
+The buffer is only allocated when tracing is enabled.
+""",
+
+            'breaker_errors': """
+Configures the number of consecutive failed calls to a fan driver after which
+FanController stops calling the driver, and serves the last known speeds for
+its fans instead. Use 0 to always call the driver.
+""",
+
+            'breaker_backoff': """
+Configures the initial time, in milliseconds, that FanController waits before
+trying a driver which has been failing. The time is doubled each time the
+driver is tried and still fails.
+""",
+
+            'breaker_backoff_max': """
+Configures the maximum time, in milliseconds, that FanController waits before
+trying a driver which has been failing.
+""",
+
+            'breaker_timeout': """
+Configures the time, in milliseconds, above which a call to a fan driver is
+considered to have failed, even if it did not return an error. Use 0 to only
+treat errors as failures.
+""",
+
+            'sample_interval': """
+Configures the interval, in centiseconds, at which FanController samples the
+speed of every fan. Use 0 to disable sampling.
+""",
+
+            'sample_backoff_max': """
+Configures the largest number of sample intervals between the samples of a
+fan whose speed is steady. The period between samples doubles while a fan's
+readings stay within its accuracy, and returns to every interval when the
+reading changes or the fan is changed. Use 1 to sample every fan at every
+interval.
+""",
+
+            'anomaly_window': """
+Configures the number of samples over which the moving mean and variance of
+each fan's speed are calculated, to detect fans which are behaving
+abnormally. Anomalous fans are listed as unhealthy. Use 0 to disable the
+detection.
+""",
+
+            'anomaly_threshold': """
+Configures the number of standard deviations from the moving mean at which
+a fan's speed is considered to be erratic.
+""",
+
+            'anomaly_drift': """
+Configures the percentage of the speed a fan was set to, by which its moving
+mean speed may differ before the fan is considered to be drifting. Use 0 to
+not check for drift.
+""",
+
+            'calibrate_settle': """
+Configures the time, in centiseconds, that a fan is given to settle at each
+speed while it is being calibrated.
+""",
+
+            'calibrate_concurrency': """
+Configures the largest number of fans on each driver that are calibrated at
+the same time.
+""",
+
+            'budget_noise': """
+Configures the largest estimated noise, in dBA, of the fans which are in the
+automatic control modes. When this or budget_power is set, FanController
+drives the fans in the automatic modes which can be set manually, rather
+than leaving them to their drivers. Use 0 for no limit on the noise.
+""",
+
+            'budget_power': """
+Configures the largest estimated power, in milliwatts, of the fans which are
+in the automatic control modes. Use 0 for no limit on the power.
+""",
+
+            'budget_fan_noise': """
+Configures the noise, in dBA, of a single fan at its maximum speed, used to
+estimate the noise of the fans.
+""",
+
+            'budget_fan_power': """
+Configures the power, in milliwatts, of a single fan at its maximum speed,
+used to estimate the power of the fans.
+""",
+
+            'budget_requirement': """
+Configures the lowest speed, as a percentage of their maximum, that the fans
+in the automatic modes may be run at to cool their zone. Fans in the
+AutomaticNoise mode run at this speed; fans in the AutomaticPerformance
+mode run as fast as the budget allows.
+""",
+
+            'budget_requirements': """
+Configures the lowest speed for the zones of particular devices, as a
+comma-separated list of device=percentage, such as 'cpu=50,gpu=40'. Devices
+may be given by name or number.
+""",
+
+            'budget_interval': """
+Configures the interval, in centiseconds, at which the speeds of the fans in
+the automatic modes are allocated.
+""",
+
+            'budget_time': """
+Configures the time, in microseconds, that each allocation of the speeds
+should take at most. Zones which cannot be considered in the time are
+left until the next allocation.
+""",
+
+            'lease_interval': """
+Configures the interval, in centiseconds, at which leases on the speeds of
+fans are checked for expiry. Leases last at least as long as requested,
+and expire within this interval of their end.
+""",
+
+            'lease_revert_control': """
+Configures the control mode that fans which support automatic control are
+returned to when the last lease on their speed expires or is released.
+""",
+
+            'lease_safe_speed': """
+Configures the speed, as a percentage of their maximum, that fans without
+automatic control are set to when the last lease on their speed expires
+or is released.
+""",
+
+            'sketch_window': """
+Configures the length, in seconds, of the windows of time that the
+distribution of the sampled speeds is recorded in.
+""",
+
+            'sketch_windows': """
+Configures the number of windows of the distribution of the sampled speeds
+which are kept for each fan and each zone, or 0 to not record the
+distribution. Percentiles of the speeds are reported by `*FanStats`.
+""",
+
+            'sketch_accuracy': """
+Configures the relative accuracy, in parts per thousand, of the percentiles
+of the sampled speeds.
+""",
+
+            'clock': """
+Configures the clock used by the fan modules. The recognised clocks are:
+
+    * `host` - the host's clock.
+    * `virtual` - a simulated clock, which only moves when `*FanSimulate` is
+      used. The periodic work of FanController runs at the simulated times,
+      and the latencies and speed changes of the emulated fans take no real
+      time, so a long period of behaviour can be simulated quickly.
+""",
+
+            'clock_seed': """
+Configures the seed for the random numbers drawn by the users of the clock,
+so that simulations can be repeated exactly.
+""",
+
+            'telemetry_dir': """
+Configures a host directory in which the fan samples are stored, at full
+resolution and downsampled to 1 second, 1 minute and 1 hour intervals.
+Use an empty string to disable the store.
+""",
+
+            'telemetry_socket': """
+Configures a host Unix domain socket on which the fan registrations, state
+changes and samples are streamed to any clients which connect. Use an empty
+string to disable the server.
+""",
+
+            'telemetry_socket_queue': """
+Configures the number of events which may be waiting to be sent to each
+client of the telemetry socket. Events for a client which is not keeping up
+are dropped once this many are waiting. The same limit applies to the events
+waiting to be passed on to the clients.
+""",
+
+            'write_behind': """
+Configures whether fan speed changes are written behind. When set to 1, a
+speed change is validated and recorded, and only the last speed requested
+for each fan is written to its driver on a callback. Use 0 to write every
+speed change to the driver immediately.
+""",
+
+            'write_deadband': """
+Configures the difference from the last speed written to the driver, within
+which a written-behind speed change is dropped. A value of 0 only drops
+changes to the speed that was last written.
+""",
+
+            'queue_calls': """
+Configures the number of calls which may be made to each driver in each
+tick of the driver queue. Requests which arrive when a driver has no calls
+left are queued and run on later ticks, with safety writes first, then
+writes from the control loops, then sampling, then reads for users (which
+are given the last known speed while they wait). Use 0 to call the drivers
+whenever they are needed.
+""",
+
+            'queue_interval': """
+Configures the length, in centiseconds, of each tick of the driver queue.
+""",
+
+            'state_file': """
+Configures a host file in which the state of the fans is saved when
+FanController is finalised. When a driver registers a fan which was saved,
+the fan's control mode and last known speed are preloaded; the speed is
+marked as stale, and is given to readers without calling the driver until
+the fan has been sampled. Use an empty string to disable the saving of the
+state.
+""",
+
+            'state_restore': """
+Configures whether the saved settings are reapplied to fans when they are
+registered. When set to 1, the location, control mode and manually set
+speed which were saved are restored to the fans on a callback after they
+register. Use 0 to only preload the last known speeds.
+""",
+
+            'status_table': """
+Configures the number of fans which the status table dynamic area can
+describe. The table is updated as the fans are sampled, and can be read by
+clients without calling FanController. Use 0 to not create the table.
+""",
+    }
+    slow_driver_threshold = 50000
+    trace_records = 4096
+    breaker_errors = 3
+    breaker_backoff = 100
+    breaker_backoff_max = 30000
+    breaker_timeout = 1000
+    sample_interval = 0
+    sample_backoff_max = 64
+    anomaly_window = 32
+    anomaly_threshold = 4
+    anomaly_drift = 20
+    calibrate_settle = 200
+    calibrate_concurrency = 4
+    budget_noise = 0
+    budget_power = 0
+    budget_fan_noise = 30
+    budget_fan_power = 2000
+    budget_requirement = 30
+    budget_requirements = ''
+    budget_interval = 100
+    budget_time = 10000
+    queue_calls = 0
+    queue_interval = 10
+    lease_interval = 10
+    lease_revert_control = 8
+    lease_safe_speed = 100
+    sketch_window = 3600
+    sketch_windows = 24
+    sketch_accuracy = 10
+    clock = 'host'
+    clock_seed = 0
+    telemetry_dir = ''
+    telemetry_socket = ''
+    telemetry_socket_queue = 1024
+    write_behind = 0
+    write_deadband = 0
+    state_file = ''
+    state_restore = 0
+    status_table = 256
+
+
+def signed_word(value):
+    """
+    Convert a 32bit register value to a signed value.
+    """
+    value &= 0xFFFFFFFF
+    if value & 0x80000000:
+        value -= 0x100000000
+    return value
+
+
+class DriverUnavailableError(RISCOSSyntheticError):
+    """
+    Raised when a call is not made to a driver because it has been failing.
+    """
+    pass
 
 
 class FanDescriptor(object):
@@ -71,7 +438,10 @@ class FanDescriptor(object):
         # Fan_id is assigned on registration
         self.fan_id = None
         self.location_id = location_id
+        # Location the driver registered the fan at, before any moves
+        self.registered_location_id = location_id
         self.provider = provider
+        self.rma = RMAAccount.get(ro, 'FanController')
         self._provider_mem = None
         self.accuracy = accuracy
         self.maximum = maximum
@@ -81,6 +451,48 @@ class FanDescriptor(object):
         self.capabilities = capabilities
         self.driver = driver
         self.driver_ws = driver_ws
+        # The last speed that the driver reported (negative for a FanState), or None if not known
+        self.last_speed = None
+        # Whether the last speed returned was served from last_speed, because the driver was failing
+        self.stale = False
+        # Whether last_speed and control_mode were preloaded from the saved state, and the driver
+        # has not yet been read, and the fan's sequence among those registered at its location
+        self.preloaded = False
+        self.warm_sequence = 0
+        # The last speed written to the driver, and the speed waiting to be written behind
+        self.applied_speed = None
+        self.pending_speed = None
+        # The (control mode, applied speed) the fan had before it was leased, or None if it has
+        # no leases; it is the state saved for the fan, as the leases are not kept
+        self.lease_saved = None
+        # Time (from the clock's time()) that the speed was last sampled, or None if never sampled
+        self.last_sample_time = None
+        # Adaptive sampling: ticks between samples, the tick of the next sample, the speed
+        # the period was decided from, and the number of samples since sample_since
+        self.sample_period = 1
+        self.sample_next = 0
+        self.sample_speed = None
+        self.samples = 0
+        self.sample_since = None
+        # Last state we know for the fan: FanState_OK, or a negative FanState value
+        self.state = FanConstants.FanState_OK
+        # AnomalyDetector flags for the fan's recent speeds
+        self.anomaly = 0
+        # CalibrationTable mapping RPM to the speed to set, or None if not calibrated, and
+        # whether a calibration run owns the fan's speed and control mode
+        self.calibration = None
+        self.calibrating = False
+        # FanBudget which drives the fan in the automatic modes (assigned on registration), and
+        # whether it is doing so
+        self.budget = None
+        self.budget_managed = False
+        # Statistics for this fan, and for the driver as a whole (assigned on registration)
+        self.stats = CallStats()
+        self.driver_stats = None
+        # Health of the driver as a whole (assigned on registration)
+        self.health = None
+        # Trace buffer to record driver calls in, or None if not tracing
+        self.trace = None
 
     def __repr__(self):
         return "<{}(location=&{:08x}, provided by {})>".format(self.__class__.__name__,
@@ -89,14 +501,16 @@ class FanDescriptor(object):
 
     def destroy(self):
         if self._provider_mem:
-            self._provider_mem.free()
+            self.rma.free(self._provider_mem)
+            self._provider_mem = None
         if self._speeds_mem:
-            self._speeds_mem.free()
+            self.rma.free(self._speeds_mem)
+            self._speeds_mem = None
 
     @property
     def provider_mem(self):
         if not self._provider_mem:
-            self._provider_mem = self.ro.kernel.da_rma.strdup(self.provider)
+            self._provider_mem = self.rma.strdup(self.provider, 'provider name')
         return self._provider_mem.address
 
     @property
@@ -105,31 +519,35 @@ class FanDescriptor(object):
             return 0
 
         if not self._speeds_mem:
-            self._speeds_mem = self.ro.kernel.da_rma.allocate((len(self.speeds) + 1) * 4)
+            self._speeds_mem = self.rma.allocate((len(self.speeds) + 1) * 4, 'speeds table')
             self._speeds_mem.write_words(self.speeds)
-            self._speeds_mem[len(self.speeds) * 4 + 4].word = -1
+            self._speeds_mem[len(self.speeds) * 4].word = -1
         return self._speeds_mem.address
 
     def location_name(self):
-        device = (self.location_id >> FanConstants.FanType_Device_Shift) & FanConstants.FanType_Device_Mask
-        sequence = (self.location_id >> FanConstants.FanType_Sequence_Shift) & FanConstants.FanType_Sequence_Mask
-        location = (self.location_id >> FanConstants.FanType_Location_Shift) & FanConstants.FanType_Location_Mask
-        device_name = self.device_names.get(device, "Device#{}".format(device))
+        return self.describe_location(self.location_id)
+
+    @classmethod
+    def describe_location(cls, location_id):
+        device = (location_id >> FanConstants.FanType_Device_Shift) & FanConstants.FanType_Device_Mask
+        sequence = (location_id >> FanConstants.FanType_Sequence_Shift) & FanConstants.FanType_Sequence_Mask
+        location = (location_id >> FanConstants.FanType_Location_Shift) & FanConstants.FanType_Location_Mask
+        device_name = cls.device_names.get(device, "Device#{}".format(device))
 
         if device >= 16 and device <= 31:
             # Devices that report their position in space
             space = []
             lateral = (location >> FanConstants.FanType_Location_Space_LateralShift) & FanConstants.FanType_Location_Space_LateralMask
             if lateral != 0:
-                space.append(self.space_lateral[lateral])
+                space.append(cls.space_lateral[lateral])
 
             longitudinal = (location >> FanConstants.FanType_Location_Space_LongitudinalShift) & FanConstants.FanType_Location_Space_LongitudinalMask
             if longitudinal != 0:
-                space.append(self.space_longitudinal[longitudinal])
+                space.append(cls.space_longitudinal[longitudinal])
 
             vertical = (location >> FanConstants.FanType_Location_Space_VerticalShift) & FanConstants.FanType_Location_Space_VerticalMask
             if vertical != 0:
-                space.append(self.space_vertical[vertical])
+                space.append(cls.space_vertical[vertical])
 
             sequence_name = ''
             if sequence:
@@ -146,7 +564,7 @@ class FanDescriptor(object):
             return "{}{}".format(device_name, sequence_name)
 
         elif device == FanConstants.FanType_Device_Memory:
-            location_name = self.memory_location.get(location, 'Loc#{}'.format(location))
+            location_name = cls.memory_location.get(location, 'Loc#{}'.format(location))
 
             sequence_name = ''
             if sequence:
@@ -154,7 +572,7 @@ class FanDescriptor(object):
             return "{} {}{}".format(device_name, location_name, sequence_name)
 
         elif device == FanConstants.FanType_Device_External:
-            location_name = self.external_location.get(location, 'Loc#{}'.format(location))
+            location_name = cls.external_location.get(location, 'Loc#{}'.format(location))
 
             sequence_name = ''
             if sequence:
@@ -162,26 +580,123 @@ class FanDescriptor(object):
             return "{} {}{}".format(device_name, location_name, sequence_name)
 
         else:
-            return "&{:08x}".format(self.location_id)
+            return "&{:08x}".format(location_id)
 
     def driver_call(self, reason, rin=None, rout=None):
         if not rin:
             rin = {}
         if not rout:
             rout = []
-        rin[0] = reason
         rin[1] = self.fan_id
         rin[2] = self.location_id
+        return self.execute_driver(reason, rin, rout, (self,))
+
+    def execute_driver(self, reason, rin, rout, fans):
+        """
+        Call our driver, recording the call in the statistics, health and trace.
+
+        @param reason:  driver reason code
+        @param rin:     registers to pass to the driver (R0 and R12 are filled in)
+        @param rout:    registers to return from the driver
+        @param fans:    the fans the call is for (which must all be on our driver)
+        """
+        rin[0] = reason
         rin[12] = self.driver_ws
-        regs = self.ro.execute_with_error(self.driver, preserve=True, rin=rin, rout=rout)
+        if self.health and not self.health.allow():
+            raise DriverUnavailableError(self.ro, FanConstants.ErrorNumber_DriverUnavailable,
+                                         "Driver for fan {} is not responding".format(self.fan_id))
+        if self.driver_stats and self.driver_stats.queue:
+            self.driver_stats.queue.called()
+
+        failed = True
+        errnum = 0
+        clock = Clock.get(self.ro)
+        start = clock.perf_counter()
+        try:
+            regs = self.ro.execute_with_error(self.driver, preserve=True, rin=rin, rout=rout)
+            failed = False
+        except RISCOSError as exc:
+            errnum = exc.errnum
+            raise
+        finally:
+            duration_us = int((clock.perf_counter() - start) * 1000000)
+            for fan in fans:
+                fan.stats.record(reason, duration_us, failed)
+            if self.driver_stats:
+                self.driver_stats.record(reason, duration_us, failed)
+                if self.driver_stats.check_slow():
+                    self.notify_driver_state()
+            if self.health and self.health.result(failed, duration_us / 1000000.0):
+                # The driver has started failing, or has recovered.
+                self.notify_driver_state()
+            if self.trace:
+                self.trace.record(TraceBuffer.Kind_Driver, reason, self.fan_id,
+                                  reason, rin.get(1, 0), rin.get(2, 0), rin.get(3, 0),
+                                  duration_us, failed, errnum, clock.perf_counter_ns())
         return regs
 
+    def driver_state(self):
+        """
+        @return: the negative state to report for the fans on our driver while it is not working
+                 properly, or None if it is working
+        """
+        if self.health and not self.health.healthy:
+            # The circuit breaker is open, so the driver is not responding
+            return FanConstants.FanState_Failed
+        if self.driver_stats and self.driver_stats.slow:
+            return FanConstants.FanState_Disconnected
+        return None
+
+    def notify_driver_state(self):
+        """
+        Notify clients that the state of all the fans on our driver has changed.
+
+        A speed (>= 0) tells clients that the fan has begun working, so it is only given when
+        the driver has recovered; until then, the fans are given a negative state.
+        """
+        state = self.driver_state()
+        for fan in list(self.driver_stats.fans.values()):
+            speed = state
+            if speed is None:
+                speed = fan.last_speed if fan.last_speed is not None else FanConstants.FanState_OK
+            self.ro.kernel.api.os_servicecall(FanConstants.Service_FanControllerFanChangedState,
+                                              regs={0: fan.fan_id,
+                                                    2: speed})
+
     def get_speed(self):
-        regs = self.driver_call(FanConstants.FanDriver_GetSpeed,
-                                rout=[3])
-        return regs[3]
+        try:
+            regs = self.driver_call(FanConstants.FanDriver_GetSpeed,
+                                    rout=[3])
+        except DriverUnavailableError:
+            if self.last_speed is None:
+                raise
+            # Serve the last speed we knew about, rather than fail.
+            self.stale = True
+            return self.last_speed
+
+        self.stale = False
+        self.preloaded = False
+        self.last_speed = signed_word(regs[3])
+        return self.last_speed
+
+    @property
+    def profile(self):
+        """
+        Key for the capabilities which determine whether a speed or control mode is valid.
+        """
+        return (self.capabilities, self.maximum, self.accuracy, tuple(self.speeds or ()))
 
-    def set_speed(self, speed):
+    def sample_soon(self):
+        """
+        Return to sampling the fan at the fastest rate, because it may be about to change.
+        """
+        self.sample_period = 1
+        self.sample_next = 0
+
+    def check_speed(self, speed):
+        """
+        Check that a speed may be set for this fan, raising an error if not.
+        """
         if not self.capabilities & FanConstants.FanCapability_SupportsManual:
             raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CannotSetSpeed,
                                        "Fan speed cannot be set for fan {}".format(self.fan_id))
@@ -202,10 +717,27 @@ class FanDescriptor(object):
                 raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CannotSetSpeed,
                                            "Fan speed must be set to a supported speed")
 
+    def set_speed(self, speed, checked=False):
+        """
+        Set the speed of the fan.
+
+        @param speed:   speed to set
+        @param checked: True if the speed has already been validated by check_speed
+        """
+        if not checked:
+            self.check_speed(speed)
+
+        # This write is newer than any speed waiting to be written behind
+        self.pending_speed = None
         regs = self.driver_call(FanConstants.FanDriver_SetSpeed,
                                 rin={3: speed},
                                 rout=[3])
-        return regs[3]
+        self.applied_speed = speed
+        self.stale = False
+        self.preloaded = False
+        self.last_speed = signed_word(regs[3])
+        self.sample_soon()
+        return self.last_speed
 
     def get_control(self):
         if not (self.capabilities & (FanConstants.FanCapability_SupportsAutomatic)):
@@ -221,7 +753,10 @@ class FanDescriptor(object):
         self.control_mode = regs[3]
         return self.control_mode
 
-    def set_control(self, control):
+    def check_control(self, control):
+        """
+        Check that a control mode may be selected for this fan, raising an error if not.
+        """
         if control in (FanConstants.FanControl_Manual, FanConstants.FanControl_Managed):
             if not (self.capabilities & (FanConstants.FanCapability_SupportsManual)):
                 raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadControlMode,
@@ -233,22 +768,44 @@ class FanDescriptor(object):
                 raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadControlMode,
                                            "Fan cannot be configured for automatic control")
 
+    def set_control(self, control, checked=False):
+        """
+        Set the control mode of the fan.
+
+        @param control: control mode to select
+        @param checked: True if the mode has already been validated by check_control
+        """
+        if not checked:
+            self.check_control(control)
+
         if self.control_mode == control:
             # It's already in this mode. No need to tell them something they already know.
             return self.control_mode
 
         # If they asked for managed mode, we ask the driver for manual mode, because to it
-        # they're being driven manually and don't care who drives them.
-        request = FanConstants.FanControl_Manual if control == FanConstants.FanControl_Managed else control
+        # they're being driven manually and don't care who drives them. The same is true
+        # of the automatic modes, if the budget is driving them.
+        request = control
+        if control == FanConstants.FanControl_Managed or \
+           (self.budget and self.budget.manages(self, control)):
+            request = FanConstants.FanControl_Manual
         regs = self.driver_call(FanConstants.FanDriver_SetControlMode,
                                 rin={3: request},
                                 rout=[3])
 
         self.control_mode = regs[3]
-        if control == FanConstants.FanControl_Managed and regs[3] == FanConstants.FanControl_Manual:
-            # Make it appear to the outside world like it's managed if that's what we requested.
-            self.control_mode = FanConstants.FanControl_Managed
-
+        if request != control and regs[3] == FanConstants.FanControl_Manual:
+            # Make it appear to the outside world like it's in the mode that was requested.
+            self.control_mode = control
+        # The speed we last set may not be what the fan runs at in its new mode, so the next
+        # speed requested must be written even if it is the same.
+        self.applied_speed = None
+
+        if self.budget:
+            self.budget_managed = self.budget.manages(self, self.control_mode) and \
+                                  regs[3] == FanConstants.FanControl_Manual
+            self.budget.changed(self)
+        self.sample_soon()
         return self.control_mode
 
     def set_location(self, new_location_id):
@@ -265,6 +822,8 @@ class FanDescriptor(object):
 
         # If it was changed ok, then we just set the new location
         self.location_id = new_location_id
+        if self.budget:
+            self.budget.changed(self)
 
 
 class TaskPollWord(object):
@@ -302,13 +861,31 @@ class Fans(object):
     Management for the registered fans.
     """
 
-    def __init__(self, ro):
+    def __init__(self, ro, health_config, slow_driver_threshold=0, queue_config=None):
         self.ro = ro
         self.next_fan_id = 1
-        # Our fans, keyed by their fan_id
+        # Our fans, keyed by their fan_id. The lock is held whilst the fans, the generation
+        # and the count of fans are changed, so that snapshots can be made on any thread.
+        self.lock = threading.Lock()
         self.fans = {}
+        self.generation = 0
+        self.count = 0
+        # The last snapshot of the registry that was made
+        self.made = FanSnapshot(self.generation, self.fans)
         # Pollwords, keyed by their address
         self.pollwords = {}
+        # Driver statistics, keyed by the (driver, driver_ws) tuple
+        self.drivers = {}
+        self.slow_driver_threshold = slow_driver_threshold
+        # Parameters for the DriverHealth of each driver, which include its clock
+        self.health_config = health_config
+        # Parameters for the DriverQueue of each driver, or None if the drivers are not queued
+        self.queue_config = queue_config
+        # Trace buffer shared with the fans, or None if not tracing
+        self.trace = None
+        # Fans which are not healthy, keyed by their fan_id, and their fan_ids in order
+        self.unhealthy = {}
+        self.unhealthy_ids = []
 
     def __repr__(self):
         return "<{}({} fans, {} pollwords)>".format(self.__class__.__name__,
@@ -334,8 +911,58 @@ class Fans(object):
         # Deregister all fans / release memory
         for fan in self.fans.values():
             fan.destroy()
-        self.fans = {}
+        for driver_stats in self.drivers.values():
+            if driver_stats.batch:
+                driver_stats.batch.free()
+        with self.lock:
+            self.fans = {}
+            self.publish_locked()
         self.pollwords = {}
+        self.drivers = {}
+        self.unhealthy = {}
+        self.unhealthy_ids = []
+
+    def set_trace(self, trace):
+        """
+        Change the trace buffer used by the fans.
+
+        @param trace:   TraceBuffer to record into, or None to stop tracing
+        """
+        self.trace = trace
+        for fan in self.fans.values():
+            fan.trace = trace
+
+    def publish(self):
+        """
+        Publish a new generation of the registry, after the fans' descriptions have changed.
+        """
+        with self.lock:
+            self.publish_locked()
+
+    def publish_locked(self):
+        """
+        Publish a new generation of the registry, with the lock held.
+        """
+        self.generation += 1
+        self.count = len(self.fans)
+
+    @property
+    def snapshot(self):
+        """
+        Snapshot of the registry's current generation, which may be read from any thread.
+
+        The snapshot is made when it is first read, so a burst of registrations makes one
+        snapshot rather than one for each fan.
+        """
+        snapshot = self.made
+        if snapshot.generation != self.generation:
+            with self.lock:
+                snapshot = self.made
+                if snapshot.generation != self.generation:
+                    snapshot = FanSnapshot(self.generation, self.fans, self.count)
+                    # Assignment of the attribute is atomic, so readers see either the old or new snapshot
+                    self.made = snapshot
+        return snapshot
 
     def new_fanid(self):
         fan_id = self.next_fan_id
@@ -345,7 +972,24 @@ class Fans(object):
     def register(self, descriptor):
         fan_id = self.new_fanid()
         descriptor.fan_id = fan_id
-        self.fans[fan_id] = descriptor
+        key = (descriptor.driver, descriptor.driver_ws)
+        driver_stats = self.drivers.get(key, None)
+        if not driver_stats:
+            driver_stats = DriverStats(descriptor.driver, descriptor.driver_ws,
+                                       slow_threshold=self.slow_driver_threshold)
+            driver_stats.health = DriverHealth(**self.health_config)
+            driver_stats.batch = None
+            driver_stats.queue = DriverQueue(**self.queue_config) if self.queue_config else None
+            self.drivers[key] = driver_stats
+        if descriptor.capabilities & FanConstants.FanCapability_MultipleFans and not driver_stats.batch:
+            driver_stats.batch = DriverBatch(RMAAccount.get(self.ro, 'FanController'))
+        driver_stats.fans[fan_id] = descriptor
+        descriptor.driver_stats = driver_stats
+        descriptor.health = driver_stats.health
+        descriptor.trace = self.trace
+        with self.lock:
+            self.fans[fan_id] = descriptor
+            self.publish_locked()
         # Issue service to say the fan has arrived
         self.ro.kernel.api.os_servicecall(FanConstants.Service_FanControllerFanChanged,
                                           regs={0: fan_id,
@@ -355,14 +999,166 @@ class Fans(object):
 
     def deregister(self, fan_id):
         fan = self.find_fan(fan_id)
-        del self.fans[fan_id]
+        with self.lock:
+            del self.fans[fan_id]
+            self.publish_locked()
+        if self.unhealthy.pop(fan_id, None):
+            del self.unhealthy_ids[bisect.bisect_left(self.unhealthy_ids, fan_id)]
         fan.destroy()
+        driver_stats = fan.driver_stats
+        del driver_stats.fans[fan_id]
+        if driver_stats.queue:
+            driver_stats.queue.discard(fan)
+        if not driver_stats.fans:
+            # The driver has no more fans, so it's gone away
+            del self.drivers[(driver_stats.driver, driver_stats.driver_ws)]
+            if driver_stats.batch:
+                driver_stats.batch.free()
         # Issue service to say the fan has been removed
         self.ro.kernel.api.os_servicecall(FanConstants.Service_FanControllerFanChanged,
                                           regs={0: fan_id,
                                                 2: FanConstants.Service_FanControllerFanChanged_Removed})
         self.notify_registrations()
 
+    def batches(self, fans):
+        """
+        Group fans so that those whose driver accepts multiple fans can be called together.
+
+        @return: list of (DriverBatch or None, list of fans), in the order of the first fan of each
+        """
+        groups = []
+        by_driver = {}
+        for fan in fans:
+            batch = fan.driver_stats.batch if fan.capabilities & FanConstants.FanCapability_MultipleFans else None
+            if not batch:
+                groups.append((None, [fan]))
+                continue
+            group = by_driver.get(batch, None)
+            if group is None:
+                group = (batch, [])
+                by_driver[batch] = group
+                groups.append(group)
+            group[1].append(fan)
+        return groups
+
+    def get_speeds(self, fans):
+        """
+        Read the speeds of a number of fans, with one driver call per driver where possible.
+
+        @return: list of (fan, speed, RISCOSError or None), in the order of the fans given
+        """
+        fans = list(fans)
+        results = []
+        for batch, group in self.batches(fans):
+            if batch and len(group) > 1:
+                try:
+                    speeds = batch.get_speeds(group)
+                except DriverUnavailableError as exc:
+                    # Serve the last speeds we knew about, rather than fail.
+                    for fan in group:
+                        if fan.last_speed is None:
+                            results.append((fan, None, exc))
+                        else:
+                            fan.stale = True
+                            results.append((fan, fan.last_speed, None))
+                    continue
+                except RISCOSError as exc:
+                    results.extend((fan, None, exc) for fan in group)
+                    continue
+                for fan, speed in zip(group, speeds):
+                    fan.stale = False
+                    fan.preloaded = False
+                    fan.last_speed = speed
+                    results.append((fan, speed, None))
+            else:
+                for fan in group:
+                    try:
+                        results.append((fan, fan.get_speed(), None))
+                    except RISCOSError as exc:
+                        results.append((fan, None, exc))
+        return self.in_order(fans, results)
+
+    def set_speeds(self, fans, speed):
+        """
+        Set the speeds of a number of fans, which have already been checked.
+
+        @return: list of (fan, speed, RISCOSError or None), in the order of the fans given
+        """
+        fans = list(fans)
+        results = []
+        for batch, group in self.batches(fans):
+            if batch and len(group) > 1:
+                for fan in group:
+                    # This write is newer than any speed waiting to be written behind
+                    fan.pending_speed = None
+                try:
+                    speeds = batch.set_speeds(group, [speed] * len(group))
+                except RISCOSError as exc:
+                    results.extend((fan, None, exc) for fan in group)
+                    continue
+                for fan, new_speed in zip(group, speeds):
+                    fan.applied_speed = speed
+                    fan.stale = False
+                    fan.preloaded = False
+                    fan.last_speed = new_speed
+                    fan.sample_soon()
+                    results.append((fan, new_speed, None))
+            else:
+                for fan in group:
+                    try:
+                        results.append((fan, fan.set_speed(speed, checked=True), None))
+                    except RISCOSError as exc:
+                        results.append((fan, None, exc))
+        return self.in_order(fans, results)
+
+    @staticmethod
+    def by_driver(fans):
+        """
+        Group fans by their driver.
+
+        @return: list of (DriverStats, list of fans), in the order of the first fan of each
+        """
+        groups = {}
+        for fan in fans:
+            groups.setdefault(fan.driver_stats, []).append(fan)
+        return list(groups.items())
+
+    @staticmethod
+    def in_order(fans, results):
+        by_fan = dict((result[0].fan_id, result) for result in results)
+        return [by_fan[fan.fan_id] for fan in fans]
+
+    def update_state(self, fan, speed):
+        """
+        Update the recorded health of a fan, from a speed (or negative state) it reported.
+
+        @return: True if the fan's health changed, False if it did not
+        """
+        speed = signed_word(speed)
+        state = speed if speed < 0 else FanConstants.FanState_OK
+        fan.state = state
+        healthy = state == FanConstants.FanState_OK and not fan.anomaly and \
+                  (not fan.health or fan.health.healthy)
+        was_healthy = fan.fan_id not in self.unhealthy
+        if healthy == was_healthy:
+            return False
+        if healthy:
+            del self.unhealthy[fan.fan_id]
+            del self.unhealthy_ids[bisect.bisect_left(self.unhealthy_ids, fan.fan_id)]
+        else:
+            self.unhealthy[fan.fan_id] = fan
+            bisect.insort(self.unhealthy_ids, fan.fan_id)
+        return True
+
+    def iter_unhealthy(self, after=0):
+        """
+        Iterate over the fans which are not healthy, in fan_id order.
+
+        @param after:   fan_id to start after, or 0 to start from the first
+        """
+        for index in range(bisect.bisect_right(self.unhealthy_ids, after), len(self.unhealthy_ids)):
+            yield self.unhealthy[self.unhealthy_ids[index]]
+
     def find_fan(self, fan_id):
         fan = self.fans.get(fan_id, None)
         if not fan:
@@ -380,8 +1176,7 @@ class Fans(object):
             del self.pollwords[address]
 
     def __iter__(self):
-        for fan_id, fan in sorted(self.fans.items()):
-            yield fan
+        return iter(self.snapshot.fans)
 
     def __len__(self):
         return len(self.fans)
@@ -390,6 +1185,60 @@ class Fans(object):
         return self.find_fan(index)
 
 
+class TelemetryListener(object):
+    """
+    Passes the fan samples on to the telemetry store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # The location each fan was described to the store with, keyed by fan_id
+        self.described = {}
+
+    def __repr__(self):
+        return "<{}({!r})>".format(self.__class__.__name__, self.store)
+
+    def sample(self, fan, timestamp, speed):
+        if fan.stale:
+            # We didn't get a real sample, so don't record it.
+            return
+        timestamp_ms = int(timestamp * 1000)
+        if self.described.get(fan.fan_id, None) != fan.location_id:
+            self.described[fan.fan_id] = fan.location_id
+            self.store.describe(fan.fan_id, fan.location_id, fan.capabilities, fan.accuracy, fan.maximum,
+                                fan.speeds, timestamp_ms)
+        self.store.sample(fan.fan_id, timestamp_ms, signed_word(speed))
+
+    def forget(self, fan_id):
+        """
+        Stop recording a fan which has gone away.
+        """
+        if self.described.pop(fan_id, None) is not None:
+            self.store.forget(fan_id)
+
+
+class TelemetryServerListener(object):
+    """
+    Passes the fan samples on to the telemetry server.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def __repr__(self):
+        return "<{}({!r})>".format(self.__class__.__name__, self.server)
+
+    def sample(self, fan, timestamp, speed):
+        if fan.stale:
+            return
+        self.server.publish(FanEvent(FanEvent.Kind_Sample, fan.fan_id, fan.location_id,
+                                     signed_word(speed), int(timestamp * 1000)))
+
+
+# The running FanController for each RISC OS instance
+_running = weakref.WeakKeyDictionary()
+
+
 class FanController(PyModule):
     version = '0.02'
     date = '01 May 2020'
@@ -402,13 +1251,13 @@ class FanController(PyModule):
             "Speed",
             "Configure",
             "TaskPollWord",
-            "6",
-            "7",
-            "8",
-            "9",
-            "10",
-            "11",
-            "12",
+            "DriverStats",
+            "EnumerateUnhealthy",
+            "Group",
+            "StatusTable",
+            "Calibrate",
+            "Lease",
+            "Stats",
             "13",
             "14",
             "15",
@@ -418,6 +1267,18 @@ class FanController(PyModule):
 
     entrypoint_names = [
             'init_callback_handler',
+            'sample_ticker_handler',
+            'sample_callback_handler',
+            'write_callback_handler',
+            'restore_callback_handler',
+            'calibrate_ticker_handler',
+            'calibrate_callback_handler',
+            'budget_ticker_handler',
+            'budget_callback_handler',
+            'lease_ticker_handler',
+            'lease_callback_handler',
+            'queue_ticker_handler',
+            'queue_callback_handler',
         ]
 
     commands = [
@@ -427,9 +1288,51 @@ class FanController(PyModule):
              'Syntax: *Fans'),
 
             ('FanSpeed',
-             "Displays or sets the speed of a fan.",
+             "Displays or sets the speed of a fan, or sets the speed of a group of fans.",
              0x00020001,
-             'Syntax: *FanSpeed <Fan> [<Speed>]')
+             'Syntax: *FanSpeed <Fan>|<Group> [<Speed>]'),
+
+            ('FanGroup',
+             "Defines, removes or lists the groups of fans.",
+             0x00ff0000,
+             'Syntax: *FanGroup [<Group> [-fans <Fan>,<Fan>...] [-location <location> [-mask <mask>]] [-remove]]'),
+
+            ('FanWatch',
+             "Displays the fans, updating the display as their speeds change until Escape is pressed. "
+             "If the fans do not fit in the window, Space shows the next page of them.",
+             0x00010000,
+             'Syntax: *FanWatch [<Interval>]'),
+
+            ('FanCalibrate',
+             "Measures the RPM of fans at each of the speeds they can be set to.",
+             0x00ff0000,
+             'Syntax: *FanCalibrate [<Fan>|<Group>] [-settle <time>] [-concurrency <fans>]'),
+
+            ('FanStats',
+             "Displays percentiles of the sampled fan speeds, for fans, groups or locations.",
+             0x00ff0000,
+             'Syntax: *FanStats [<Fan>|<Group>] [-by <fields>] [-windows <count>]'),
+
+            ('FanSimulate',
+             "Runs the virtual clock on, performing the work due in the simulated time.",
+             0x00010001,
+             'Syntax: *FanSimulate <seconds>'),
+
+            ('FanChurn',
+             "Stress tests the registration and enumeration of fans, checking for leaks.",
+             0x00050000,
+             'Syntax: *FanChurn [<Driver module> [<Reloads> [<Operations>]]] [-readers <threads>]'),
+
+            ('FanDriverStats',
+             "Displays the statistics for calls to the fan drivers.",
+             0x00010000,
+             'Syntax: *FanDriverStats [<Fan>]'),
+
+            ('FanTrace',
+             "Controls and displays the trace of FanController operations.",
+             0x00ff0000,
+             'Syntax: *FanTrace [-on|-off] [-clear] [-swi] [-driver] [-service] [-errors] '
+             '[-fan <Fan>] [-export <filename>]'),
         ]
 
     api_version = 101
@@ -443,12 +1346,115 @@ class FanController(PyModule):
                 3: self.swi_speed,
                 4: self.swi_configure,
                 5: self.swi_taskpollword,
+                6: self.swi_driverstats,
+                7: self.swi_enumerateunhealthy,
+                8: self.swi_group,
+                9: self.swi_statustable,
+                10: self.swi_calibrate,
+                11: self.swi_lease,
+                12: self.swi_stats,
 
                 16: self.swi_register,
                 17: self.swi_deregister,
             }
 
-        self.fans = Fans(ro)
+        if self.ro.config['fancontroller.clock'] == 'virtual':
+            Clock.install(ro, VirtualClock(seed=self.ro.config['fancontroller.clock_seed']))
+        # Tickers running on the virtual clock, keyed by their name
+        self.virtual_tickers = {}
+
+        health_config = {
+                'clock': self.clock.monotonic,
+                'max_errors': self.ro.config['fancontroller.breaker_errors'],
+                'backoff': self.ro.config['fancontroller.breaker_backoff'] / 1000.0,
+                'backoff_max': self.ro.config['fancontroller.breaker_backoff_max'] / 1000.0,
+                'timeout': self.ro.config['fancontroller.breaker_timeout'] / 1000.0,
+            }
+        queue_config = None
+        if self.ro.config['fancontroller.queue_calls']:
+            queue_config = {
+                    'calls_per_tick': self.ro.config['fancontroller.queue_calls'],
+                    'tick_time': self.ro.config['fancontroller.queue_interval'] / 100.0,
+                    'clock': self.clock.monotonic,
+                }
+        self.fans = Fans(ro,
+                         slow_driver_threshold=self.ro.config['fancontroller.slow_driver_threshold'],
+                         health_config=health_config,
+                         queue_config=queue_config)
+        # Whether the driver queues have requests waiting, so their ticker is running
+        self.queue_ticking = False
+        self.queue_pending = False
+        self.groups = FanGroups(ro)
+
+        # Trace buffer, or None if we're not tracing
+        self.trace = None
+
+        # Sampling of the fan speeds
+        self.sample_interval = self.ro.config['fancontroller.sample_interval']
+        self.sample_pending = False
+        self.sampling = AdaptiveSampling(max_period=self.ro.config['fancontroller.sample_backoff_max'])
+        # Detection of abnormal speeds in the samples, or None if disabled
+        self.anomalies = None
+        if self.ro.config['fancontroller.anomaly_window']:
+            self.anomalies = AnomalyDetector(window=self.ro.config['fancontroller.anomaly_window'],
+                                             threshold=self.ro.config['fancontroller.anomaly_threshold'],
+                                             drift=self.ro.config['fancontroller.anomaly_drift'])
+        # Objects to be given each sample, through their sample(fan, timestamp, speed) method
+        self.sample_listeners = []
+        # Distribution of the sampled speeds, or None if not recorded
+        self.sketches = None
+        if self.ro.config['fancontroller.sketch_windows']:
+            self.sketches = FanSketches(window=self.ro.config['fancontroller.sketch_window'],
+                                        windows=self.ro.config['fancontroller.sketch_windows'],
+                                        accuracy=self.ro.config['fancontroller.sketch_accuracy'] / 1000.0)
+            self.sample_listeners.append(self.sketches)
+        self.telemetry = None
+        self.telemetry_listener = None
+        # Server streaming events to host clients, or None if not configured
+        self.server = None
+
+        # Speed changes waiting to be written, or None if we write them immediately
+        self.write_behind = None
+        if self.ro.config['fancontroller.write_behind']:
+            self.write_behind = WriteBehind(deadband=self.ro.config['fancontroller.write_deadband'])
+
+        # Calibration run started by FanController_Calibrate, or None if not running
+        self.calibration = None
+        self.calibration_pending = False
+        # Fans whose leases changed whilst they were being calibrated, keyed by fan_id
+        self.lease_deferred = {}
+        # Result of the last calibration run, whether finished or aborted
+        self.last_calibration = None
+
+        # Allocation of speeds to the fans in the automatic modes, or None if not configured
+        self.budget = None
+        self.budget_pending = False
+        if self.ro.config['fancontroller.budget_noise'] or self.ro.config['fancontroller.budget_power']:
+            self.budget = FanBudget(noise=self.ro.config['fancontroller.budget_noise'],
+                                    power=self.ro.config['fancontroller.budget_power'],
+                                    fan_noise=self.ro.config['fancontroller.budget_fan_noise'],
+                                    fan_power=self.ro.config['fancontroller.budget_fan_power'],
+                                    requirement=self.ro.config['fancontroller.budget_requirement'],
+                                    requirements=self.budget_requirements(),
+                                    time_budget=self.ro.config['fancontroller.budget_time'] / 1000000.0,
+                                    clock=self.clock.perf_counter)
+
+        # Leases on the speeds of managed fans; the ticker only runs while there are leases
+        self.leases = FanLeases(tick_time=self.ro.config['fancontroller.lease_interval'] / 100.0,
+                                clock=self.clock.monotonic)
+        self.lease_ticking = False
+        self.lease_pending = False
+
+        # Status table in a dynamic area, or None if not configured
+        self.status = None
+
+        # Saved state of the fans, or None if we're not saving it
+        self.warm = None
+        state_file = self.ro.config['fancontroller.state_file']
+        if state_file:
+            self.warm = WarmStart(state_file)
+        # Fans with saved settings waiting to be reapplied, and their WarmRecords
+        self.restore_pending = []
 
         self.debug_fancontroller = False
         self.ro.debug_register_ivar('fancontroller', self)
@@ -457,21 +1463,620 @@ class FanController(PyModule):
         super(FanController, self).initialise(arguments, pwp)
         # Must announce our existance on a callback, as SWIs not available during initialise
         self.pwp = pwp
+        _running[self.ro] = self
         self.ro.kernel.api.os_addcallback(self.module.entrypoints['init_callback_handler'].address,
                                           self.pwp)
 
+        if self.warm:
+            self.warm.load()
+
+        telemetry_dir = self.ro.config['fancontroller.telemetry_dir']
+        if telemetry_dir:
+            self.telemetry = TelemetryStore(telemetry_dir)
+            self.telemetry_listener = TelemetryListener(self.telemetry)
+            self.sample_listeners.append(self.telemetry_listener)
+
+        telemetry_socket = self.ro.config['fancontroller.telemetry_socket']
+        if telemetry_socket:
+            self.server = TelemetryServer(self.ro, telemetry_socket,
+                                          queue_length=self.ro.config['fancontroller.telemetry_socket_queue'],
+                                          initial=self.server_initial_events)
+            try:
+                self.server.start()
+            except RISCOSError:
+                self.server = None
+                if self.telemetry:
+                    self.telemetry.close()
+                    self.telemetry = None
+                raise
+            self.sample_listeners.append(TelemetryServerListener(self.server))
+
+        status_table = self.ro.config['fancontroller.status_table']
+        if status_table:
+            self.status = FanStatusTable(self.ro, capacity=status_table)
+            self.status.create(RMAAccount.get(self.ro, 'FanController'))
+            self.status.rebuild(self.fans.snapshot)
+            self.sample_listeners.append(self.status)
+
+        if self.sample_interval:
+            self.start_ticker('sample', self.sample_interval)
+
+        if self.budget:
+            self.start_ticker('budget', self.ro.config['fancontroller.budget_interval'])
+
+    @property
+    def clock(self):
+        return Clock.get(self.ro)
+
+    def start_ticker(self, name, interval):
+        """
+        Start calling the <name>_callback_handler periodically.
+
+        With the host clock, OS_CallEvery calls the <name>_ticker_handler, which sets up
+        the callback. With the virtual clock, the callback handler is called directly at
+        the simulated times.
+
+        @param name:        name of the handlers
+        @param interval:    time between the calls, in centiseconds
+        """
+        if self.clock.virtual:
+            handler = getattr(self, name + '_callback_handler')
+            self.virtual_tickers[name] = self.clock.every(interval / 100.0, lambda: handler(None))
+        else:
+            self.ro.kernel.api.os_callevery(interval - 1,
+                                            self.module.entrypoints[name + '_ticker_handler'].address,
+                                            self.pwp)
+
+    def stop_ticker(self, name):
+        """
+        Stop calling the <name>_callback_handler periodically.
+        """
+        if name in self.virtual_tickers:
+            self.clock.cancel(self.virtual_tickers.pop(name))
+        elif not self.clock.virtual:
+            self.ro.kernel.api.os_removetickerevent(self.module.entrypoints[name + '_ticker_handler'].address,
+                                                    self.pwp)
+
+    def budget_requirements(self):
+        """
+        Read the cooling requirements of the zones for particular devices from the configuration.
+
+        @return: dictionary of the requirement for each device type
+        """
+        names = dict((name.lower(), device) for device, name in FanDescriptor.device_names.items())
+        requirements = {}
+        for item in self.ro.config['fancontroller.budget_requirements'].split(','):
+            if '=' not in item:
+                continue
+            (device, requirement) = item.split('=', 1)
+            device = device.strip().lower()
+            device = names[device] if device in names else int(device)
+            requirements[device] = int(requirement)
+        return requirements
+
+    def server_initial_events(self):
+        """
+        Describe the registered fans to a new client of the telemetry server.
+
+        Called on the server thread, so only the published snapshot is used.
+        """
+        return [FanEvent(FanEvent.Kind_Added, record.fan_id, record.location_id, record.capabilities)
+                for record in self.fans.snapshot]
+
     def init_callback_handler(self, regs):
         self.announce_initialise(FanConstants.Service_FanControllerStarted)
 
+    def sample_ticker_handler(self, regs):
+        # Drivers must not be called from the ticker, so we sample on a callback.
+        if not self.sample_pending:
+            self.sample_pending = True
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['sample_callback_handler'].address,
+                                              self.pwp)
+
+    def sample_callback_handler(self, regs):
+        self.sample_pending = False
+        self.sample_fans(self.sampling.due(self.fans))
+
+    def sample_fans(self, fans=None):
+        """
+        Read the speed of the fans, and pass it on to anyone interested in the samples.
+
+        @param fans:    fans to sample, or None to sample every fan
+        """
+        if fans is None:
+            fans = self.fans
+        self.queue_request(DriverQueue.Class_Sampling, self.record_samples, fans, read=True)
+
+    def record_samples(self, fans):
+        """
+        Read the speed of some fans, when their drivers can be called, and record the samples.
+        """
+        timestamp = self.clock.time()
+        for fan, speed, error in self.fans.get_speeds(fans):
+            if error:
+                # The failure has already been recorded in the driver statistics
+                self.sampling.failed(fan)
+                continue
+            self.sampling.sampled(fan, timestamp, signed_word(speed))
+            fan.last_sample_time = timestamp
+            if self.anomalies:
+                fan.anomaly = self.anomalies.sample(fan, signed_word(speed))
+            if self.fans.update_state(fan, speed):
+                self.fans.notify_errors()
+            for listener in self.sample_listeners:
+                listener.sample(fan, timestamp, speed)
+
+    def write_callback_handler(self, regs):
+        self.queue_request(DriverQueue.Class_Control, self.write_behind.write, self.write_behind.take())
+
+    def queue_ticker_handler(self, regs):
+        # Drivers must not be called from the ticker, so we run the queues on a callback.
+        if not self.queue_pending:
+            self.queue_pending = True
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['queue_callback_handler'].address,
+                                              self.pwp)
+
+    def queue_callback_handler(self, regs):
+        self.queue_pending = False
+        waiting = False
+        for driver_stats in list(self.fans.drivers.values()):
+            if driver_stats.queue and driver_stats.queue.run():
+                waiting = True
+        if not waiting:
+            self.stop_queue()
+
+    def start_queue(self):
+        if not self.queue_ticking:
+            self.queue_ticking = True
+            self.start_ticker('queue', self.ro.config['fancontroller.queue_interval'])
+
+    def stop_queue(self):
+        if self.queue_ticking:
+            self.queue_ticking = False
+            self.stop_ticker('queue')
+        if self.queue_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['queue_callback_handler'].address,
+                                                 self.pwp)
+            self.queue_pending = False
+
+    def queue_request(self, request_class, operation, fans, read=False):
+        """
+        Make a request of the drivers of some fans, now if they can be called, or when they are free.
+
+        @param request_class:   DriverQueue priority class of the request
+        @param operation:       function to call with a list of the fans on one driver
+        @param fans:            the fans the request is for
+        @param read:            True if the request only reads the fans, so may be merged
+        """
+        for driver_stats, group in self.fans.by_driver(fans):
+            queue = driver_stats.queue
+            if not queue:
+                operation(group)
+            elif not queue.submit(request_class, operation, group, read=read) and len(queue):
+                self.start_queue()
+
+    def read_speeds(self, fans):
+        """
+        Read the speeds of fans for a user.
+
+        Fans whose drivers have no calls to spare are given their last known speed, marked
+        as stale, and are read again when their driver is free. Fans whose speed was preloaded
+        from the saved state are given that speed until they have been sampled.
+
+        @return: list of (fan, speed, RISCOSError or None), in the order of the fans given
+        """
+        fans = list(fans)
+        results = [(fan, fan.last_speed, None) for fan in fans if fan.preloaded]
+        for driver_stats, group in self.fans.by_driver(fan for fan in fans if not fan.preloaded):
+            queue = driver_stats.queue
+            if queue and not queue.can_call(DriverQueue.Class_Interactive):
+                known = [fan for fan in group if fan.last_speed is not None]
+                for fan in known:
+                    fan.stale = True
+                    results.append((fan, fan.last_speed, None))
+                if known:
+                    self.queue_request(DriverQueue.Class_Interactive, self.fans.get_speeds, known, read=True)
+                # Fans we know nothing about must be read, even though the driver is busy
+                group = [fan for fan in group if fan.last_speed is None]
+            results.extend(self.fans.get_speeds(group))
+        return self.fans.in_order(fans, results)
+
+    def warm_start(self, fan):
+        """
+        Preload a newly registered fan from its saved state.
+        """
+        self.warm.registered(fan)
+        record = self.warm.get(fan)
+        if not record:
+            return
+        if record.control != FanConstants.FanControl_Invalid and \
+           fan.capabilities & FanConstants.FanCapability_SupportsAutomatic:
+            fan.control_mode = record.control
+        if record.speed is not None:
+            fan.last_speed = record.speed
+            fan.stale = True
+            # The sampling will read the driver for us, so until then the saved speed is served
+            # without calling it. Without sampling, nothing would ever replace the saved speed.
+            fan.preloaded = bool(self.sample_interval)
+
+        if self.ro.config['fancontroller.state_restore']:
+            if not self.restore_pending:
+                self.ro.kernel.api.os_addcallback(self.module.entrypoints['restore_callback_handler'].address,
+                                                  self.pwp)
+            self.restore_pending.append((fan, record))
+
+    def restore_callback_handler(self, regs):
+        pending = self.restore_pending
+        self.restore_pending = []
+        moved = False
+        for fan, record in pending:
+            if self.fans.fans.get(fan.fan_id, None) is not fan or fan.calibrating:
+                # Deregistered before we got to it, or being calibrated, which puts it back itself
+                continue
+            # A setting which can no longer be applied is recorded in the driver statistics,
+            # and should not stop the others being restored.
+            try:
+                if record.location_id != fan.location_id and \
+                   fan.capabilities & FanConstants.FanCapability_SupportsMove:
+                    fan.set_location(record.location_id)
+                    moved = True
+                if record.control != FanConstants.FanControl_Invalid:
+                    # The preloaded mode may not be the driver's, so it must be set
+                    fan.control_mode = FanConstants.FanControl_Invalid
+                    fan.set_control(record.control)
+                if record.applied_speed is not None and \
+                   record.control in (FanConstants.FanControl_Manual, FanConstants.FanControl_Managed):
+                    fan.set_speed(record.applied_speed)
+            except RISCOSError:
+                pass
+        if moved:
+            self.fans.publish()
+
+    def budget_ticker_handler(self, regs):
+        # Drivers must not be called from the ticker, so we allocate on a callback.
+        if not self.budget_pending:
+            self.budget_pending = True
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['budget_callback_handler'].address,
+                                              self.pwp)
+
+    def budget_callback_handler(self, regs):
+        self.budget_pending = False
+        self.apply_budget()
+
+    def apply_budget(self):
+        """
+        Set the speeds of the fans in the automatic modes, as allocated by the budget.
+        """
+        by_speed = {}
+        for fan, speed in self.budget.solve():
+            if fan.calibrating:
+                # Allocated again once the calibration has finished
+                continue
+            by_speed.setdefault(speed, []).append(fan)
+        for speed, fans in by_speed.items():
+            self.queue_request(DriverQueue.Class_Control,
+                               lambda group, speed=speed: self.set_budget_speeds(group, speed), fans)
+
+    def set_budget_speeds(self, fans, speed):
+        """
+        Set fans to the speed allocated by the budget, allocating them again on the next
+        solve if they could not be set. The failures are recorded in the driver statistics.
+        """
+        for fan, _, exc in self.fans.set_speeds(fans, speed):
+            if exc:
+                self.budget.failed(fan)
+
+    def lease_ticker_handler(self, regs):
+        self.queue_lease_callback()
+
+    def queue_lease_callback(self):
+        # Drivers must not be called from the ticker, so we expire leases on a callback.
+        if not self.lease_pending:
+            self.lease_pending = True
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['lease_callback_handler'].address,
+                                              self.pwp)
+
+    def lease_callback_handler(self, regs):
+        self.lease_pending = False
+        self.leases.advance()
+        for fan in self.leases.take_expired():
+            if self.fans.fans.get(fan.fan_id, None) is not fan:
+                continue
+            # Returning a fan to a safe speed when its leases have all gone is more important
+            # than following the leases which remain.
+            request_class = DriverQueue.Class_Control if self.leases.winner(fan.fan_id) \
+                                else DriverQueue.Class_Safety
+            self.queue_request(request_class, self.apply_expired_leases, [fan])
+        if not self.leases:
+            self.stop_leases()
+
+    def start_leases(self):
+        if not self.lease_ticking:
+            self.lease_ticking = True
+            self.start_ticker('lease', self.ro.config['fancontroller.lease_interval'])
+
+    def stop_leases(self):
+        if self.lease_ticking:
+            self.lease_ticking = False
+            self.stop_ticker('lease')
+        if self.lease_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['lease_callback_handler'].address,
+                                                 self.pwp)
+            self.lease_pending = False
+
+    def apply_expired_leases(self, fans):
+        for fan in fans:
+            # Nobody is waiting on the result, so failures are only recorded in the driver statistics
+            try:
+                self.apply_lease(fan)
+            except RISCOSError:
+                pass
+
+    def apply_lease(self, fan):
+        """
+        Set a fan to the speed of its winning lease, or release it if it has none.
+
+        A fan which is being calibrated is dealt with once it has been put back.
+        """
+        if fan.calibrating:
+            self.lease_deferred[fan.fan_id] = fan
+            return
+        lease = self.leases.winner(fan.fan_id)
+        if lease:
+            fan.set_control(FanConstants.FanControl_Managed)
+            if lease.speed not in (fan.applied_speed, fan.pending_speed):
+                self.set_speed(fan, lease.speed)
+
+        elif fan.capabilities & FanConstants.FanCapability_SupportsAutomatic:
+            fan.lease_saved = None
+            fan.set_control(self.ro.config['fancontroller.lease_revert_control'])
+
+        else:
+            fan.lease_saved = None
+            maximum = fan.maximum or 100
+            self.set_speed(fan, snap_speed(fan, maximum * self.ro.config['fancontroller.lease_safe_speed'] / 100.0,
+                                           up=True))
+
+        if self.status:
+            self.status.update(fan)
+
+    def calibrate_ticker_handler(self, regs):
+        # Drivers must not be called from the ticker, so we calibrate on a callback.
+        if not self.calibration_pending:
+            self.calibration_pending = True
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['calibrate_callback_handler'].address,
+                                              self.pwp)
+
+    def calibrate_callback_handler(self, regs):
+        self.calibration_pending = False
+        if self.calibration and self.calibration.step():
+            self.stop_calibration()
+
+    def start_calibration(self, fans, settle=None, concurrency=None):
+        """
+        Create a calibration run for the fans that can be calibrated.
+
+        @param fans:        list of fans to calibrate
+        @param settle:      time to settle, in centiseconds, or None for the configured time
+        @param concurrency: fans per driver to calibrate at once, or None for the configured number
+        """
+        if self.calibration:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CalibrationRunning,
+                                       "Fans are already being calibrated")
+        if settle is None:
+            settle = self.ro.config['fancontroller.calibrate_settle']
+        if concurrency is None:
+            concurrency = self.ro.config['fancontroller.calibrate_concurrency']
+        run = CalibrationRun(self.fans, [fan for fan in fans if FanCalibration.can_calibrate(fan)],
+                             settle=settle / 100.0, concurrency=concurrency, clock=self.clock.monotonic,
+                             finished=self.calibration_finished)
+        self.last_calibration = run
+        return run
+
+    def calibration_finished(self, fan):
+        """
+        Make the changes to a fan which were deferred whilst it was being calibrated.
+        """
+        if self.lease_deferred.pop(fan.fan_id, None):
+            self.queue_request(DriverQueue.Class_Control, self.apply_expired_leases, [fan])
+        if self.budget and fan.budget_managed:
+            self.budget.failed(fan)
+
+    def check_calibrating(self, fan):
+        """
+        Refuse to change a fan which is being calibrated, as it would spoil the readings.
+        """
+        if fan.calibrating:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CalibrationRunning,
+                                       "Fan {} is being calibrated".format(fan.fan_id))
+
+    def stop_calibration(self):
+        """
+        Stop the calibration run started by FanController_Calibrate.
+        """
+        self.stop_ticker('calibrate')
+        if self.calibration_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['calibrate_callback_handler'].address,
+                                                 self.pwp)
+            self.calibration_pending = False
+        if not self.calibration.finished:
+            self.calibration.abort()
+        self.calibration = None
+
+    @staticmethod
+    def fan_speed(fan, speed):
+        """
+        Find the speed to set a fan to, translating speeds in RPM for fans which are set by
+        percentage, if they have been calibrated.
+        """
+        if speed >= 200 and fan.calibration and fan.maximum <= 100:
+            return fan.calibration.speed_for_rpm(speed, fan)
+        return speed
+
+    def set_speed(self, fan, speed, checked=False):
+        """
+        Set the speed of a fan, writing behind if configured.
+
+        Speeds in RPM may be given for fans which are set by percentage, if they have been
+        calibrated.
+
+        @param checked: True if the speed has already been validated
+
+        @return: the speed of the fan
+        """
+        self.check_calibrating(fan)
+        speed = self.fan_speed(fan, speed)
+        if not self.write_behind:
+            return fan.set_speed(speed, checked=checked)
+
+        if self.write_behind.request(fan, speed):
+            self.ro.kernel.api.os_addcallback(self.module.entrypoints['write_callback_handler'].address,
+                                              self.pwp)
+        return speed
+
+    def set_speeds(self, fans, speed):
+        """
+        Set the speeds of a number of fans, which have already been checked, as set_speed
+        would for each, but with one driver call per driver where possible.
+
+        @return: list of (fan, speed, RISCOSError or None), in the order of the fans given
+        """
+        fans = list(fans)
+        results = []
+        if self.write_behind:
+            for fan in fans:
+                try:
+                    results.append((fan, self.set_speed(fan, speed, checked=True), None))
+                except RISCOSError as exc:
+                    results.append((fan, None, exc))
+            return results
+
+        by_speed = {}
+        for fan in fans:
+            try:
+                self.check_calibrating(fan)
+            except RISCOSError as exc:
+                results.append((fan, None, exc))
+                continue
+            by_speed.setdefault(self.fan_speed(fan, speed), []).append(fan)
+        for fan_speed, group in by_speed.items():
+            results.extend(self.fans.set_speeds(group, fan_speed))
+        return self.fans.in_order(fans, results)
+
+    def set_control(self, fan, control, checked=False):
+        """
+        Set the control mode of a fan, keeping the status table up to date.
+
+        @return: the control mode of the fan
+        """
+        self.check_calibrating(fan)
+        control = fan.set_control(control, checked=checked)
+        if self.status:
+            self.status.update(fan)
+        return control
+
+    def set_group_speed(self, group, speed):
+        """
+        Set the speed of the fans in a group, as set_speed would for each fan.
+
+        @return: list of FanGroupResult, one for each fan in the group
+        """
+        return group.apply(self.fans,
+                           lambda fan: fan.check_speed(self.fan_speed(fan, speed)),
+                           lambda fan: self.set_speed(fan, speed, checked=True),
+                           bulk=lambda members: self.set_speeds(members, speed),
+                           # Speeds in RPM are translated by each calibrated fan's own table,
+                           # so fans are checked for the speed that they will actually be set to
+                           profile=lambda fan: (fan.profile, self.fan_speed(fan, speed)),
+                           each=self.check_calibrating)
+
+    def set_group_control(self, group, control):
+        """
+        Set the control mode of the fans in a group, as set_control would for each fan.
+
+        @return: list of FanGroupResult, one for each fan in the group
+        """
+        return group.apply(self.fans,
+                           lambda fan: fan.check_control(control),
+                           lambda fan: self.set_control(fan, control, checked=True),
+                           each=self.check_calibrating)
+
     def finalise(self, pwp):
         # Remove any announcement
         self.ro.kernel.api.os_removecallback(self.module.entrypoints['init_callback_handler'].address,
                                              self.pwp)
 
+        self.stop_queue()
+        for driver_stats in list(self.fans.drivers.values()):
+            if driver_stats.queue:
+                # Make sure that the writes waiting reach the drivers
+                driver_stats.queue.run(limit=False)
+
+        if self.write_behind and self.write_behind.pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['write_callback_handler'].address,
+                                                 self.pwp)
+            # Make sure that the last speeds requested reach the drivers
+            self.write_behind.flush()
+
+        if self.sample_interval:
+            self.stop_ticker('sample')
+        if self.sample_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['sample_callback_handler'].address,
+                                                 self.pwp)
+            self.sample_pending = False
+        if self.telemetry:
+            self.telemetry.close()
+            self.telemetry = None
+            self.telemetry_listener = None
+
+        if self.calibration:
+            self.stop_calibration()
+
+        self.stop_leases()
+
+        if self.budget:
+            self.stop_ticker('budget')
+        if self.budget_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['budget_callback_handler'].address,
+                                                 self.pwp)
+            self.budget_pending = False
+
+        if self.restore_pending:
+            self.ro.kernel.api.os_removecallback(self.module.entrypoints['restore_callback_handler'].address,
+                                                 self.pwp)
+            self.restore_pending = []
+        if self.warm:
+            for fan in self.fans:
+                self.warm.remember(fan)
+            try:
+                self.warm.save()
+            except (IOError, OSError) as exc:
+                if self.debug_fancontroller:
+                    print("FanController: Could not save the fan state: {}".format(exc))
+        if self.server:
+            self.server.stop()
+            self.server = None
+
         # Issue the finalise first so that clients can know to stop calling us.
         self.announce_initialise(FanConstants.Service_FanControllerDying)
         self.fans.shutdown()
 
+        if self.status:
+            self.status.remove()
+            self.status = None
+
+        if _running.get(self.ro, None) is self:
+            del _running[self.ro]
+
+    @staticmethod
+    def running(ro):
+        """
+        Find the FanController running in a RISC OS instance.
+
+        @return: FanController, or None if it is not running
+        """
+        return _running.get(ro, None)
+
     def announce_initialise(self, state):
         """
         Announce the initialisation/finalisation state.
@@ -485,17 +2090,96 @@ class FanController(PyModule):
         self.ro.kernel.api.os_servicecall(state)
 
     def service(self, service, regs):
+        if self.trace:
+            self.trace.record(TraceBuffer.Kind_Service, service, regs[0],
+                              regs[0], regs[1], regs[2], regs[3],
+                              0, False, 0, self.clock.perf_counter_ns())
+
         if service == FanConstants.Service_FanControllerFanChangedState:
             # A driver has notified us of an error state, so we need to update the pollwords
+            fan = self.fans.fans.get(regs[0], None)
+            if fan:
+                self.fans.update_state(fan, regs[2])
+                fan.sample_soon()
+                if self.status:
+                    self.status.update(fan)
             self.fans.notify_errors()
+            if self.server:
+                self.server.publish(FanEvent(FanEvent.Kind_State, regs[0], signed_word(regs[2])))
+
+        elif service == FanConstants.Service_FanControllerFanChanged:
+            if self.status:
+                self.status.rebuild(self.fans.snapshot)
+            if self.server:
+                if regs[2] == FanConstants.Service_FanControllerFanChanged_Added:
+                    fan = self.fans.fans.get(regs[0], None)
+                    if fan:
+                        self.server.publish(FanEvent(FanEvent.Kind_Added, fan.fan_id, fan.location_id,
+                                                     fan.capabilities))
+                else:
+                    self.server.publish(FanEvent(FanEvent.Kind_Removed, regs[0]))
+            if self.anomalies and regs[2] == FanConstants.Service_FanControllerFanChanged_Removed:
+                self.anomalies.forget(regs[0])
+            if self.budget and regs[2] == FanConstants.Service_FanControllerFanChanged_Removed:
+                self.budget.remove(regs[0])
+            if regs[2] == FanConstants.Service_FanControllerFanChanged_Removed:
+                self.leases.forget(regs[0])
+                if self.sketches:
+                    self.sketches.forget(regs[0])
+                if self.telemetry_listener:
+                    self.telemetry_listener.forget(regs[0])
+
+    # Register holding the fan id for each SWI that takes one
+    swi_fan_register = {
+            2: 0,
+            3: 0,
+            4: 0,
+            6: 1,
+            17: 0,
+        }
 
     def swi(self, offset, regs):
+        if self.trace:
+            return self.swi_traced(offset, regs)
+
         func = self.swi_dispatch.get(offset, None)
         if func:
             return func(regs)
 
         return False
 
+    def swi_traced(self, offset, regs):
+        """
+        Dispatch a SWI, recording it in the trace buffer.
+        """
+        func = self.swi_dispatch.get(offset, None)
+        if not func:
+            return False
+
+        r0, r1, r2, r3 = regs[0], regs[1], regs[2], regs[3]
+        fan_reg = self.swi_fan_register.get(offset, None)
+        fan_id = regs[fan_reg] if fan_reg is not None else 0
+        failed = True
+        errnum = 0
+        start = self.clock.perf_counter()
+        try:
+            result = func(regs)
+            failed = False
+            if offset == 16:
+                # Registration returns the fan id allocated
+                fan_id = regs[0]
+        except RISCOSError as exc:
+            errnum = exc.errnum
+            raise
+        finally:
+            duration_us = int((self.clock.perf_counter() - start) * 1000000)
+            # The trace may have been turned off by the SWI
+            if self.trace:
+                self.trace.record(TraceBuffer.Kind_SWI, offset, fan_id,
+                                  r0, r1, r2, r3,
+                                  duration_us, failed, errnum, self.clock.perf_counter_ns())
+        return result
+
     def swi_version(self, regs):
         """
         SWI FanController_Version - Read version of the API
@@ -548,6 +2232,248 @@ class FanController(PyModule):
         regs[0] = -1
         return True
 
+    def swi_enumerateunhealthy(self, regs):
+        """
+        SWI FanController_EnumerateUnhealthy - enumerate the fans which are failing
+
+        =>  R0 = 0 for first call, or value from previous call
+
+        <=  R0 = fan id, or -1 if no more entries
+            R1 = location id
+            R2 = fan capabilty flags
+            R3 = pointer to provider name
+            R4 = fan speed accuracy
+            R5 = maximum speed
+            R6 = pointer to list of supported speeds, or 0 if arbitrary speeds (for the accuracy) may be given
+            R7 = fan state (FanState_OK if the driver is not responding, or its speed is anomalous)
+            R8 = anomaly flags:
+                    bit 0: speed is erratic compared to its recent behaviour
+                    bit 1: speed has drifted from the speed it was set to
+        """
+        for fan in self.fans.iter_unhealthy(after=regs[0]):
+            self._return_faninfo(regs, fan)
+            regs[7] = fan.state
+            regs[8] = fan.anomaly
+            return True
+
+        # No fan found. So we're at the end of the list.
+        regs[0] = -1
+        return True
+
+    def swi_statustable(self, regs):
+        """
+        SWI FanController_StatusTable - Find the status table of the fans
+
+        =>  no parameters
+
+        <=  R0 = pointer to the status table, or 0 if there is no table
+            R1 = dynamic area number of the table, or -1 if there is no table
+
+        The table is read-only to user mode. See fanstatus.py for its layout, and the
+        sequence lock protocol which readers must follow to read consistent records.
+        """
+        if self.status:
+            regs[0] = self.status.base
+            regs[1] = self.status.area
+        else:
+            regs[0] = 0
+            regs[1] = -1
+        return True
+
+    def swi_calibrate(self, regs):
+        """
+        SWI FanController_Calibrate - Calibrate the RPM of fans set by percentage
+
+        =>  R0 = reason code:
+                    0: start calibrating fans
+                        R1 = fan id, or 0 for every fan that can be calibrated
+                        R2 = time in centiseconds to settle at each speed, or 0 for the default
+                        R3 = number of fans on each driver to calibrate at once, or 0 for the default
+                    1: read the progress of the calibration
+                        <= R1 = number of fans still being calibrated
+                           R2 = number of fans calibrated
+                           R3 = number of fans which could not be calibrated
+                    2: read the calibration table of a fan
+                        R1 = fan id
+                        R2 = pointer to buffer for pairs of words (speed, RPM), or 0 to read the size
+                        R3 = size of buffer
+                        <= R3 = number of pairs in the table, or 0 if not calibrated
+                    3: abort the calibration
+
+        Once a fan is calibrated, FanController_Speed may be given a speed in RPM for it,
+        and will select the speed which should give that RPM.
+        """
+        reason = regs[0]
+        if reason == FanConstants.FanController_Calibrate_Start:
+            if regs[1]:
+                fan = self.fans.find_fan(regs[1])
+                if not FanCalibration.can_calibrate(fan):
+                    raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CannotCalibrate,
+                                               "Fan {} cannot be calibrated".format(fan.fan_id))
+                fans = [fan]
+            else:
+                fans = list(self.fans)
+            self.calibration = self.start_calibration(fans, settle=regs[2] or None, concurrency=regs[3] or None)
+            self.start_ticker('calibrate', 10)
+
+        elif reason == FanConstants.FanController_Calibrate_Progress:
+            run = self.last_calibration
+            calibrations = run.calibrations if run else []
+            regs[1] = run.remaining if run else 0
+            regs[2] = sum(1 for calibration in calibrations
+                          if calibration.state == FanCalibration.State_Done)
+            regs[3] = sum(1 for calibration in calibrations
+                          if calibration.state == FanCalibration.State_Failed)
+
+        elif reason == FanConstants.FanController_Calibrate_ReadTable:
+            fan = self.fans.find_fan(regs[1])
+            points = list(fan.calibration) if fan.calibration else []
+            buffer = regs[2]
+            if buffer:
+                npoints = min(len(points), regs[3] // 8)
+                words = []
+                for speed, rpm in points[:npoints]:
+                    words.extend((speed, rpm))
+                if words:
+                    self.ro.memory[buffer].write_words(words)
+            regs[3] = len(points)
+
+        elif reason == FanConstants.FanController_Calibrate_Abort:
+            if self.calibration:
+                self.stop_calibration()
+
+        else:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "FanController_Calibrate reason {} not supported".format(reason))
+        return True
+
+    def swi_lease(self, regs):
+        """
+        SWI FanController_Lease - Request a speed for a managed fan, for a limited time
+
+        =>  R0 = reason code:
+                    0: acquire a lease
+                        R1 = fan id
+                        R2 = speed requested
+                        R3 = time in centiseconds that the lease lasts
+                        R4 = priority of the lease (signed); higher priorities win
+                        <= R1 = lease handle
+                    1: renew a lease
+                        R1 = lease handle
+                        R3 = time in centiseconds that the lease lasts from now
+                    2: release a lease
+                        R1 = lease handle
+                    3: read the winning lease on a fan
+                        R1 = fan id
+                        <= R1 = handle of the winning lease, or 0 if the fan has no leases
+                           R2 = speed of the winning lease
+                           R3 = time in centiseconds until the winning lease expires
+                           R4 = priority of the winning lease
+                           R5 = number of leases on the fan
+
+        The fan is set to FanControl_Managed while it has leases, and runs at the speed of
+        the lease with the highest priority (the most recent, if several have that priority).
+        When its last lease is released or expires, the fan is returned to automatic control,
+        or set to a safe speed if it cannot be controlled automatically.
+        """
+        reason = regs[0]
+        # Bring the leases up to date, so that new expiry times are measured from now. The fans
+        # whose leases expired are dealt with on the callback, as they would be by the ticker.
+        if self.leases.advance():
+            self.queue_lease_callback()
+
+        if reason == FanConstants.FanController_Lease_Acquire:
+            fan = self.fans.find_fan(regs[1])
+            fan.check_control(FanConstants.FanControl_Managed)
+            speed = regs[2]
+            if not (speed >= 200 and fan.calibration and fan.maximum <= 100):
+                fan.check_speed(speed)
+            control = fan.control_mode
+            if fan.lease_saved is None:
+                fan.lease_saved = (control, fan.applied_speed)
+            lease = self.leases.acquire(fan, speed, regs[3] / 100.0, regs.signed[4])
+            try:
+                self.apply_lease(fan)
+            except RISCOSError:
+                self.leases.release(lease)
+                if not self.leases.winner(fan.fan_id):
+                    fan.lease_saved = None
+                    if fan.control_mode != control:
+                        # The fan may have been made Managed before the failure, and must not be
+                        # left that way with nothing to renew it.
+                        try:
+                            fan.set_control(control)
+                        except RISCOSError:
+                            pass
+                raise
+            self.start_leases()
+            regs[1] = lease.handle
+
+        elif reason == FanConstants.FanController_Lease_Read:
+            fan = self.fans.find_fan(regs[1])
+            lease = self.leases.winner(fan.fan_id)
+            regs[1] = lease.handle if lease else 0
+            regs[2] = lease.speed if lease else 0
+            regs[3] = int(round(self.leases.remaining(lease) * 100)) if lease else 0
+            regs[4] = lease.priority & 0xFFFFFFFF if lease else 0
+            regs[5] = len(self.leases.fan_leases.get(fan.fan_id, {}))
+
+        elif reason in (FanConstants.FanController_Lease_Renew, FanConstants.FanController_Lease_Release):
+            lease = self.leases.find(regs[1])
+            if not lease:
+                raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadLease,
+                                           "Lease {} has expired or was not known".format(regs[1]))
+            if reason == FanConstants.FanController_Lease_Renew:
+                self.leases.renew(lease, regs[3] / 100.0)
+            else:
+                self.leases.release(lease)
+                self.apply_lease(lease.fan)
+
+        else:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "FanController_Lease reason {} not supported".format(reason))
+        return True
+
+    def swi_stats(self, regs):
+        """
+        SWI FanController_Stats - Read a percentile of the sampled fan speeds
+
+        =>  R0 = flags:
+                    bit 0: R1 is a fan id, rather than a location
+            R1 = fan id, or location id to match
+            R2 = mask of the location id bits to match, if R1 is a location (0 for all fans)
+            R3 = percentile, in tenths of a percent (eg 990 for the 99th percentile)
+            R4 = number of windows to include, counting back from the current one, or 0 for all
+        <=  R3 = speed, as a percentage, at the percentile, or -1 if none were sampled
+            R4 = speed, in RPM, at the percentile, or -1 if none were sampled
+            R5 = number of samples included
+        """
+        if not self.sketches:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "Speed distributions are not being recorded")
+        sketch = self._stats_sketch(regs[0] & FanConstants.FanController_Stats_Fan, regs[1], regs[2], regs[4])
+        quantile = min(regs[3], 1000) / 1000.0
+        percent = sketch.percent.quantile(quantile) if sketch.percent else None
+        rpm = sketch.rpm.quantile(quantile) if sketch.rpm else None
+        regs[3] = -1 if percent is None else int(round(percent))
+        regs[4] = -1 if rpm is None else int(round(rpm))
+        regs[5] = (len(sketch.percent) if sketch.percent else 0) + (len(sketch.rpm) if sketch.rpm else 0)
+        return True
+
+    def _stats_sketch(self, is_fan, value, mask, windows):
+        """
+        Merge the speed sketches for a fan, or for the fans at a location.
+        """
+        now = self.clock.time()
+        if is_fan:
+            fan = self.fans.find_fan(value)
+            return self.sketches.fan_sketch([fan.fan_id], now, windows)
+        if mask & FanSketches.Field_Sequence:
+            # The zones do not distinguish fans by sequence, so we need the fans themselves
+            fan_ids = [fan.fan_id for fan in self.fans if fan.location_id & mask == value & mask]
+            return self.sketches.fan_sketch(fan_ids, now, windows)
+        return self.sketches.location_sketch(value, mask, now, windows)
+
     def swi_info(self, regs):
         """
         SWI FanController_Info - Information about a specific fan
@@ -580,9 +2506,11 @@ class FanController(PyModule):
         fan = self.fans.find_fan(fan_id)
 
         if new_speed == -1:
-            speed = fan.get_speed()
+            (fan, speed, error) = self.read_speeds([fan])[0]
+            if error:
+                raise error
         else:
-            speed = fan.set_speed(new_speed)
+            speed = self.set_speed(fan, new_speed)
 
         regs[1] = speed
         return True
@@ -609,11 +2537,14 @@ class FanController(PyModule):
             if param == -1:
                 result = fan.get_control()
             else:
-                result = fan.set_control(param)
+                result = self.set_control(fan, param)
 
         elif config == FanConstants.FanController_Configure_Location:
             param = regs[2]
             fan.set_location(param)
+            self.fans.publish()
+            if self.status:
+                self.status.rebuild(self.fans.snapshot)
             result = param
 
         else:
@@ -644,6 +2575,116 @@ class FanController(PyModule):
             self.fans.add_pollword(pollword, bit_dying, bit_registrations, bit_errors)
         return True
 
+    def swi_driverstats(self, regs):
+        """
+        SWI FanController_DriverStats - Read the statistics for calls to a fan's driver
+
+        =>  R0 = flags:
+                    bit 0: return statistics for all the fans on the driver, rather than just this fan
+                    bit 1: reset the statistics after reading
+            R1 = fan id
+            R2 = pointer to buffer to fill, or 0 to read the size required
+            R3 = size of buffer
+        <=  R3 = size of the statistics block (which may be larger than the buffer)
+
+        The statistics block is a sequence of words:
+            +0      number of reason counts (n)
+            +4      n words of call counts, indexed by driver reason
+            ...     count of calls with unrecognised reasons
+            ...     count of errors
+            ...     number of latency buckets (m)
+            ...     m words of counts of calls whose latency was under 2^i microseconds
+        """
+        flags = regs[0]
+        fan = self.fans.find_fan(regs[1])
+        buffer = regs[2]
+        size = regs[3]
+
+        if flags & FanConstants.FanController_DriverStats_Driver:
+            stats = fan.driver_stats
+        else:
+            stats = fan.stats
+        words = stats.words()
+        if buffer:
+            nwords = min(len(words), size // 4)
+            self.ro.memory[buffer].write_words(words[:nwords])
+        if flags & FanConstants.FanController_DriverStats_Reset:
+            stats.reset()
+
+        regs[3] = len(words) * 4
+        return True
+
+    def swi_group(self, regs):
+        """
+        SWI FanController_Group - Manage and control groups of fans
+
+        =>  R0 = reason code:
+                    0: define a group
+                        R1 = pointer to group name
+                        R2 = pointer to list of fan ids terminated by -1, or 0 to select by location
+                        R3 = mask to apply to the location id of each fan
+                        R4 = value the masked location id must have to be in the group
+                    1: remove a group
+                        R1 = pointer to group name
+                    2: set the speed of the fans in a group
+                        R1 = pointer to group name
+                        R2 = speed
+                        R3 = pointer to buffer for results, or 0 for no results
+                        R4 = size of buffer
+                    3: set the control mode of the fans in a group
+                        R1 = pointer to group name
+                        R2 = control mode
+                        R3 = pointer to buffer for results, or 0 for no results
+                        R4 = size of buffer
+        <=  for reasons 2 and 3:
+            R0 = number of fans in the group
+            R1 = number of fans which could not be changed
+
+        The settings are validated for every fan before any fan is changed. If any fan
+        cannot accept the setting, no fans are changed. The results buffer is filled
+        with a pair of words for each fan in the group: the fan id, and the error number
+        for that fan, or 0 if it was changed.
+        """
+        reason = regs[0]
+        name = self.ro.memory[regs[1]].string
+
+        if reason == FanConstants.FanController_Group_Define:
+            if regs[2]:
+                fan_ids = []
+                fan_ids_mem = self.ro.memory[regs[2]]
+                while fan_ids_mem.signedword != -1:
+                    fan_ids.append(fan_ids_mem.word)
+                    fan_ids_mem.address += 4
+                group = FanGroup(name, fan_ids=fan_ids)
+            else:
+                group = FanGroup(name, location_mask=regs[3], location_value=regs[4])
+            self.groups.define(group)
+
+        elif reason == FanConstants.FanController_Group_Remove:
+            self.groups.remove(name)
+
+        elif reason in (FanConstants.FanController_Group_SetSpeed,
+                        FanConstants.FanController_Group_SetControl):
+            group = self.groups.find_group(name)
+            if reason == FanConstants.FanController_Group_SetSpeed:
+                results = self.set_group_speed(group, regs.signed[2])
+            else:
+                results = self.set_group_control(group, regs.signed[2])
+
+            buffer = regs[3]
+            if buffer:
+                words = []
+                for result in results[:regs[4] // 8]:
+                    words.extend((result.fan.fan_id, result.errnum))
+                self.ro.memory[buffer].write_words(words)
+            regs[0] = len(results)
+            regs[1] = sum(1 for result in results if result.failed)
+
+        else:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "FanController_Group operation {} not supported".format(reason))
+        return True
+
     def swi_register(self, regs):
         """
         SWI FanController_Register - Register a fan driver
@@ -677,7 +2718,10 @@ class FanController(PyModule):
             speeds = None
 
         fan = FanDescriptor(self.ro, location_id, provider, accuracy, maximum, speeds, capabilities, driver, driver_ws)
+        fan.budget = self.budget
         self.fans.register(fan)
+        if self.warm:
+            self.warm_start(fan)
         if self.debug_fancontroller:
             print("Registered fan {!r} with id {}".format(fan, fan.fan_id))
 
@@ -692,6 +2736,13 @@ class FanController(PyModule):
         =>  R0 = fan id to deregister
         """
         fan_id = regs[0]
+        fan = self.fans.find_fan(fan_id)
+        if self.write_behind:
+            self.write_behind.discard(fan)
+        self.lease_deferred.pop(fan_id, None)
+        if self.warm:
+            # Drivers may go before we do, so remember the fan now in case it does not return
+            self.warm.deregistered(fan)
         self.fans.deregister(fan_id)
 
         return True
@@ -717,31 +2768,514 @@ class FanController(PyModule):
         """
         Syntax: *Fans
         """
-        for fan in self.fans:
-            speed = fan.get_speed()
-            speed_str = self._speed_string(speed)
-
-            control = fan.get_control()
-            control_str = fan.control_modes.get(control, "Control {}".format(control))
-
+        for fan, speed, error in self.read_speeds(self.fans):
             location_str = fan.location_name()
 
+            # A failing driver should not stop us listing the other fans
+            try:
+                if error:
+                    raise error
+                speed_str = self._speed_string(speed)
+                if fan.stale:
+                    speed_str += " (stale)"
+
+                control = fan.get_control()
+                control_str = fan.control_modes.get(control, "Control {}".format(control))
+            except RISCOSError as exc:
+                self.ro.kernel.writeln("{:5} : {:<24}  {:<32}  Error: {}".format(fan.fan_id, fan.provider,
+                                                                                  location_str, exc.errmess))
+                continue
+
             self.ro.kernel.writeln("{:5} : {:<24}  {:<32}  {:9}  {}".format(fan.fan_id, fan.provider,
                                                                             location_str, control_str,
                                                                             speed_str))
 
+    def _watch_row(self, fan):
+        """
+        Describe a fan for *FanWatch, using only what we already know about it.
+        """
+        if fan.state != FanConstants.FanState_OK:
+            speed_str = self._speed_string(fan.state)
+        elif fan.last_speed is None:
+            speed_str = "Unknown"
+        else:
+            speed_str = self._speed_string(fan.last_speed)
+            if fan.stale:
+                speed_str += " (stale)"
+
+        if not (fan.capabilities & FanConstants.FanCapability_SupportsAutomatic):
+            control = FanConstants.FanControl_Manual
+        else:
+            control = fan.control_mode
+        control_str = fan.control_modes.get(control, "Unknown")
+
+        key = (speed_str, control_str)
+        return (key, "{:5} : {:<24}  {:<32}  {:9}  {}".format(fan.fan_id, fan.provider, fan.location_name(),
+                                                              control_str, speed_str))
+
+    def cmd_fanwatch(self, args):
+        """
+        Syntax: *FanWatch [<Interval>]
+        """
+        args = read_args(self.ro, "interval", args)
+        interval = int(args[0].value) if args[0] else 100
+        interval = max(1, min(interval, 0x7FFF))
+
+        watch = FanWatch("{:>5}   {:<24}  {:<32}  {:<9}  {}".format("Fan", "Provider", "Location",
+                                                                   "Control", "Speed"),
+                         self._watch_row)
+        rma = RMAAccount.get(self.ro, 'FanController')
+        while True:
+            if not self.sample_interval:
+                # Nothing is keeping the samples up to date, so we must read them ourselves.
+                self.sample_fans()
+
+            (columns, rows) = self._text_window()
+            output = watch.refresh(self.fans, columns, rows)
+            if output:
+                # Write the whole update at once, rather than a line at a time
+                block = rma.strdup(output, 'watch output')
+                try:
+                    self.ro.kernel.api.swi(FanConstants.SWIOS_Write0, regs={0: block.address})
+                finally:
+                    rma.free(block)
+
+            # Wait for the next refresh, or until Escape is pressed
+            key = self._wait_key(interval)
+            if key == FanConstants.OSByte_ReadKey_Escape:
+                return
+            if key == ord(' '):
+                watch.next_page()
+
+    def _text_window(self):
+        """
+        Read the size of the text window.
+
+        @return: tuple of (columns, rows)
+        """
+        variables = (FanConstants.VduVariable_TWLCol, FanConstants.VduVariable_TWBRow,
+                     FanConstants.VduVariable_TWRCol, FanConstants.VduVariable_TWTRow)
+        rma = RMAAccount.get(self.ro, 'FanController')
+        block = rma.allocate(4 * (len(variables) + 1), 'vdu variables')
+        try:
+            block.write_words(variables + (-1,))
+            self.ro.kernel.api.swi(FanConstants.SWIOS_ReadVduVariables,
+                                   regs={0: block.address, 1: block.address})
+            (left, bottom, right, top) = [self.ro.memory[block.address + index * 4].word
+                                          for index in range(len(variables))]
+        finally:
+            rma.free(block)
+        return (right - left + 1, bottom - top + 1)
+
+    def _wait_key(self, interval):
+        """
+        Wait for a time, or until a key is pressed.
+
+        @param interval:    time to wait, in centiseconds
+
+        @return: code of the key pressed, OSByte_ReadKey_Escape if Escape was pressed (and has
+                 been acknowledged), or None if no key was pressed
+        """
+        try:
+            rout = self.ro.kernel.api.swi(FanConstants.SWIOS_Byte,
+                                          regs={0: FanConstants.OSByte_ReadKey,
+                                                1: interval & 0xFF,
+                                                2: interval >> 8})
+            if rout[2] == FanConstants.OSByte_ReadKey_Escape:
+                key = FanConstants.OSByte_ReadKey_Escape
+            elif rout[2] == 0:
+                key = rout[1]
+            else:
+                key = None
+        except RISCOSError as exc:
+            if exc.errnum != FanConstants.ErrorNumber_Escape:
+                raise
+            key = FanConstants.OSByte_ReadKey_Escape
+        if key == FanConstants.OSByte_ReadKey_Escape:
+            self.ro.kernel.api.swi(FanConstants.SWIOS_Byte,
+                                   regs={0: FanConstants.OSByte_AcknowledgeEscape})
+        return key
+
+    def _wait_escape(self, interval):
+        """
+        Wait for a time, or until Escape is pressed.
+
+        @param interval:    time to wait, in centiseconds
+
+        @return: True if Escape was pressed (and has been acknowledged)
+        """
+        return self._wait_key(interval) == FanConstants.OSByte_ReadKey_Escape
+
     def cmd_fanspeed(self, args):
         """
-        Syntax: *FanSpeed <Fan> (<Speed>)
+        Syntax: *FanSpeed <Fan>|<Group> (<Speed>)
         """
         args = read_args(self.ro, "/A,", args)
 
+        group = self.groups.get(args[0].value)
+        if group:
+            if not args[1]:
+                for fan, speed, error in self.read_speeds(group.members(self.fans)):
+                    if error:
+                        self.ro.kernel.writeln("{} : {}".format(fan.fan_id, error.errmess))
+                        continue
+                    self.ro.kernel.writeln("{} : {}".format(fan.fan_id, self._speed_string(speed)))
+                return
+            results = self.set_group_speed(group, int(args[1].value))
+            for result in results:
+                if result.failed:
+                    self.ro.kernel.writeln("{} : {}".format(result.fan.fan_id, result.message))
+            return
+
         fan_id = int(args[0].value)
         fan = self.fans.find_fan(fan_id)
         if args[1]:
             speed = int(args[1].value)
-            fan.set_speed(speed)
+            self.set_speed(fan, speed)
         else:
-            speed = fan.get_speed()
+            (fan, speed, error) = self.read_speeds([fan])[0]
+            if error:
+                raise error
             speed_str = self._speed_string(speed)
             self.ro.kernel.writeln("{} : {}".format(fan_id, speed_str))
+
+    def _stats_line(self, name, stats):
+        latency = stats.latency
+        self.ro.kernel.writeln("{:<24}  {:8}  {:6}  {:8}  {:8}  {:8}".format(name,
+                                                                           stats.total_calls,
+                                                                           stats.errors,
+                                                                           int(latency.mean()),
+                                                                           latency.percentile(50),
+                                                                           latency.percentile(99)))
+
+    def _queue_lines(self, queue):
+        for request_class, name in enumerate(queue.class_names):
+            stats = queue.stats[request_class]
+            if not stats.submitted:
+                continue
+            self.ro.kernel.writeln("  Queue {:<11}  {} waiting, {} requests, {} merged, {} deferred, "
+                                   "wait mean {:.0f} ms, max {:.0f} ms".format(name, queue.depth(request_class),
+                                                                           stats.submitted, stats.merged,
+                                                                           stats.deferred,
+                                                                           stats.mean_wait() * 1000,
+                                                                           stats.max_wait * 1000))
+
+    def cmd_fandriverstats(self, args):
+        """
+        Syntax: *FanDriverStats [<Fan>]
+        """
+        args = read_args(self.ro, "fan", args)
+
+        self.ro.kernel.writeln("{:<24}  {:>8}  {:>6}  {:>8}  {:>8}  {:>8}".format("Driver", "Calls", "Errors",
+                                                                                "Mean us", "p50 us", "p99 us"))
+        if args[0]:
+            fan_id = int(args[0].value)
+            fan = self.fans.find_fan(fan_id)
+            self._stats_line("Fan {}".format(fan_id), fan.stats)
+            return
+
+        for driver_stats in sorted(self.fans.drivers.values(), key=lambda stats: min(stats.fans)):
+            flags = ''
+            if driver_stats.slow:
+                flags += '*'
+            if driver_stats.health and not driver_stats.health.healthy:
+                flags += '!'
+            name = "&{:08x}/&{:08x}{}".format(driver_stats.driver, driver_stats.driver_ws, flags)
+            self._stats_line(name, driver_stats)
+            for fan_id, fan in sorted(driver_stats.fans.items()):
+                self._stats_line("  Fan {}".format(fan_id), fan.stats)
+            if driver_stats.queue:
+                self._queue_lines(driver_stats.queue)
+
+        if self.sample_interval:
+            sampling = self.sampling
+            self.ro.kernel.writeln("Sampling: {} samples, {} skipped as steady".format(sampling.sampled_count,
+                                                                                 sampling.skipped_count))
+            now = self.clock.time()
+            for fan in self.fans:
+                self.ro.kernel.writeln("  Fan {:<5}  every {:>3} x {}cs, {:.2f} samples/s".format(fan.fan_id,
+                                                                                        fan.sample_period,
+                                                                                        self.sample_interval,
+                                                                                        sampling.rate(fan, now)))
+
+        if self.write_behind:
+            wb = self.write_behind
+            self.ro.kernel.writeln("Write-behind: {} requested, {} written, {} saved "
+                                   "({} coalesced, {} within deadband), {} failed".format(wb.requested, wb.written,
+                                                                                          wb.saved, wb.coalesced,
+                                                                                          wb.dropped, wb.failed))
+
+        if self.leases.granted:
+            leases = self.leases
+            self.ro.kernel.writeln("Leases: {} live on {} fans, {} granted, {} renewed, {} released, "
+                                   "{} expired".format(len(leases), len(leases.fan_leases), leases.granted,
+                                                       leases.renewed, leases.released, leases.expired))
+
+        if self.budget:
+            budget = self.budget
+            (power, noise) = budget.estimate(budget.level or 0.0)
+            mean = budget.solve_time / budget.solves if budget.solves else 0
+            self.ro.kernel.writeln("Budget: {} fans in {} zones, level {:.1f}%, "
+                                   "estimated {:.1f} dBA, {:.0f} mW{}".format(len(budget.zone_of), len(budget.zones),
+                                                                           (budget.level or 0.0) * 100, noise, power,
+                                                                           ' (over budget)' if budget.over_budget else ''))
+            self.ro.kernel.writeln("  {} solves, last {:.0f} us, mean {:.0f} us, max {:.0f} us, "
+                                   "{} out of time".format(budget.solves, budget.last_solve_time * 1000000,
+                                                           mean * 1000000, budget.max_solve_time * 1000000,
+                                                           budget.overruns))
+
+    def set_trace(self, enable):
+        """
+        Turn the trace on or off.
+        """
+        if enable:
+            if not self.trace:
+                self.trace = TraceBuffer(self.ro.config['fancontroller.trace_records'])
+        else:
+            self.trace = None
+        self.fans.set_trace(self.trace)
+
+    def cmd_fantrace(self, args):
+        """
+        Syntax: *FanTrace [-on|-off] [-clear] [-swi] [-driver] [-service] [-errors] [-fan <Fan>] [-export <filename>]
+        """
+        args = read_args(self.ro, "on/S,off/S,clear/S,swi/S,driver/S,service/S,errors/S,fan/K,export/K", args)
+
+        if args[0]:
+            self.set_trace(True)
+            return
+        if args[1]:
+            self.set_trace(False)
+            return
+
+        if not self.trace:
+            self.ro.kernel.writeln("FanController tracing is off")
+            return
+
+        if args[2]:
+            self.trace.clear()
+            return
+
+        if args[8]:
+            filename = args[8].value
+            count = self.trace.export(filename)
+            self.ro.kernel.writeln("Exported {} trace records to {}".format(count, filename))
+            return
+
+        kinds = []
+        if args[3]:
+            kinds.append(TraceBuffer.Kind_SWI)
+        if args[4]:
+            kinds.append(TraceBuffer.Kind_Driver)
+        if args[5]:
+            kinds.append(TraceBuffer.Kind_Service)
+        errors_only = bool(args[6])
+        fan_id = int(args[7].value) if args[7] else None
+
+        first = None
+        for record in self.trace.records(fan_id=fan_id, errors_only=errors_only):
+            if kinds and record.kind not in kinds:
+                continue
+            if first is None:
+                first = record.timestamp_ns
+            if record.kind == TraceBuffer.Kind_SWI:
+                name = "FanController_{}".format(self.swi_names[record.number]
+                                                 if record.number < len(self.swi_names) else record.number)
+            elif record.kind == TraceBuffer.Kind_Driver:
+                name = "Driver reason {}".format(record.number)
+            else:
+                name = "Service &{:x}".format(record.number)
+            error_str = ''
+            if record.failed:
+                error_str = "  error &{:x}".format(record.errnum)
+            self.ro.kernel.writeln("{:10.6f} : {:<28} fan {:<5} "
+                                   "&{:08x} &{:08x} &{:08x} &{:08x}  {:7}us{}".format((record.timestamp_ns - first) / 1000000000.0,
+                                                                                      name, record.fan_id,
+                                                                                      record.r0, record.r1,
+                                                                                      record.r2, record.r3,
+                                                                                      record.duration_us,
+                                                                                      error_str))
+
+    @staticmethod
+    def _number(value):
+        """
+        Convert a number given on the command line, which may be in &hex.
+        """
+        if value.startswith('&'):
+            return int(value[1:], 16)
+        return int(value, 0)
+
+    def cmd_fangroup(self, args):
+        """
+        Syntax: *FanGroup [<Group> [-fans <Fan>,<Fan>...] [-location <location> [-mask <mask>]] [-remove]]
+        """
+        args = read_args(self.ro, ",fans/K,location/K,mask/K,remove/S", args)
+
+        if not args[0]:
+            for group in self.groups:
+                members = ', '.join(str(fan.fan_id) for fan in group.members(self.fans))
+                if group.fan_ids is not None:
+                    kind = "Fans"
+                else:
+                    kind = "Location &{:08x}/&{:08x}".format(group.location_value, group.location_mask)
+                self.ro.kernel.writeln("{:<16}  {:<32}  {}".format(group.name, kind, members or 'None'))
+            return
+
+        name = args[0].value
+        if args[4]:
+            self.groups.remove(name)
+            return
+
+        if args[2]:
+            location = self._number(args[2].value)
+            mask = self._number(args[3].value) if args[3] else 0xFFFFFFFF
+            self.groups.define(FanGroup(name, location_mask=mask, location_value=location))
+        else:
+            fan_ids = [int(fan_id) for fan_id in args[1].value.split(',')] if args[1] else []
+            self.groups.define(FanGroup(name, fan_ids=fan_ids))
+
+    def cmd_fancalibrate(self, args):
+        """
+        Syntax: *FanCalibrate [<Fan>|<Group>] [-settle <time>] [-concurrency <fans>]
+        """
+        args = read_args(self.ro, ",settle/K,concurrency/K", args)
+
+        if args[0]:
+            group = self.groups.get(args[0].value)
+            if group:
+                fans = list(group.members(self.fans))
+            else:
+                fans = [self.fans.find_fan(int(args[0].value))]
+        else:
+            fans = list(self.fans)
+        settle = int(args[1].value) if args[1] else None
+        concurrency = int(args[2].value) if args[2] else None
+
+        run = self.start_calibration(fans, settle=settle, concurrency=concurrency)
+        if not run.calibrations:
+            self.ro.kernel.writeln("No fans can be calibrated")
+            return
+
+        self.ro.kernel.writeln("Calibrating {} fans".format(len(run.calibrations)))
+        # We drive the calibration ourselves, checking on it every 10cs
+        while not run.step():
+            if self.clock.virtual:
+                self.clock.run(0.1)
+            elif self._wait_escape(10):
+                run.abort()
+                break
+
+        for calibration in run.calibrations:
+            if calibration.state == FanCalibration.State_Done:
+                points = ', '.join("{}% {} RPM".format(speed, rpm) for speed, rpm in calibration.points)
+                self.ro.kernel.writeln("{:5} : {}".format(calibration.fan.fan_id, points))
+            else:
+                self.ro.kernel.writeln("{:5} : Failed: {}".format(calibration.fan.fan_id, calibration.error))
+        if run.duration is not None:
+            self.ro.kernel.writeln("Calibrated in {:.1f}s".format(run.duration))
+
+    def _stats_row(self, name, sketch):
+        for unit, quantiles in (('%', sketch.percent), ('RPM', sketch.rpm)):
+            if not quantiles:
+                continue
+            values = [quantiles.quantile(q) for q in (0.5, 0.9, 0.99)] + [quantiles.max]
+            self.ro.kernel.writeln("{:<32}  {:>8}  {:>7}  {}".format(name, len(quantiles), unit,
+                                                                   '  '.join("{:>7.0f}".format(value)
+                                                                             for value in values)))
+
+    def cmd_fanstats(self, args):
+        """
+        Syntax: *FanStats [<Fan>|<Group>] [-by <fields>] [-windows <count>]
+        """
+        args = read_args(self.ro, ",by/K,windows/K", args)
+        if not self.sketches:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "Speed distributions are not being recorded")
+        windows = int(args[2].value) if args[2] else 0
+        now = self.clock.time()
+
+        self.ro.kernel.writeln("{:<32}  {:>8}  {:>7}  {:>7}  {:>7}  {:>7}  {:>7}".format("Fans", "Samples", "Units",
+                                                                                   "p50", "p90", "p99", "Max"))
+        if args[0]:
+            group = self.groups.get(args[0].value)
+            if group:
+                fan_ids = [fan.fan_id for fan in group.members(self.fans)]
+                self._stats_row(group.name, self.sketches.fan_sketch(fan_ids, now, windows))
+            else:
+                fan = self.fans.find_fan(int(args[0].value))
+                self._stats_row("Fan {}".format(fan.fan_id), self.sketches.fan_sketch([fan.fan_id], now, windows))
+            return
+
+        fields = 0
+        for name in (args[1].value if args[1] else 'device').split(','):
+            field = FanSketches.field_names.get(name.strip().lower(), None)
+            if field is None:
+                raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                           "Location fields must be from: {}".format(
+                                                ', '.join(sorted(FanSketches.field_names))))
+            fields |= field
+        for key, sketch in sorted(self.sketches.grouped(fields, now, windows).items()):
+            self._stats_row(FanDescriptor.describe_location(key).strip(), sketch)
+
+    def cmd_fansimulate(self, args):
+        """
+        Syntax: *FanSimulate <seconds>
+        """
+        args = read_args(self.ro, "/A", args)
+        clock = self.clock
+        if not clock.virtual:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadConfigure,
+                                       "Simulation needs the virtual clock (fancontroller.clock = virtual)")
+
+        duration = float(args[0].value)
+        start = time.perf_counter()
+        events = clock.run(duration)
+        elapsed = time.perf_counter() - start
+        self.ro.kernel.writeln("Simulated {:.2f}s in {:.2f}s: {} events, "
+                               "clock now at {:.2f}s".format(duration, elapsed, events, clock.monotonic()))
+
+    def cmd_fanchurn(self, args):
+        """
+        Syntax: *FanChurn [<Driver module> [<Reloads> [<Operations>]]] [-readers <threads>]
+
+        Both the driver module and FanController itself are killed and loaded again.
+        """
+        args = read_args(self.ro, ",,,readers/K", args)
+
+        driver_module = args[0].value if args[0] else 'FanDriverPyromaniac'
+        reloads = int(args[1].value) if args[1] else 1000
+        operations = int(args[2].value) if args[2] else 1000000
+        readers = int(args[3].value) if args[3] else 0
+
+        def registry():
+            controller = FanController.running(self.ro)
+            return controller.fans if controller else None
+
+        harness = ChurnHarness(self.ro, driver_module=driver_module, registry=registry)
+        result = harness.run(reloads=reloads, operations=operations, readers=readers)
+
+        self.ro.kernel.writeln("{} reloads and {} operations in {:.2f}s".format(result.reloads,
+                                                                                result.operations,
+                                                                                result.duration))
+        for account in RMAAccount.all(self.ro):
+            self.ro.kernel.writeln("{}: {} live RMA blocks (growth {}), "
+                                   "{:.4f} allocations per operation".format(account.owner, account.live,
+                                                                             result.live_growth[account.owner],
+                                                                             result.allocations_per_operation(account.owner)))
+            for purpose, counts in sorted(account.purposes.items()):
+                self.ro.kernel.writeln("  {:<16}  {} allocated, {} freed, {} live ({} bytes)".format(purpose,
+                                                                                                    counts.allocations,
+                                                                                                    counts.frees,
+                                                                                                    counts.live,
+                                                                                                    counts.live_bytes))
+        self.ro.kernel.writeln("Python heap growth: {} bytes".format(result.heap_growth))
+        if readers:
+            self.ro.kernel.writeln("Snapshot readers: {} reads, {} inconsistent".format(result.snapshot_reads,
+                                                                                       result.snapshot_errors))
+
+        if not result.passed(harness.heap_tolerance):
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_ChurnFailed,
+                                       "Fan churn leaked {} RMA blocks and {} bytes of heap, "
+                                       "with {} inconsistent snapshots".format(result.leaked_blocks,
+                                                                              result.heap_growth,
+                                                                              result.snapshot_errors))
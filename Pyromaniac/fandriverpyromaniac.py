@@ -8,6 +8,10 @@ from riscos.errors import RISCOSSyntheticError, RISCOSError
 from riscos.modules.pymodules import PyModule
 
 from .constants import FanConstants
+from .fanclock import Clock
+from .fanhwmon import HwmonBackend, GPUNames
+from .fanreplay import ReplayTimeline, replay_source
+from .fanrma import RMAAccount
 
 FanTechMapping = {
         'fan': FanConstants.FanCapability_Type_Fan,
@@ -64,12 +68,20 @@ class FanDriverConfig(Configuration):
             'speeds': SpeedList,
             'accuracy': int,
             'max_speed': int,
-            'capabilities': 'flags:manual,auto,moveable,can-fail',
+            'capabilities': 'flags:manual,auto,moveable,can-fail,multiple',
             'tech': 'enum:fan,piezoelectric,peltier,liquid',
             'position_lateral': 'enum:unspecified,left,middle,right',
             'position_longitudinal': 'enum:unspecified,front,middle,rear',
             'position_vertical': 'enum:unspecified,lower,middle,upper',
-            'device': 'enum:cpu,gpu,memory,iocard,psu,backplane,radiator,chassis,external,generic'
+            'device': 'enum:cpu,gpu,memory,iocard,psu,backplane,radiator,chassis,external,generic',
+            'replay': str,
+            'replay_rate': int,
+            'hwmon': str,
+            'hwmon_max_age': int,
+            'fans': int,
+            'ramp_rate': int,
+            'ramp_jitter': int,
+            'latency': int,
     }
     _help = {
             'fan_speeds': """
@@ -94,6 +106,9 @@ The recognised flags are:
     * `auto` - fan support automatic speed selection.
     * `moveable` - fan can have its location changed.
     * `can-fail` - fan can report that it has failed.
+    * `multiple` - driver can read and set the speeds of many fans in one call.
+
+The `multiple` flag is also given to the fans declared for `hwmon`.
 """,
 
             'tech': """
@@ -156,6 +171,57 @@ spacially distinguished. The recognised positions are:
     * `lower`
     * `middle`
     * `upper`
+""",
+
+            'replay': """
+Configures a recording to replay the fans from, instead of declaring the
+single configured fan. This may be a FanController telemetry directory (of
+which the latest run is replayed) or a replay file. The fans are registered
+with the location, capabilities and speeds that were recorded, and report the
+recorded speeds, latencies and errors.
+""",
+
+            'replay_rate': """
+Configures the rate, as a percentage of real time, at which the recording is
+replayed. Use 0 to replay as fast as possible, moving on to the next recorded
+timestamp each time a fan is read again, so that each sweep of the fans sees
+one step of the recording.
+""",
+
+            'hwmon': """
+Configures a Linux sysfs hwmon directory (usually `/sys/class/hwmon`) whose
+fans are declared, instead of the single configured fan. One fan is declared
+for each `fan<n>_input` channel. Channels with a writable `pwm<n>` can have
+their duty cycle set, and those with a writable `pwm<n>_enable` can be
+switched between manual and automatic control. A fan which is turning slower
+than 200 RPM whilst it is being driven is reported as failed.
+""",
+
+            'hwmon_max_age': """
+Configures the time, in milliseconds, for which the readings of the hwmon
+fans are used before all of them are read again.
+""",
+
+            'fans': """
+Configures the number of fans declared with the configured details. Each is
+given the next sequence number in its location.
+""",
+
+            'ramp_rate': """
+Configures the rate, in speed units per second, at which the declared fans
+change speed when they are set to a new speed. Use 0 for the fans to change
+speed immediately.
+""",
+
+            'ramp_jitter': """
+Configures the variation, as a percentage, of the ramp rate of each declared
+fan from the configured rate. The variation is chosen from the random
+numbers of the fan clock, so it is repeatable with the clock's seed.
+""",
+
+            'latency': """
+Configures the time, in microseconds, that each call to the driver for the
+declared fans takes.
 """,
     }
     speeds = []
@@ -168,27 +234,61 @@ spacially distinguished. The recognised positions are:
     position_longitudinal = 'rear'
     position_vertical = 'unspecified'
     device = 'chassis'
+    replay = ''
+    replay_rate = 100
+    hwmon = ''
+    hwmon_max_age = 100
+    fans = 1
+    ramp_rate = 0
+    ramp_jitter = 0
+    latency = 0
 
 
 class Fan(object):
 
-    def __init__(self, location_id, capabilities, accuracy, maximum, speeds):
+    def __init__(self, location_id, capabilities, accuracy, maximum, speeds, ramp_rate=0):
         self.fan_in = None
+        self.fan_id = None
         if speeds:
             self.speed = max(speeds)
         else:
             self.speed = 100
+        # Speed the fan was set to, which it moves towards at the ramp rate (in units per
+        # second, or 0 to move immediately) from the speed it was at the ramp time
+        self.target = self.speed
+        self.ramp_rate = ramp_rate
+        self.ramp_time = 0
         self.mode = FanConstants.FanControl_Manual
         self.speeds = speeds
         self.accuracy = accuracy
         self.maximum = maximum
         self.location_id = location_id
         self.capabilities = capabilities
+        # HwmonChannel of the host fan providing this fan, or None if it is emulated
+        self.channel = None
 
     def __repr__(self):
         return "<{}(id={}, speed={}, mode={})>".format(self.__class__.__name__,
                                                        self.fan_id, self. speed, self.mode)
 
+    def current_speed(self, now):
+        """
+        @param now:     the time, in seconds
+
+        @return: the speed the fan has reached
+        """
+        if not self.ramp_rate or self.speed == self.target:
+            return self.target
+        step = self.ramp_rate * (now - self.ramp_time)
+        if self.target > self.speed:
+            return int(min(self.speed + step, self.target))
+        return int(max(self.speed - step, self.target))
+
+    def set_target(self, speed, now):
+        self.speed = self.current_speed(now)
+        self.target = speed
+        self.ramp_time = now
+
 
 class FanDriverPyromaniac(PyModule):
     version = '0.02'
@@ -203,6 +303,7 @@ class FanDriverPyromaniac(PyModule):
         self.registered = False
         self.pwp = None
         self.provider_name = None
+        self.rma = RMAAccount.get(ro, 'FanDriverPyromaniac')
 
         location_id = DeviceMapping[self.ro.config['fandriver.device']]<<FanConstants.FanType_Device_Shift
         if 16 <= DeviceMapping[self.ro.config['fandriver.device']] < 32:
@@ -216,19 +317,88 @@ class FanDriverPyromaniac(PyModule):
         # FIXME: Configurable sequence?
         location_id |= (0<<FanConstants.FanType_Sequence_Shift)
 
+        # The recording we are replaying, or None if we're declaring the configured fan
+        self.replay = None
+        # Registered fans, keyed by their fan_id
+        self.fan_ids = {}
+
         # The fans that we'll declare
-        self.fans = [
-                Fan(location_id=location_id,
-                    speeds=self.ro.config['fandriver.speeds'] or None,
-                    accuracy=self.ro.config['fandriver.accuracy'],
-                    maximum=self.ro.config['fandriver.max_speed'],
-                    capabilities=(self.ro.config['fandriver.capabilities'] |
-                                  FanTechMapping[self.ro.config['fandriver.tech']] << FanConstants.FanCapability_Type_Shift))
-            ]
+        ramp_rate = self.ro.config['fandriver.ramp_rate']
+        ramp_jitter = self.ro.config['fandriver.ramp_jitter']
+        self.fans = []
+        for sequence in range(self.ro.config['fandriver.fans']):
+            rate = ramp_rate
+            if ramp_jitter:
+                rate = ramp_rate * (1 + self.clock.random.uniform(-ramp_jitter, ramp_jitter) / 100.0)
+            self.fans.append(Fan(location_id=location_id | ((sequence & FanConstants.FanType_Sequence_Mask)
+                                                            << FanConstants.FanType_Sequence_Shift),
+                                 speeds=self.ro.config['fandriver.speeds'] or None,
+                                 accuracy=self.ro.config['fandriver.accuracy'],
+                                 maximum=self.ro.config['fandriver.max_speed'],
+                                 capabilities=(self.ro.config['fandriver.capabilities'] |
+                                               FanTechMapping[self.ro.config['fandriver.tech']] << FanConstants.FanCapability_Type_Shift),
+                                 ramp_rate=rate))
+        self.latency = self.ro.config['fandriver.latency'] / 1000000.0
+
+        replay = self.ro.config['fandriver.replay']
+        if replay:
+            source = replay_source(replay)
+            self.replay = ReplayTimeline(source, rate=self.ro.config['fandriver.replay_rate'] / 100.0,
+                                         clock=lambda: self.clock.monotonic())
+            self.fans = [Fan(location_id=description['location'],
+                             speeds=description['speeds'] or None,
+                             accuracy=description['accuracy'],
+                             maximum=description['maximum'],
+                             capabilities=description['capabilities'])
+                         for description in source.fans()]
+
+        # The host's hwmon fans, or None if we're not declaring them
+        self.hwmon = None
+        hwmon = self.ro.config['fandriver.hwmon']
+        if hwmon:
+            self.hwmon = HwmonBackend(hwmon, clock=lambda: self.clock.monotonic(),
+                                      max_age=self.ro.config['fandriver.hwmon_max_age'] / 1000.0)
+            self.fans = self.hwmon_fans(self.hwmon.discover())
 
         self.debug_fandriverpyromaniac = False
         self.ro.debug_register_ivar('fandriverpyromaniac', self)
 
+    @property
+    def clock(self):
+        return Clock.get(self.ro)
+
+    def hwmon_fans(self, channels):
+        """
+        Describe the fans for the hwmon channels.
+        """
+        fans = []
+        # Next sequence number to use for each device
+        sequences = {}
+        for channel in channels:
+            device = FanConstants.FanType_Device_GPU if channel.name in GPUNames else FanConstants.FanType_Device_Chassis
+            sequence = sequences.get(device, 0)
+            sequences[device] = sequence + 1
+            location_id = (device << FanConstants.FanType_Device_Shift) | \
+                          ((sequence & FanConstants.FanType_Sequence_Mask) << FanConstants.FanType_Sequence_Shift)
+
+            capabilities = FanConstants.FanCapability_CanFail | \
+                           (self.ro.config['fandriver.capabilities'] & FanConstants.FanCapability_MultipleFans) | \
+                           (FanConstants.FanCapability_Type_Fan << FanConstants.FanCapability_Type_Shift)
+            if channel.controllable:
+                capabilities |= FanConstants.FanCapability_SupportsManual
+            if channel.automatic:
+                capabilities |= FanConstants.FanCapability_SupportsAutomatic
+
+            fan = Fan(location_id=location_id,
+                      speeds=None,
+                      accuracy=1,
+                      # Controllable fans are driven by duty cycle
+                      maximum=100 if channel.controllable else channel.maximum,
+                      capabilities=capabilities)
+            fan.channel = channel
+            fans.append(fan)
+        return fans
+
     def register(self):
         if self.registered:
             return
@@ -238,7 +408,7 @@ class FanDriverPyromaniac(PyModule):
                 try:
                     speeds_ptr = 0
                     if fan.speeds:
-                        speeds_ptr = self.ro.kernel.da_rma.allocate(4 * (len(fan.speeds) + 1))
+                        speeds_ptr = self.rma.allocate(4 * (len(fan.speeds) + 1), 'speeds table')
                         speeds_ptr.write_words(fan.speeds)
                         speeds_ptr[4 * len(fan.speeds)].word = -1
 
@@ -252,10 +422,11 @@ class FanDriverPyromaniac(PyModule):
                                                         6: fan.maximum,
                                                         7: speeds_ptr})
                     fan.fan_id = rout[0]
+                    self.fan_ids[fan.fan_id] = fan
 
                 finally:
                     if speeds_ptr:
-                        speeds_ptr.free()
+                        self.rma.free(speeds_ptr)
 
             self.registered = True
             if self.debug_fandriverpyromaniac:
@@ -276,6 +447,7 @@ class FanDriverPyromaniac(PyModule):
                         if not silent:
                             raise
                         # If silent, we just mark them as deregistered silently.
+                    self.fan_ids.pop(fan.fan_id, None)
                 fan.fan_id = None
             if self.debug_fandriverpyromaniac:
                 print("Deregistered with FanController")
@@ -287,13 +459,15 @@ class FanDriverPyromaniac(PyModule):
 
     def initialise(self, arguments, pwp):
         self.pwp = pwp
-        self.provider_name = self.ro.kernel.da_rma.strdup("Pyromaniac")
+        self.provider_name = self.rma.strdup("Pyromaniac", 'provider name')
         self.register()
 
     def finalise(self, pwp):
         self.deregister()
-        self.provider_name.free()
+        self.rma.free(self.provider_name)
         self.provider_name = None
+        if self.hwmon:
+            self.hwmon.close()
 
     def service(self, service_number, regs):
         if service_number == FanConstants.Service_FanControllerStarted:
@@ -305,18 +479,20 @@ class FanDriverPyromaniac(PyModule):
         """
         Look up the fan in our list by its ID.
         """
-        # FIXME: Change to a dictionary?
-        for fan in self.fans:
-            if fan.fan_id == fan_id:
-                return fan
-        return None
+        return self.fan_ids.get(fan_id, None)
 
-    def driver(self, regs):
+    def driver(self, regs, advance=True):
         """
         Entry point for the fan driver
+
+        @param advance: False if the replay has already been advanced for this call
         """
 
         reason = regs[0]
+        if reason in (FanConstants.FanDriver_GetSpeeds, FanConstants.FanDriver_SetSpeeds):
+            self.driver_multiple(reason, regs)
+            return
+
         fan_id = regs[1]
         location_id = regs[2]
 
@@ -329,11 +505,33 @@ class FanDriverPyromaniac(PyModule):
         if self.debug_fandriverpyromaniac:
             print("FanDriver call for fan {!r} (location &{:08x}, reason {})".format(fan, location_id, reason))
 
+        if fan.channel:
+            self.hwmon_driver(fan, reason, regs)
+            return
+
+        replay_state = None
+        if self.replay:
+            if advance:
+                self.replay.advance((fan.location_id,) if reason == FanConstants.FanDriver_GetSpeed else ())
+            replay_state = self.replay.state(fan.location_id)
+            if replay_state:
+                if replay_state.latency:
+                    self.clock.sleep(replay_state.latency)
+                if replay_state.error:
+                    (errnum, message) = replay_state.error
+                    raise RISCOSSyntheticError(self.ro, errnum, message)
+
+        elif self.latency:
+            self.clock.sleep(self.latency)
+
         if reason == FanConstants.FanDriver_GetSpeed:
-            regs[3] = fan.speed
+            if replay_state and replay_state.speed is not None:
+                regs[3] = replay_state.speed
+            else:
+                regs[3] = fan.current_speed(self.clock.monotonic())
 
         elif reason == FanConstants.FanDriver_SetSpeed:
-            fan.speed = regs[3]
+            fan.set_target(regs[3], self.clock.monotonic())
 
         elif reason == FanConstants.FanDriver_GetControlMode:
             regs[3] = fan.mode
@@ -348,3 +546,94 @@ class FanDriverPyromaniac(PyModule):
         else:
             # Not recognised, so explicitly return a failure
             regs[0] = -1
+
+    def driver_multiple(self, reason, regs):
+        """
+        Handle a driver call for a list of fans, by performing the single fan operation on each.
+        """
+        fan_ids = regs[1]
+        count = regs[2]
+        speeds = regs[3]
+        single_reason = FanConstants.FanDriver_GetSpeed if reason == FanConstants.FanDriver_GetSpeeds \
+                                                        else FanConstants.FanDriver_SetSpeed
+        if self.hwmon:
+            # Read all the host's fans once, rather than checking for each fan
+            self.hwmon.refresh()
+        fans = [self.get_fan(self.ro.memory[fan_ids + index * 4].word) for index in range(count)]
+        if self.replay:
+            # The whole list is one read of the fans, so the replay only moves on once
+            self.replay.advance([fan.location_id for fan in fans if fan]
+                                if reason == FanConstants.FanDriver_GetSpeeds else ())
+        for index, fan in enumerate(fans):
+            speed_mem = self.ro.memory[speeds + index * 4]
+            if not fan:
+                speed_mem.word = FanConstants.FanState_Disconnected & 0xFFFFFFFF
+                continue
+            fan_regs = {0: single_reason, 1: fan.fan_id, 2: fan.location_id, 3: speed_mem.word}
+            try:
+                self.driver(fan_regs, advance=False)
+            except RISCOSError as exc:
+                # One fan failing does not fail the others; its word reports the failure instead
+                if self.debug_fandriverpyromaniac:
+                    print("FanDriver call for fan {!r} failed: {}".format(fan, exc))
+                speed_mem.word = FanConstants.FanState_Failed & 0xFFFFFFFF
+                continue
+            speed_mem.word = fan_regs[3] & 0xFFFFFFFF
+
+    def hwmon_driver(self, fan, reason, regs):
+        """
+        Handle a driver call for a fan on the host.
+        """
+        channel = fan.channel
+        try:
+            if reason == FanConstants.FanDriver_GetSpeed:
+                self.hwmon.refresh()
+                if channel.rpm is None:
+                    regs[3] = FanConstants.FanState_Disconnected
+                elif channel.rpm == 0 and channel.pwm:
+                    # Stalled, although it is being driven
+                    regs[3] = FanConstants.FanState_Failed
+                elif 0 < channel.rpm < 200 and channel.pwm != 0:
+                    # Too slow to be reported as RPM whilst being driven, so it is failing
+                    regs[3] = FanConstants.FanState_Failed
+                elif channel.controllable and channel.enable in (None, 1) and channel.pwm is not None:
+                    # Under manual control we report the duty cycle that was selected
+                    regs[3] = (channel.pwm * 100 + 127) // 255
+                elif channel.rpm < 200:
+                    # Stopped, or still slowing after being turned off
+                    regs[3] = 0
+                else:
+                    regs[3] = channel.rpm
+
+            elif reason == FanConstants.FanDriver_SetSpeed:
+                channel.set_pwm((regs[3] * 255 + 50) // 100)
+
+            elif reason == FanConstants.FanDriver_GetControlMode:
+                self.hwmon.refresh()
+                if channel.automatic and channel.enable not in (None, 1):
+                    regs[3] = FanConstants.FanControl_AutomaticPerformance
+                else:
+                    regs[3] = FanConstants.FanControl_Manual
+
+            elif reason == FanConstants.FanDriver_SetControlMode:
+                if not channel.automatic:
+                    # Without an enable file, the channel is always under manual control
+                    regs[3] = FanConstants.FanControl_Manual
+                elif regs[3] == FanConstants.FanControl_Manual:
+                    channel.set_enable(1)
+                else:
+                    channel.set_enable(2)
+                    regs[3] = FanConstants.FanControl_AutomaticPerformance
+
+            elif reason == FanConstants.FanDriver_SetLocation:
+                fan.location_id = regs[3]
+                regs[3] = FanConstants.FanSetLocation_OK
+
+            else:
+                regs[0] = -1
+
+        except OSError as exc:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_CannotSetSpeed,
+                                       "Host fan {} ({}) could not be controlled: {}".format(channel.label,
+                                                                                             channel.name,
+                                                                                             exc.strerror))
@@ -0,0 +1,190 @@
+"""
+Named groups of fans which may be controlled together.
+"""
+
+from riscos.errors import RISCOSSyntheticError, RISCOSError
+
+from .constants import FanConstants
+
+
+class FanGroupResult(object):
+    """
+    The result of an operation on a single fan in a group.
+    """
+    __slots__ = ('fan', 'errnum', 'message', 'value')
+
+    def __init__(self, fan, errnum=0, message=None, value=None):
+        self.fan = fan
+        self.errnum = errnum
+        self.message = message
+        self.value = value
+
+    def __repr__(self):
+        if self.errnum:
+            return "<{}(fan={}, error &{:x}: {})>".format(self.__class__.__name__,
+                                                           self.fan.fan_id, self.errnum, self.message)
+        return "<{}(fan={}, value={})>".format(self.__class__.__name__, self.fan.fan_id, self.value)
+
+    @property
+    def failed(self):
+        return self.errnum != 0
+
+
+class FanGroup(object):
+    """
+    A group of fans, either listed explicitly or selected by their location.
+    """
+
+    def __init__(self, name, fan_ids=None, location_mask=0, location_value=0):
+        """
+        @param name:            name of the group
+        @param fan_ids:         list of fan ids in the group, or None to select by location
+        @param location_mask:   mask applied to the location id of each fan
+        @param location_value:  value that the masked location id must have to be in the group
+        """
+        self.name = name
+        self.fan_ids = fan_ids
+        self.location_mask = location_mask
+        self.location_value = location_value & location_mask
+
+    def __repr__(self):
+        if self.fan_ids is not None:
+            return "<{}({}, fans={})>".format(self.__class__.__name__, self.name, self.fan_ids)
+        return "<{}({}, location &{:08x}/&{:08x})>".format(self.__class__.__name__, self.name,
+                                                           self.location_value, self.location_mask)
+
+    def members(self, fans):
+        """
+        Iterate over the registered fans in the group.
+
+        @param fans: the Fans registry
+        """
+        if self.fan_ids is not None:
+            for fan_id in self.fan_ids:
+                fan = fans.fans.get(fan_id, None)
+                if fan:
+                    yield fan
+        else:
+            for fan in fans:
+                if fan.location_id & self.location_mask == self.location_value:
+                    yield fan
+
+    def apply(self, fans, check, operation, bulk=None, profile=None, each=None):
+        """
+        Validate and then apply an operation to every fan in the group.
+
+        The operation is only validated once for each distinct capability profile in
+        the group, with any checks of the fans' own state made for every fan. If any fan
+        would reject the operation, no fan is changed.
+
+        @param fans:        the Fans registry
+        @param check:       function(fan) to validate the operation, raising an error if invalid
+        @param operation:   function(fan) to perform the operation, returning the new value
+        @param bulk:        function(list of fans) to perform the operation on all the fans at once,
+                            returning a list of (fan, value, RISCOSError or None), or None to use
+                            the operation on each fan
+        @param profile:     function(fan) returning the key of the fans which validate the same way,
+                            or None to use the fans' capability profiles
+        @param each:        function(fan) to validate the operation against the state of each fan,
+                            raising an error if invalid, or None if only the profiles matter
+
+        @return: list of FanGroupResult, one for each fan in the group
+        """
+        members = list(self.members(fans))
+        if profile is None:
+            profile = lambda fan: fan.profile
+
+        # Validate each fan's state, and once for each profile
+        fan_errors = {}
+        profile_errors = {}
+        for fan in members:
+            if each:
+                try:
+                    each(fan)
+                except RISCOSError as exc:
+                    fan_errors[fan.fan_id] = exc
+                    continue
+            key = profile(fan)
+            if key in profile_errors:
+                continue
+            try:
+                check(fan)
+                profile_errors[key] = None
+            except RISCOSError as exc:
+                profile_errors[key] = exc
+
+        if fan_errors or any(profile_errors.values()):
+            # Something couldn't accept this, so we do nothing.
+            results = []
+            for fan in members:
+                exc = fan_errors.get(fan.fan_id, None)
+                if exc:
+                    results.append(FanGroupResult(fan, exc.errnum, exc.errmess))
+                    continue
+                exc = profile_errors[profile(fan)]
+                if exc:
+                    # The error was for the first fan with this profile; describe this fan instead
+                    try:
+                        check(fan)
+                    except RISCOSError as fan_exc:
+                        exc = fan_exc
+                    results.append(FanGroupResult(fan, exc.errnum, exc.errmess))
+                else:
+                    results.append(FanGroupResult(fan, FanConstants.ErrorNumber_GroupNotApplied,
+                                                  "Not applied because other fans in the group could not be changed"))
+            return results
+
+        if bulk:
+            results = []
+            for fan, value, exc in bulk(members):
+                if exc:
+                    results.append(FanGroupResult(fan, exc.errnum, exc.errmess))
+                else:
+                    results.append(FanGroupResult(fan, value=value))
+            return results
+
+        results = []
+        for fan in members:
+            try:
+                value = operation(fan)
+                results.append(FanGroupResult(fan, value=value))
+            except RISCOSError as exc:
+                results.append(FanGroupResult(fan, exc.errnum, exc.errmess))
+        return results
+
+
+class FanGroups(object):
+    """
+    The named fan groups, looked up without regard to case.
+    """
+
+    def __init__(self, ro):
+        self.ro = ro
+        self.groups = {}
+
+    def __repr__(self):
+        return "<{}({} groups)>".format(self.__class__.__name__, len(self.groups))
+
+    def __iter__(self):
+        for key, group in sorted(self.groups.items()):
+            yield group
+
+    def __len__(self):
+        return len(self.groups)
+
+    def define(self, group):
+        self.groups[group.name.lower()] = group
+
+    def remove(self, name):
+        self.find_group(name)
+        del self.groups[name.lower()]
+
+    def get(self, name):
+        return self.groups.get(name.lower(), None)
+
+    def find_group(self, name):
+        group = self.get(name)
+        if not group:
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_BadGroup,
+                                       "Fan group '{}' is not known to FanController".format(name))
+        return group
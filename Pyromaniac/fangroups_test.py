@@ -0,0 +1,109 @@
+"""
+Test that operations on fan groups change every fan or none of them.
+"""
+
+import unittest
+
+try:
+    from riscos.errors import RISCOSError
+except ImportError:
+    RISCOSError = None
+
+from .constants import FanConstants
+
+if RISCOSError:
+    from .fangroups import FanGroup
+
+    class FakeError(RISCOSError):
+        """
+        An error from a fan, without the RISC OS instance a real error would report through.
+        """
+
+        def __init__(self, errnum, errmess):
+            Exception.__init__(self, errmess)
+            self.errnum = errnum
+            self.errmess = errmess
+
+
+class FakeFan(object):
+
+    def __init__(self, fan_id, maximum, calibrating=False):
+        self.fan_id = fan_id
+        self.location_id = FanConstants.FanType_Device_CPU << FanConstants.FanType_Device_Shift
+        self.maximum = maximum
+        self.calibrating = calibrating
+        self.speed = None
+
+    @property
+    def profile(self):
+        return (self.maximum,)
+
+
+class FakeRegistry(object):
+
+    def __init__(self, fans):
+        self.fans = dict((fan.fan_id, fan) for fan in fans)
+
+    def __iter__(self):
+        return iter(sorted(self.fans.values(), key=lambda fan: fan.fan_id))
+
+
+@unittest.skipUnless(RISCOSError, "The RISC OS classes are not installed")
+class TestFanGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.checks = []
+
+    def check_speed(self, fan, speed):
+        self.checks.append(fan.fan_id)
+        if speed > fan.maximum:
+            raise FakeError(FanConstants.ErrorNumber_CannotSetSpeed,
+                            "Fan speed cannot be set higher than {}".format(fan.maximum))
+
+    def check_calibrating(self, fan):
+        if fan.calibrating:
+            raise FakeError(FanConstants.ErrorNumber_CalibrationRunning,
+                            "Fan {} is being calibrated".format(fan.fan_id))
+
+    def set_speed(self, fan, speed):
+        fan.speed = speed
+        return speed
+
+    def apply(self, fans, speed):
+        group = FanGroup('Test', fan_ids=[fan.fan_id for fan in fans])
+        return group.apply(FakeRegistry(fans),
+                           lambda fan: self.check_speed(fan, speed),
+                           lambda fan: self.set_speed(fan, speed),
+                           each=self.check_calibrating)
+
+    def test_applied(self):
+        fans = [FakeFan(1, 5000), FakeFan(2, 5000), FakeFan(3, 3000)]
+        results = self.apply(fans, 2000)
+        self.assertEqual([result.value for result in results], [2000, 2000, 2000])
+        self.assertEqual([fan.speed for fan in fans], [2000, 2000, 2000])
+        # Checked once for each profile
+        self.assertEqual(self.checks, [1, 3])
+
+    def test_rejected_by_profile(self):
+        fans = [FakeFan(1, 5000), FakeFan(2, 3000), FakeFan(3, 3000)]
+        results = self.apply(fans, 4000)
+        self.assertEqual([result.errnum for result in results],
+                         [FanConstants.ErrorNumber_GroupNotApplied,
+                          FanConstants.ErrorNumber_CannotSetSpeed,
+                          FanConstants.ErrorNumber_CannotSetSpeed])
+        self.assertEqual([fan.speed for fan in fans], [None, None, None])
+
+    def test_rejected_by_calibration(self):
+        # The calibrating fan shares its profile with a fan which accepts the speed, so it has
+        # to be checked itself
+        fans = [FakeFan(1, 5000), FakeFan(2, 5000, calibrating=True), FakeFan(3, 5000)]
+        results = self.apply(fans, 2000)
+        self.assertEqual([result.errnum for result in results],
+                         [FanConstants.ErrorNumber_GroupNotApplied,
+                          FanConstants.ErrorNumber_CalibrationRunning,
+                          FanConstants.ErrorNumber_GroupNotApplied])
+        self.assertEqual([fan.speed for fan in fans], [None, None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Health tracking for fan drivers.
+"""
+
+
+class DriverHealth(object):
+    """
+    Circuit breaker for calls to a driver.
+
+    While the driver is healthy (closed), every call is allowed. After a number
+    of consecutive failures the breaker opens and calls are refused until the
+    backoff period has passed. A single probe call is then allowed through; if
+    it succeeds the breaker closes again, and if it fails the backoff is doubled.
+    """
+    State_Closed = 0
+    State_Open = 1
+    State_Probing = 2
+
+    state_names = {
+            State_Closed: 'OK',
+            State_Open: 'Open',
+            State_Probing: 'Probing',
+        }
+
+    def __init__(self, clock, max_errors=3, backoff=0.1, backoff_max=30.0, timeout=1.0):
+        """
+        @param clock:       function returning the time in seconds
+        @param max_errors:  number of consecutive failures before we stop calling the driver,
+                            or 0 to always call the driver
+        @param backoff:     initial time (in seconds) to wait before probing the driver
+        @param backoff_max: maximum time (in seconds) to wait before probing the driver
+        @param timeout:     time (in seconds) above which a call is considered to have failed,
+                            or 0 to only consider errors as failures
+        """
+        self.max_errors = max_errors
+        self.backoff_initial = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.clock = clock
+
+        self.state = self.State_Closed
+        self.consecutive_errors = 0
+        self.backoff = backoff
+        self.retry_at = 0
+        # Number of calls we refused
+        self.refused = 0
+
+    def __repr__(self):
+        return "<{}({}, {} errors, backoff {}s)>".format(self.__class__.__name__,
+                                                          self.state_names[self.state],
+                                                          self.consecutive_errors,
+                                                          self.backoff)
+
+    @property
+    def healthy(self):
+        return self.state == self.State_Closed
+
+    def allow(self):
+        """
+        Check whether a call to the driver may be made.
+
+        @return: True if the call should be made, False if it should be refused
+        """
+        if self.state == self.State_Closed:
+            return True
+
+        if self.state == self.State_Open and self.clock() >= self.retry_at:
+            # Let this one call through to see if the driver has recovered
+            self.state = self.State_Probing
+            return True
+
+        self.refused += 1
+        return False
+
+    def result(self, failed, duration):
+        """
+        Record the result of a call to the driver.
+
+        @param failed:      True if the call returned an error
+        @param duration:    time (in seconds) that the call took
+
+        @return: True if the health of the driver changed, False if it did not
+        """
+        if self.timeout and duration > self.timeout:
+            failed = True
+
+        if not failed:
+            self.consecutive_errors = 0
+            if self.state == self.State_Closed:
+                return False
+            self.state = self.State_Closed
+            self.backoff = self.backoff_initial
+            return True
+
+        self.consecutive_errors += 1
+        if self.state == self.State_Probing:
+            # Still failing, so wait longer before we try again
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+            self.state = self.State_Open
+            self.retry_at = self.clock() + self.backoff
+            return False
+
+        if self.state == self.State_Closed and \
+           self.max_errors and self.consecutive_errors >= self.max_errors:
+            self.state = self.State_Open
+            self.retry_at = self.clock() + self.backoff
+            return True
+
+        return False
@@ -0,0 +1,77 @@
+"""
+Test that the circuit breaker for the drivers opens and closes properly.
+"""
+
+import unittest
+
+from .fanclock import VirtualClock
+from .fanhealth import DriverHealth
+
+
+class TestDriverHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.health = DriverHealth(self.clock.monotonic, max_errors=3, backoff=1.0, backoff_max=4.0,
+                                   timeout=0.5)
+
+    def fail(self, times=1):
+        changed = False
+        for _ in range(times):
+            self.assertTrue(self.health.allow())
+            changed = self.health.result(True, 0.01)
+        return changed
+
+    def test_opens_after_errors(self):
+        self.assertFalse(self.fail(2))
+        self.assertTrue(self.health.healthy)
+        self.assertTrue(self.fail())
+        self.assertFalse(self.health.healthy)
+        self.assertFalse(self.health.allow())
+        self.assertEqual(self.health.refused, 1)
+
+    def test_success_resets(self):
+        self.fail(2)
+        self.health.result(False, 0.01)
+        self.assertFalse(self.fail(2))
+        self.assertTrue(self.health.healthy)
+
+    def test_slow_call_fails(self):
+        for _ in range(3):
+            self.health.allow()
+            changed = self.health.result(False, 0.6)
+        self.assertTrue(changed)
+        self.assertFalse(self.health.healthy)
+
+    def test_probe(self):
+        self.fail(3)
+        self.clock.sleep(0.9)
+        self.assertFalse(self.health.allow())
+        self.clock.sleep(0.1)
+        # One call is let through to probe the driver, and no more until it returns
+        self.assertTrue(self.health.allow())
+        self.assertEqual(self.health.state, DriverHealth.State_Probing)
+        self.assertFalse(self.health.allow())
+
+        self.assertTrue(self.health.result(False, 0.01))
+        self.assertTrue(self.health.healthy)
+        self.assertEqual(self.health.backoff, 1.0)
+
+    def test_backoff_doubles(self):
+        self.fail(3)
+        for backoff in (2.0, 4.0, 4.0):
+            self.clock.sleep(self.health.backoff)
+            self.assertFalse(self.fail())
+            self.assertEqual(self.health.backoff, backoff)
+            self.assertEqual(self.health.retry_at, self.clock.monotonic() + backoff)
+
+    def test_never_opens(self):
+        health = DriverHealth(self.clock.monotonic, max_errors=0)
+        for _ in range(10):
+            self.assertTrue(health.allow())
+            health.result(True, 0.01)
+        self.assertTrue(health.healthy)
+
+
+if __name__ == '__main__':
+    unittest.main()
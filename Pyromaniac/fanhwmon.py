@@ -0,0 +1,194 @@
+"""
+Access to the host's fans through the Linux hwmon interface.
+
+Each hwmon device in the sysfs tree may provide a number of fan channels, as
+'fan<n>_input' files giving the speed in RPM. A channel may be controllable
+through 'pwm<n>' (duty cycle, 0-255) and 'pwm<n>_enable' (1 for manual control,
+2 or more for automatic control by the hardware).
+
+The files are opened once, when the channels are discovered, and all of them
+are read together with os.pread when any reading is found to be out of date,
+so that reading many fans costs one sweep rather than an open and read of
+each file on every request.
+"""
+
+import errno
+import glob
+import os
+import re
+
+
+# hwmon device names which are graphics cards
+GPUNames = ('amdgpu', 'radeon', 'nouveau', 'nvidia')
+
+
+class HwmonChannel(object):
+    """
+    A fan channel on a hwmon device.
+    """
+    # Size of the reads from the files; the values are short decimal numbers
+    read_size = 32
+
+    def __init__(self, path, index, name):
+        """
+        @param path:    path of the hwmon device directory
+        @param index:   number of the fan channel on the device
+        @param name:    name of the hwmon device
+        """
+        self.path = path
+        self.index = index
+        self.name = name
+        self.label = self.read_file('fan{}_label'.format(index)) or 'fan{}'.format(index)
+        maximum = self.read_file('fan{}_max'.format(index))
+        self.maximum = int(maximum) if maximum and maximum.isdigit() else 0
+
+        self.input_fd = os.open(self.filename('fan{}_input'.format(index)), os.O_RDONLY)
+        self.pwm_fd = self.open_control('pwm{}'.format(index))
+        self.enable_fd = self.open_control('pwm{}_enable'.format(index)) if self.pwm_fd is not None else None
+
+        # Values read by the last sweep; None if they could not be read
+        self.rpm = None
+        self.pwm = None
+        self.enable = None
+
+    def __repr__(self):
+        return "<{}({}, {}/{}, rpm={})>".format(self.__class__.__name__, self.path, self.name,
+                                                self.label, self.rpm)
+
+    def filename(self, leaf):
+        return os.path.join(self.path, leaf)
+
+    def read_file(self, leaf):
+        try:
+            with open(self.filename(leaf), 'r') as fh:
+                return fh.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def open_control(self, leaf):
+        """
+        Open a control file for writing, if we can.
+
+        @return: file descriptor, or None if the file is not present or not writable
+        """
+        try:
+            return os.open(self.filename(leaf), os.O_RDWR)
+        except (IOError, OSError):
+            return None
+
+    @property
+    def controllable(self):
+        return self.pwm_fd is not None
+
+    @property
+    def automatic(self):
+        return self.enable_fd is not None
+
+    def close(self):
+        for fd in (self.input_fd, self.pwm_fd, self.enable_fd):
+            if fd is not None:
+                os.close(fd)
+        self.input_fd = None
+        self.pwm_fd = None
+        self.enable_fd = None
+
+    def read_value(self, fd):
+        if fd is None:
+            return None
+        try:
+            return int(os.pread(fd, self.read_size, 0))
+        except (OSError, ValueError):
+            return None
+
+    def read(self):
+        """
+        Read the current values from the device.
+        """
+        self.rpm = self.read_value(self.input_fd)
+        self.pwm = self.read_value(self.pwm_fd)
+        self.enable = self.read_value(self.enable_fd)
+
+    def write_value(self, fd, value):
+        if fd is None:
+            raise OSError(errno.EACCES, "The channel has no writable control file")
+        os.pwrite(fd, '{}\n'.format(value).encode('ascii'), 0)
+
+    def set_pwm(self, pwm):
+        self.write_value(self.pwm_fd, pwm)
+        self.pwm = pwm
+
+    def set_enable(self, enable):
+        self.write_value(self.enable_fd, enable)
+        self.enable = enable
+
+
+class HwmonBackend(object):
+    """
+    The fan channels found in a sysfs tree, read in batches.
+    """
+
+    def __init__(self, root, clock, max_age=0.1):
+        """
+        @param root:    directory containing the hwmon devices
+        @param clock:   function returning the time in seconds
+        @param max_age: time, in seconds, for which readings are used before they are read again
+        """
+        self.root = root
+        self.clock = clock
+        self.max_age = max_age
+        self.channels = []
+        # Time of the last sweep, from the clock
+        self.last_sweep = None
+        self.sweeps = 0
+
+    def __repr__(self):
+        return "<{}({}, {} channels)>".format(self.__class__.__name__, self.root, len(self.channels))
+
+    def discover(self):
+        """
+        Find the fan channels in the sysfs tree, opening their files.
+
+        @return: list of HwmonChannel objects
+        """
+        self.close()
+        for path in sorted(glob.glob(os.path.join(self.root, '*'))):
+            try:
+                with open(os.path.join(path, 'name'), 'r') as fh:
+                    name = fh.read().strip()
+            except (IOError, OSError):
+                name = os.path.basename(path)
+
+            indexes = []
+            for filename in glob.glob(os.path.join(path, 'fan*_input')):
+                match = re.match(r'fan([0-9]+)_input$', os.path.basename(filename))
+                if match:
+                    indexes.append(int(match.group(1)))
+            for index in sorted(indexes):
+                try:
+                    self.channels.append(HwmonChannel(path, index, name))
+                except OSError as exc:
+                    if exc.errno not in (errno.ENOENT, errno.EACCES, errno.ENODEV):
+                        raise
+        self.last_sweep = None
+        return self.channels
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+
+    def sweep(self):
+        """
+        Read every channel.
+        """
+        for channel in self.channels:
+            channel.read()
+        self.last_sweep = self.clock()
+        self.sweeps += 1
+
+    def refresh(self):
+        """
+        Sweep the channels if the last readings are out of date.
+        """
+        if self.last_sweep is None or self.clock() - self.last_sweep >= self.max_age:
+            self.sweep()
@@ -0,0 +1,119 @@
+"""
+Test that the hwmon fans are found and controlled properly, using a fake sysfs tree.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .fanhwmon import HwmonBackend
+
+
+class FakeSysfs(object):
+    """
+    A temporary directory laid out as /sys/class/hwmon.
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+    def device(self, number, name):
+        path = os.path.join(self.root, 'hwmon{}'.format(number))
+        os.mkdir(path)
+        self.write(path, 'name', name)
+        return path
+
+    def write(self, path, leaf, value, writable=True):
+        filename = os.path.join(path, leaf)
+        with open(filename, 'w') as fh:
+            fh.write('{}\n'.format(value))
+        os.chmod(filename, 0o644 if writable else 0o444)
+
+    def read(self, path, leaf):
+        with open(os.path.join(path, leaf), 'r') as fh:
+            return fh.read().strip()
+
+
+class TestHwmon(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = FakeSysfs()
+        self.now = 0.0
+        # A board with a controllable fan and a fan which can only be read
+        self.board = self.sysfs.device(0, 'nct6775')
+        self.sysfs.write(self.board, 'fan1_input', 1200)
+        self.sysfs.write(self.board, 'fan1_label', 'CPU Fan')
+        self.sysfs.write(self.board, 'fan1_max', 3000)
+        self.sysfs.write(self.board, 'pwm1', 128)
+        self.sysfs.write(self.board, 'pwm1_enable', 2)
+        self.sysfs.write(self.board, 'fan2_input', 800)
+        # A graphics card whose fan has a duty cycle but no enable file
+        self.gpu = self.sysfs.device(1, 'amdgpu')
+        self.sysfs.write(self.gpu, 'fan1_input', 0)
+        self.sysfs.write(self.gpu, 'pwm1', 0)
+        # Something which is not a fan at all
+        self.sysfs.device(2, 'coretemp')
+
+        self.backend = HwmonBackend(self.sysfs.root, lambda: self.now, max_age=1.0)
+        self.channels = self.backend.discover()
+
+    def tearDown(self):
+        self.backend.close()
+        self.sysfs.remove()
+
+    def test_discover(self):
+        self.assertEqual([(channel.name, channel.label) for channel in self.channels],
+                         [('nct6775', 'CPU Fan'), ('nct6775', 'fan2'), ('amdgpu', 'fan1')])
+        (cpu, case, gpu) = self.channels
+        self.assertEqual((cpu.maximum, cpu.controllable, cpu.automatic), (3000, True, True))
+        self.assertEqual((case.maximum, case.controllable, case.automatic), (0, False, False))
+        self.assertEqual((gpu.controllable, gpu.automatic), (True, False))
+
+    def test_sweep(self):
+        (cpu, case, gpu) = self.channels
+        self.backend.refresh()
+        self.assertEqual((cpu.rpm, cpu.pwm, cpu.enable), (1200, 128, 2))
+        self.assertEqual((case.rpm, case.pwm, case.enable), (800, None, None))
+        self.assertEqual((gpu.rpm, gpu.pwm, gpu.enable), (0, 0, None))
+
+        # Readings are used until they are out of date, and then all are read again
+        self.sysfs.write(self.board, 'fan1_input', 1500)
+        self.now = 0.5
+        self.backend.refresh()
+        self.assertEqual(cpu.rpm, 1200)
+        self.now = 1.0
+        self.backend.refresh()
+        self.assertEqual(cpu.rpm, 1500)
+        self.assertEqual(self.backend.sweeps, 2)
+
+    def test_control(self):
+        (cpu, case, gpu) = self.channels
+        cpu.set_enable(1)
+        cpu.set_pwm(200)
+        self.assertEqual(self.sysfs.read(self.board, 'pwm1_enable'), '1')
+        self.assertEqual(self.sysfs.read(self.board, 'pwm1'), '200')
+        gpu.set_pwm(64)
+        self.assertEqual(self.sysfs.read(self.gpu, 'pwm1'), '64')
+
+    def test_no_enable_file(self):
+        # Writing to a control which is not present is an OSError, which the driver reports
+        (cpu, case, gpu) = self.channels
+        with self.assertRaises(OSError):
+            gpu.set_enable(1)
+        with self.assertRaises(OSError):
+            case.set_pwm(100)
+
+    def test_missing_device(self):
+        self.backend.close()
+        self.sysfs.remove()
+        self.sysfs = FakeSysfs()
+        self.backend = HwmonBackend(os.path.join(self.sysfs.root, 'absent'), lambda: self.now)
+        self.assertEqual(self.backend.discover(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+"""
+Leased requests for the speed of managed fans.
+
+A client which wants a fan at a speed takes a lease on it, for a duration
+and at a priority, and renews the lease while it still wants the speed. The
+fan runs at the speed of its highest priority live lease (the most recent,
+if there are several at that priority). When the last lease on a fan is
+released or expires, the fan is returned to the control of its driver, or
+set to a safe speed if it has no automatic control; a client which dies
+therefore cannot leave a fan stuck at the speed it asked for.
+
+Leases are expired by a hierarchical timer wheel, so that each tick costs
+the same however many leases there are.
+"""
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel.
+
+    Each level has a number of slots, each of which covers the whole span of a slot on the
+    level below. Timers are placed on the lowest level whose span reaches their expiry, and
+    are moved down a level each time the slot they are in comes around, so that a timer is
+    touched at most once per level. Timers further ahead than the span of the wheel wait on
+    its top level until they come within it.
+    """
+
+    def __init__(self, slot_bits=6, levels=4):
+        """
+        @param slot_bits:   log2 of the number of slots on each level
+        @param levels:      number of levels
+        """
+        self.slot_bits = slot_bits
+        self.slot_mask = (1 << slot_bits) - 1
+        self.levels = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        # Furthest ahead that a timer can be placed, in ticks
+        self.span = 1 << (slot_bits * levels)
+        self.tick = 0
+        # The slot that each timer is in, keyed by the timer
+        self.slots = {}
+
+    def __repr__(self):
+        return "<{}(tick={}, {} timers)>".format(self.__class__.__name__, self.tick, len(self.slots))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def schedule(self, timer, expiry):
+        """
+        Place a timer on the wheel, replacing any earlier placement.
+
+        @param timer:   hashable object to return when it expires
+        @param expiry:  tick at which it expires
+        """
+        self.cancel(timer)
+        self.place(timer, max(expiry, self.tick + 1))
+
+    def place(self, timer, expiry):
+        # Timers moved down from a higher level may be due on this very tick
+        delta = max(expiry - self.tick, 0)
+        if delta >= self.span:
+            # Too far ahead for the wheel; it is placed as far ahead as it can be, and placed
+            # again for its real expiry when that slot comes around.
+            delta = self.span - 1
+        level = 0
+        while delta >> (self.slot_bits * (level + 1)):
+            level += 1
+        slot = self.levels[level][((self.tick + delta) >> (self.slot_bits * level)) & self.slot_mask]
+        slot.add(timer)
+        self.slots[timer] = (slot, expiry)
+
+    def cancel(self, timer):
+        placement = self.slots.pop(timer, None)
+        if placement:
+            placement[0].discard(timer)
+
+    def advance(self, ticks=1):
+        """
+        Move the wheel on.
+
+        @param ticks:   number of ticks to move on by
+
+        @return: list of the timers which expired
+        """
+        expired = []
+        for _ in range(ticks):
+            self.tick += 1
+            tick = self.tick
+            # Move the timers down from the higher levels whose slot has come around
+            level = 1
+            while level < len(self.levels) and not (tick & ((1 << (self.slot_bits * level)) - 1)):
+                slot = self.levels[level][(tick >> (self.slot_bits * level)) & self.slot_mask]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    (old_slot, expiry) = self.slots.pop(timer)
+                    self.place(timer, expiry)
+                level += 1
+
+            slot = self.levels[0][tick & self.slot_mask]
+            if slot:
+                for timer in slot:
+                    del self.slots[timer]
+                expired.extend(slot)
+                slot.clear()
+        return expired
+
+
+class Lease(object):
+    """
+    A request for a fan to run at a speed.
+    """
+    __slots__ = ('handle', 'fan', 'speed', 'priority', 'expiry')
+
+    def __init__(self, handle, fan, speed, priority, expiry):
+        self.handle = handle
+        self.fan = fan
+        self.speed = speed
+        self.priority = priority
+        self.expiry = expiry
+
+    def __repr__(self):
+        return "<{}(#{}, fan={}, speed={}, priority={})>".format(self.__class__.__name__, self.handle,
+                                                                 self.fan.fan_id, self.speed, self.priority)
+
+    def __hash__(self):
+        return self.handle
+
+    def __eq__(self, other):
+        return self is other
+
+
+class FanLeases(object):
+    """
+    The leases on all the fans.
+    """
+
+    def __init__(self, clock, tick_time=0.1):
+        """
+        @param clock:       function returning the time in seconds
+        @param tick_time:   time, in seconds, of each tick of the timer wheel
+        """
+        self.tick_time = tick_time
+        self.clock = clock
+        self.wheel = TimerWheel()
+        self.next_handle = 1
+        # Leases keyed by their handle, and by fan_id then handle
+        self.leases = {}
+        self.fan_leases = {}
+        # Time of the tick the wheel is at
+        self.tick_start = clock()
+        # Fans whose leases have expired, waiting to be given to take_expired(), keyed by fan_id
+        self.expired_fans = {}
+
+        self.granted = 0
+        self.renewed = 0
+        self.released = 0
+        self.expired = 0
+
+    def __repr__(self):
+        return "<{}({} leases on {} fans)>".format(self.__class__.__name__, len(self.leases),
+                                                   len(self.fan_leases))
+
+    def __len__(self):
+        return len(self.leases)
+
+    def ticks(self, duration):
+        """
+        @return: number of ticks in a duration in seconds, rounded up so that leases are never short
+        """
+        return max(1, int(-(-duration // self.tick_time)))
+
+    def winner(self, fan_id):
+        """
+        @return: the lease which decides the speed of a fan, or None if it has no leases
+        """
+        leases = self.fan_leases.get(fan_id, None)
+        if not leases:
+            return None
+        return max(leases.values(), key=lambda lease: (lease.priority, lease.handle))
+
+    def acquire(self, fan, speed, duration, priority):
+        """
+        Take a lease on a fan.
+
+        @param fan:         FanDescriptor
+        @param speed:       speed requested
+        @param duration:    time, in seconds, the lease lasts if not renewed
+        @param priority:    priority of the lease; higher priorities win
+
+        @return: the new Lease
+        """
+        lease = Lease(self.next_handle, fan, speed, priority, self.wheel.tick + self.ticks(duration))
+        self.next_handle += 1
+        self.leases[lease.handle] = lease
+        self.fan_leases.setdefault(fan.fan_id, {})[lease.handle] = lease
+        self.wheel.schedule(lease, lease.expiry)
+        self.granted += 1
+        return lease
+
+    def find(self, handle):
+        """
+        @return: the live Lease with a handle, or None if it has gone
+        """
+        return self.leases.get(handle, None)
+
+    def renew(self, lease, duration):
+        lease.expiry = self.wheel.tick + self.ticks(duration)
+        self.wheel.schedule(lease, lease.expiry)
+        self.renewed += 1
+
+    def discard(self, lease):
+        """
+        Remove a lease, whether released or expired.
+        """
+        del self.leases[lease.handle]
+        leases = self.fan_leases[lease.fan.fan_id]
+        del leases[lease.handle]
+        if not leases:
+            del self.fan_leases[lease.fan.fan_id]
+
+    def release(self, lease):
+        self.wheel.cancel(lease)
+        self.discard(lease)
+        self.released += 1
+
+    def forget(self, fan_id):
+        """
+        Remove all the leases on a fan which has gone away.
+        """
+        for lease in list(self.fan_leases.get(fan_id, {}).values()):
+            self.wheel.cancel(lease)
+            self.discard(lease)
+        self.expired_fans.pop(fan_id, None)
+
+    def remaining(self, lease):
+        """
+        @return: time, in seconds, before a lease expires
+        """
+        return (lease.expiry - self.wheel.tick) * self.tick_time
+
+    def advance(self):
+        """
+        Expire the leases whose time has passed.
+
+        The fans whose leases expired are kept until they are collected by take_expired(),
+        so that the leases may be brought up to date by whoever is next to use them.
+
+        @return: number of leases which expired
+        """
+        ticks = int((self.clock() - self.tick_start) // self.tick_time)
+        if ticks <= 0:
+            return 0
+        self.tick_start += ticks * self.tick_time
+
+        expired = self.wheel.advance(ticks)
+        for lease in expired:
+            self.discard(lease)
+            self.expired += 1
+            self.expired_fans[lease.fan.fan_id] = lease.fan
+        return len(expired)
+
+    def take_expired(self):
+        """
+        @return: list of the fans whose leases have expired since the last call
+        """
+        fans = list(self.expired_fans.values())
+        self.expired_fans = {}
+        return fans
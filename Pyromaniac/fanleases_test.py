@@ -0,0 +1,131 @@
+"""
+Test that leases on the fans expire properly.
+"""
+
+import random
+import unittest
+
+from .fanclock import VirtualClock
+from .fanleases import FanLeases, TimerWheel
+
+
+class FakeFan(object):
+
+    def __init__(self, fan_id):
+        self.fan_id = fan_id
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def run_wheel(self, wheel, ticks):
+        fired = {}
+        for _ in range(ticks):
+            for timer in wheel.advance():
+                fired[timer] = wheel.tick
+        return fired
+
+    def test_expire_on_time(self):
+        wheel = TimerWheel(slot_bits=2, levels=3)
+        rng = random.Random(1)
+        expiries = {}
+        for timer in range(300):
+            expiries[timer] = rng.randint(1, wheel.span - 1)
+            wheel.schedule(timer, expiries[timer])
+        self.assertEqual(self.run_wheel(wheel, wheel.span), expiries)
+        self.assertEqual(len(wheel), 0)
+
+    def test_beyond_span(self):
+        # Timers further ahead than the wheel can hold still expire on their own tick
+        wheel = TimerWheel(slot_bits=2, levels=3)
+        expiries = {'near': 5, 'edge': wheel.span, 'far': wheel.span * 3 + 7}
+        for timer, expiry in expiries.items():
+            wheel.schedule(timer, expiry)
+        self.assertEqual(self.run_wheel(wheel, wheel.span * 4), expiries)
+
+    def test_cancel(self):
+        wheel = TimerWheel(slot_bits=2, levels=3)
+        wheel.schedule('a', 10)
+        wheel.schedule('b', 10)
+        wheel.cancel('a')
+        self.assertEqual(self.run_wheel(wheel, 20), {'b': 10})
+
+
+class TestFanLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.leases = FanLeases(self.clock.monotonic, tick_time=0.1)
+        self.fan = FakeFan(1)
+
+    def test_winner(self):
+        low = self.leases.acquire(self.fan, 1000, 10, 0)
+        high = self.leases.acquire(self.fan, 2000, 10, 5)
+        later = self.leases.acquire(self.fan, 3000, 10, 5)
+        self.assertIs(self.leases.winner(1), later)
+        self.leases.release(later)
+        self.assertIs(self.leases.winner(1), high)
+        self.leases.release(high)
+        self.assertIs(self.leases.winner(1), low)
+
+    def test_expiry(self):
+        lease = self.leases.acquire(self.fan, 1000, 1.0, 0)
+        self.clock.sleep(0.95)
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [])
+        self.assertIs(self.leases.find(lease.handle), lease)
+
+        self.clock.sleep(0.1)
+        self.assertEqual(self.leases.advance(), 1)
+        self.assertEqual(self.leases.take_expired(), [self.fan])
+        self.assertIsNone(self.leases.find(lease.handle))
+        self.assertIsNone(self.leases.winner(1))
+
+    def test_expiry_seen_before_tick(self):
+        # A lease call brings the leases up to date before the ticker does; the fan whose lease
+        # expired must still be given to the ticker, or it would be left at the lease's speed.
+        self.leases.acquire(self.fan, 1000, 1.0, 0)
+        other = FakeFan(2)
+        self.clock.sleep(1.5)
+        self.leases.advance()
+        self.leases.acquire(other, 2000, 1.0, 0)
+
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [self.fan])
+        self.assertEqual(self.leases.take_expired(), [])
+        self.assertIsNotNone(self.leases.winner(2))
+
+    def test_renew(self):
+        lease = self.leases.acquire(self.fan, 1000, 1.0, 0)
+        self.clock.sleep(0.8)
+        self.leases.advance()
+        self.leases.renew(lease, 1.0)
+        self.clock.sleep(0.8)
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [])
+        self.clock.sleep(0.3)
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [self.fan])
+
+    def test_long_lease(self):
+        # Longer than the span of the wheel, which is made small so that it comes round quickly
+        self.leases.wheel = TimerWheel(slot_bits=2, levels=3)
+        duration = self.leases.wheel.span * 0.1 * 2
+        self.leases.acquire(self.fan, 1000, duration, 0)
+        self.clock.sleep(duration - 1)
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [])
+        self.clock.sleep(2)
+        self.leases.advance()
+        self.assertEqual(self.leases.take_expired(), [self.fan])
+
+    def test_forget(self):
+        self.leases.acquire(self.fan, 1000, 1.0, 0)
+        self.clock.sleep(2)
+        self.leases.advance()
+        self.leases.forget(1)
+        self.assertEqual(self.leases.take_expired(), [])
+        self.assertEqual(len(self.leases), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
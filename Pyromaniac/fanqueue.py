@@ -0,0 +1,219 @@
+"""
+Scheduling of the calls made to the fan drivers.
+
+Each driver has a queue of the requests waiting to call it, in priority
+classes: writes made because something has failed, then writes from the
+control loops, then sampling, then reads for interactive users. A driver
+is only called a limited number of times in each tick; requests which
+arrive when the driver has no calls left this tick, or when more important
+requests are already waiting, are queued and run on later ticks in order
+of their class. A burst of listings from users therefore cannot hold up the
+control loop on a slow driver.
+
+Reads of a fan which already has a read waiting are merged into it.
+"""
+
+import collections
+
+
+class DriverRequest(object):
+    """
+    A request waiting to call a driver.
+    """
+    __slots__ = ('request_class', 'operation', 'fans', 'read', 'queued')
+
+    def __init__(self, request_class, operation, fans, read, queued):
+        self.request_class = request_class
+        self.operation = operation
+        self.fans = fans
+        self.read = read
+        self.queued = queued
+
+    def __repr__(self):
+        return "<{}(class {}, {} fans)>".format(self.__class__.__name__, self.request_class, len(self.fans))
+
+
+class QueueClassStats(object):
+    """
+    Statistics for the requests in one priority class.
+    """
+
+    def __init__(self):
+        self.submitted = 0
+        self.merged = 0
+        self.deferred = 0
+        self.run = 0
+        # Time, in seconds, that the deferred requests waited before being run
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __repr__(self):
+        return "<{}({} submitted, {} deferred)>".format(self.__class__.__name__, self.submitted, self.deferred)
+
+    def mean_wait(self):
+        return self.total_wait / self.deferred if self.deferred else 0.0
+
+
+class DriverQueue(object):
+    """
+    The requests waiting to call one driver.
+    """
+    # Priority classes, most important first
+    Class_Safety = 0
+    Class_Control = 1
+    Class_Sampling = 2
+    Class_Interactive = 3
+    class_names = ('Safety', 'Control', 'Sampling', 'Interactive')
+
+    def __init__(self, clock, calls_per_tick=0, tick_time=0.1):
+        """
+        @param clock:           function returning the time in seconds
+        @param calls_per_tick:  number of calls to make to the driver in each tick, or 0 for no limit
+        @param tick_time:       time, in seconds, of each tick
+        """
+        self.calls_per_tick = calls_per_tick
+        self.tick_time = tick_time
+        self.clock = clock
+        self.queues = [collections.deque() for _ in self.class_names]
+        # Read requests waiting, keyed by the fan_id they read
+        self.reads = {}
+        self.stats = [QueueClassStats() for _ in self.class_names]
+        # Calls made to the driver in the current tick
+        self.tick = None
+        self.calls = 0
+
+    def __repr__(self):
+        return "<{}({} waiting, {} calls this tick)>".format(self.__class__.__name__, len(self), self.calls)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def depth(self, request_class):
+        return len(self.queues[request_class])
+
+    def called(self):
+        """
+        Record that a call has been made to the driver.
+        """
+        self.start_tick()
+        self.calls += 1
+
+    def start_tick(self):
+        """
+        Reset the count of calls if a new tick has started.
+        """
+        tick = int(self.clock() // self.tick_time)
+        if tick != self.tick:
+            self.tick = tick
+            self.calls = 0
+
+    def can_call(self, request_class):
+        """
+        @return: True if a request of a class may call the driver now
+        """
+        if request_class == self.Class_Safety or not self.calls_per_tick:
+            return True
+        if any(self.queues[index] for index in range(request_class + 1)):
+            # Requests that are at least as important are already waiting
+            return False
+        self.start_tick()
+        return self.calls < self.calls_per_tick
+
+    def submit(self, request_class, operation, fans, read=False):
+        """
+        Run a request now if the driver can be called, or queue it.
+
+        @param request_class:   priority class of the request
+        @param operation:       function to call with the list of fans, which calls the driver;
+                                it must deal with any errors, as there may be nobody to report them to
+        @param fans:            list of the fans the request is for
+        @param read:            True if the request only reads the fans, so may be merged
+
+        @return: True if the request was run, False if it is waiting or was merged
+        """
+        stats = self.stats[request_class]
+        stats.submitted += 1
+        if read and self.reads:
+            fans = self.merge_reads(request_class, fans)
+            if not fans:
+                stats.merged += 1
+                return False
+
+        if self.can_call(request_class):
+            stats.run += 1
+            operation(fans)
+            return True
+
+        request = DriverRequest(request_class, operation, fans, read, self.clock())
+        self.queues[request_class].append(request)
+        if read:
+            for fan in fans:
+                self.reads[fan.fan_id] = request
+        stats.deferred += 1
+        return False
+
+    def merge_reads(self, request_class, fans):
+        """
+        Remove the fans which already have reads waiting from a new read.
+
+        A waiting read in a less important class gives its fan up to the new read instead,
+        so that the fan is read as soon as the more important request needs it.
+
+        @return: list of the fans which still need to be read by the new request
+        """
+        remaining = []
+        for fan in fans:
+            waiting = self.reads.get(fan.fan_id, None)
+            if not waiting:
+                remaining.append(fan)
+            elif waiting.request_class > request_class:
+                waiting.fans.remove(fan)
+                del self.reads[fan.fan_id]
+                remaining.append(fan)
+        return remaining
+
+    def run(self, limit=True):
+        """
+        Run the waiting requests, in order of their class, until the driver's calls for this
+        tick have been used.
+
+        @param limit:   False to run all the waiting requests, however many calls they make
+
+        @return: True if requests are still waiting
+        """
+        self.start_tick()
+        now = self.clock()
+        for request_class, queue in enumerate(self.queues):
+            stats = self.stats[request_class]
+            while queue:
+                if not queue[0].fans:
+                    # All its fans were taken by more important reads, so it was merged into them
+                    queue.popleft()
+                    stats.deferred -= 1
+                    stats.merged += 1
+                    continue
+                if limit and request_class != self.Class_Safety and \
+                   self.calls_per_tick and self.calls >= self.calls_per_tick:
+                    return True
+                request = queue.popleft()
+                if request.read:
+                    for fan in request.fans:
+                        del self.reads[fan.fan_id]
+                wait = now - request.queued
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                stats.run += 1
+                request.operation(request.fans)
+        return False
+
+    def discard(self, fan):
+        """
+        Remove a fan which has gone away from the waiting requests.
+        """
+        for queue in self.queues:
+            for request in list(queue):
+                if fan in request.fans:
+                    request.fans.remove(fan)
+                    if not request.fans:
+                        queue.remove(request)
+        self.reads.pop(fan.fan_id, None)
@@ -0,0 +1,93 @@
+"""
+Test that the calls to a driver are scheduled in order of their class.
+"""
+
+import unittest
+
+from .fanclock import VirtualClock
+from .fanqueue import DriverQueue
+
+
+class FakeFan(object):
+
+    def __init__(self, fan_id):
+        self.fan_id = fan_id
+
+
+class TestDriverQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.queue = DriverQueue(self.clock.monotonic, calls_per_tick=2, tick_time=1.0)
+        self.calls = []
+        self.fans = [FakeFan(fan_id) for fan_id in range(1, 6)]
+
+    def operation(self, name):
+        def call(fans):
+            self.queue.called()
+            self.calls.append((name, [fan.fan_id for fan in fans]))
+        return call
+
+    def test_limited_per_tick(self):
+        for index in range(3):
+            self.queue.submit(DriverQueue.Class_Control, self.operation(index), self.fans[index:index + 1])
+        self.assertEqual([name for name, fans in self.calls], [0, 1])
+        self.assertEqual(self.queue.depth(DriverQueue.Class_Control), 1)
+
+        # Nothing more may run until the next tick
+        self.assertTrue(self.queue.run())
+        self.clock.sleep(1.0)
+        self.assertFalse(self.queue.run())
+        self.assertEqual([name for name, fans in self.calls], [0, 1, 2])
+        stats = self.queue.stats[DriverQueue.Class_Control]
+        self.assertEqual((stats.submitted, stats.run, stats.deferred), (3, 3, 1))
+        self.assertEqual(stats.max_wait, 1.0)
+
+    def test_priority(self):
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[:1])
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[1:2])
+        self.queue.submit(DriverQueue.Class_Interactive, self.operation('list'), self.fans[:1], read=True)
+        self.queue.submit(DriverQueue.Class_Sampling, self.operation('sample'), self.fans[2:3], read=True)
+        # Safety writes are never held back
+        self.queue.submit(DriverQueue.Class_Safety, self.operation('safety'), self.fans[3:4])
+        self.assertEqual([name for name, fans in self.calls], ['control', 'control', 'safety'])
+
+        self.clock.sleep(1.0)
+        self.queue.run()
+        self.assertEqual([name for name, fans in self.calls[3:]], ['sample', 'list'])
+
+    def test_reads_merged(self):
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[:2])
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[:2])
+        self.queue.submit(DriverQueue.Class_Interactive, self.operation('list'), self.fans[:3], read=True)
+        # The sampling read takes the fans it shares from the waiting interactive read
+        self.queue.submit(DriverQueue.Class_Sampling, self.operation('sample'), self.fans[1:3], read=True)
+        self.queue.submit(DriverQueue.Class_Interactive, self.operation('again'), self.fans[2:3], read=True)
+
+        self.clock.sleep(1.0)
+        self.queue.run()
+        self.assertEqual(self.calls[2:], [('sample', [2, 3]), ('list', [1])])
+        self.assertEqual(self.queue.stats[DriverQueue.Class_Interactive].merged, 1)
+        self.assertEqual(self.queue.reads, {})
+
+    def test_discard(self):
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[:2])
+        self.queue.submit(DriverQueue.Class_Control, self.operation('control'), self.fans[:2])
+        self.queue.submit(DriverQueue.Class_Sampling, self.operation('sample'), self.fans[:1], read=True)
+        self.queue.submit(DriverQueue.Class_Sampling, self.operation('sample'), self.fans[:2], read=True)
+        self.queue.discard(self.fans[0])
+        self.assertEqual(len(self.queue), 1)
+
+        self.clock.sleep(1.0)
+        self.queue.run()
+        self.assertEqual(self.calls[2:], [('sample', [2])])
+
+    def test_unlimited(self):
+        queue = DriverQueue(self.clock.monotonic)
+        for fan in self.fans:
+            self.assertTrue(queue.submit(DriverQueue.Class_Interactive, lambda fans: None, [fan]))
+        self.assertEqual(len(queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
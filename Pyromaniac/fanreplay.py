@@ -0,0 +1,256 @@
+"""
+Replay of recorded fan behaviour.
+
+A replay may be taken from a telemetry store directory (see fantelemetry), or
+from a replay file. A telemetry store replays one run of FanController (the
+latest, unless another is chosen), with each fan at the location it was
+first described with in that run. A replay file is a sequence of JSON objects, one per line.
+The file starts with the descriptions of the fans, in the same form as the
+telemetry store's 'fans.jsonl':
+
+    {"fan": {"location": <id>, "capabilities": <flags>, "accuracy": <accuracy>,
+             "maximum": <maximum>, "speeds": [<speed>, ...] or null}}
+
+These are followed by the events, in time order:
+
+    {"t": <seconds>, "location": <id>, "speed": <speed>}
+    {"t": <seconds>, "location": <id>, "latency": <seconds>}
+    {"t": <seconds>, "location": <id>, "error": [<error number>, <message>]}
+
+A speed event clears any error for the fan. An error event makes calls for the
+fan fail until the next speed event. A latency event sets the time that each
+call for the fan takes until the next latency event. Any of the keys may be
+combined in a single event.
+"""
+
+import json
+import os
+
+from .fantelemetry import TelemetryStore, read_segment
+
+
+class ReplayEvent(object):
+    __slots__ = ('t', 'location_id', 'speed', 'latency', 'error')
+
+    def __init__(self, t, location_id, speed=None, latency=None, error=None):
+        self.t = t
+        self.location_id = location_id
+        self.speed = speed
+        self.latency = latency
+        self.error = error
+
+    def __repr__(self):
+        return "<{}(t={}, location=&{:08x}, speed={}, latency={}, error={})>".format(self.__class__.__name__,
+                                                                                    self.t, self.location_id,
+                                                                                    self.speed, self.latency,
+                                                                                    self.error)
+
+
+class ReplayFileSource(object):
+    """
+    Replay from a JSON lines replay file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, self.filename)
+
+    def fans(self):
+        """
+        Read the fan descriptions from the start of the file.
+        """
+        with open(self.filename, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'fan' not in record:
+                    break
+                yield record['fan']
+
+    def events(self):
+        with open(self.filename, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'fan' in record:
+                    continue
+                yield ReplayEvent(record['t'], record['location'],
+                                  speed=record.get('speed', None),
+                                  latency=record.get('latency', None),
+                                  error=record.get('error', None))
+
+
+class TelemetryReplaySource(object):
+    """
+    Replay from the raw samples of one run in a telemetry store.
+    """
+
+    def __init__(self, directory, run=None):
+        """
+        @param directory:   telemetry store directory
+        @param run:         run to replay, or None for the latest run in the store
+        """
+        self.directory = directory
+        self.run = run
+
+    def __repr__(self):
+        return "<{}({}, run={})>".format(self.__class__.__name__, self.directory, self.run)
+
+    def series(self):
+        """
+        Find the series of the fans in the run replayed.
+
+        @return: dictionary of the first description of each series in the run, keyed by series
+        """
+        series = TelemetryStore.read_series(self.directory)
+        run = self.run
+        if run is None:
+            run = max([descriptions[0].get('run', 0) for descriptions in series.values()] or [0])
+        first = {}
+        for number, descriptions in series.items():
+            # Series which were never described (because nothing was known about the fan)
+            # have nowhere to be replayed
+            described = [description for description in descriptions if 'location' in description]
+            if described and described[0].get('run', 0) == run:
+                first[number] = described[0]
+        return first
+
+    def fans(self):
+        return [description for description in sorted(self.series().values(),
+                                                      key=lambda description: description['location'])]
+
+    def events(self):
+        # The samples are recorded by series; the replay is by location
+        locations = dict((number, description['location']) for number, description in self.series().items())
+        for base_ms, filename in TelemetryStore.list_segments(self.directory, 0):
+            for (series, timestamp_ms, values) in read_segment(filename, 1):
+                location_id = locations.get(series, None)
+                if location_id is not None:
+                    yield ReplayEvent(timestamp_ms / 1000.0, location_id, speed=values[0])
+
+
+def replay_source(path):
+    """
+    Create a replay source for a telemetry store directory or replay file.
+    """
+    if os.path.isdir(path):
+        return TelemetryReplaySource(path)
+    return ReplayFileSource(path)
+
+
+class ReplayState(object):
+    """
+    The current recorded state of a fan.
+    """
+    __slots__ = ('speed', 'latency', 'error')
+
+    def __init__(self):
+        self.speed = None
+        self.latency = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<{}(speed={}, latency={}, error={})>".format(self.__class__.__name__,
+                                                             self.speed, self.latency, self.error)
+
+
+class ReplayTimeline(object):
+    """
+    Steps through the recorded events, streaming them from the source.
+
+    With a rate of 0, the replay runs as fast as possible: it moves on to the next
+    timestamp in the recording each time a fan which has already been read at the
+    current timestamp is read again, so each sweep of the fans sees one step of the
+    recording, however many fans there are. Otherwise the recording is replayed
+    against the clock, scaled by the rate.
+    """
+
+    def __init__(self, source, clock, rate=1.0):
+        """
+        @param source:  ReplayFileSource or TelemetryReplaySource to replay
+        @param clock:   function returning the time in seconds
+        @param rate:    rate to replay at, relative to the clock, or 0 for as fast as possible
+        """
+        self.source = source
+        self.rate = rate
+        self.clock = clock
+        self.events = None
+        self.next_event = None
+        self.start_time = None
+        self.start_t = None
+        # Current state, keyed by location id
+        self.states = {}
+        # Locations read at the current timestamp, when replaying as fast as possible
+        self.read = set()
+
+    def __repr__(self):
+        return "<{}({!r}, rate={})>".format(self.__class__.__name__, self.source, self.rate)
+
+    @property
+    def finished(self):
+        return self.events is not None and self.next_event is None
+
+    def start(self):
+        self.events = self.source.events()
+        self.next_event = next(self.events, None)
+        self.start_time = self.clock()
+        self.start_t = self.next_event.t if self.next_event else 0
+        self.states = {}
+        self.read = set()
+        # Make sure that the initial state is known before anyone asks for it
+        self.step(self.next_event.t if self.next_event else 0)
+
+    def apply(self, event):
+        state = self.states.get(event.location_id, None)
+        if not state:
+            state = ReplayState()
+            self.states[event.location_id] = state
+        if event.speed is not None:
+            state.speed = event.speed
+            state.error = None
+        if event.latency is not None:
+            state.latency = event.latency
+        if event.error is not None:
+            state.error = event.error
+
+    def advance(self, location_ids=()):
+        """
+        Apply the events which are due.
+
+        @param location_ids: locations of the fans being read, in one call to the driver
+        """
+        if self.events is None:
+            self.start()
+        if not self.next_event:
+            return
+
+        if self.rate:
+            self.step(self.start_t + (self.clock() - self.start_time) * self.rate)
+        elif location_ids:
+            if not self.read.isdisjoint(location_ids):
+                # A new sweep of the fans has started
+                self.read = set()
+                self.step(self.next_event.t)
+            self.read.update(location_ids)
+
+    def step(self, now_t):
+        """
+        Apply the events up to a time in the recording.
+        """
+        while self.next_event and self.next_event.t <= now_t:
+            self.apply(self.next_event)
+            self.next_event = next(self.events, None)
+
+    def state(self, location_id):
+        """
+        Read the recorded state of a fan.
+
+        @return: ReplayState, or None if nothing has been recorded for the fan yet
+        """
+        return self.states.get(location_id, None)
@@ -0,0 +1,93 @@
+"""
+Test that recordings are replayed properly.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from .fanreplay import ReplayFileSource, ReplayTimeline, TelemetryReplaySource
+from .fantelemetry import TelemetryStore
+
+
+class TestReplaySources(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_file(self):
+        filename = os.path.join(self.directory, 'replay')
+        with open(filename, 'w') as fh:
+            for record in ({'fan': {'location': 0x100, 'capabilities': 1, 'accuracy': 10,
+                                    'maximum': 5000, 'speeds': None}},
+                           {'t': 0.5, 'location': 0x100, 'speed': 2000},
+                           {'t': 1.0, 'location': 0x100, 'error': [1, 'Failed']}):
+                fh.write(json.dumps(record) + '\n')
+        source = ReplayFileSource(filename)
+        self.assertEqual([fan['location'] for fan in source.fans()], [0x100])
+        events = list(source.events())
+        self.assertEqual([(event.t, event.speed, event.error) for event in events],
+                         [(0.5, 2000, None), (1.0, None, [1, 'Failed'])])
+
+    def record_runs(self):
+        # Two runs, in which fan 1 is at different locations, and which share location &200
+        store = TelemetryStore(self.directory)
+        store.describe(1, 0x100, 1, 10, 5000, None, 1000)
+        store.describe(2, 0x200, 1, 10, 5000, None, 1000)
+        store.sample(1, 1000, 1000)
+        store.sample(2, 1000, 1500)
+        store.close()
+        store = TelemetryStore(self.directory)
+        store.describe(1, 0x200, 1, 10, 5000, None, 5000)
+        store.sample(1, 5000, 3000)
+        store.describe(1, 0x300, 1, 10, 5000, None, 6000)
+        store.sample(1, 6000, 3100)
+        store.close()
+
+    def test_latest_run(self):
+        self.record_runs()
+        source = TelemetryReplaySource(self.directory)
+        self.assertEqual([fan['location'] for fan in source.fans()], [0x200])
+        # The fan stays at the location it was registered with, and only this run's samples are seen
+        self.assertEqual([(event.t, event.location_id, event.speed) for event in source.events()],
+                         [(5.0, 0x200, 3000), (6.0, 0x200, 3100)])
+
+    def test_earlier_run(self):
+        self.record_runs()
+        source = TelemetryReplaySource(self.directory, run=1)
+        self.assertEqual([fan['location'] for fan in source.fans()], [0x100, 0x200])
+        self.assertEqual(sorted((event.location_id, event.speed) for event in source.events()),
+                         [(0x100, 1000), (0x200, 1500)])
+
+
+class TestReplayTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'replay')
+        with open(self.filename, 'w') as fh:
+            fh.write(json.dumps({'fan': {'location': 0x100, 'capabilities': 1, 'accuracy': 10,
+                                         'maximum': 5000, 'speeds': None}}) + '\n')
+            for t, speed in ((0.0, 1000), (1.0, 2000), (2.0, 3000)):
+                fh.write(json.dumps({'t': t, 'location': 0x100, 'speed': speed}) + '\n')
+        self.now = 0.0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_follows_clock(self):
+        timeline = ReplayTimeline(ReplayFileSource(self.filename), lambda: self.now)
+        speeds = []
+        for self.now in (0.0, 0.5, 1.0, 1.5, 2.5):
+            timeline.advance()
+            speeds.append(timeline.state(0x100).speed)
+        self.assertEqual(speeds, [1000, 1000, 2000, 2000, 3000])
+
+
+if __name__ == '__main__':
+    unittest.main()
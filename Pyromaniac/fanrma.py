@@ -0,0 +1,101 @@
+"""
+Accounting for the RMA blocks allocated by the fan modules.
+"""
+
+import weakref
+
+
+# Accounts for each RISC OS instance, keyed by the instance and then by the owner name
+_accounts = weakref.WeakKeyDictionary()
+
+
+class RMAPurpose(object):
+    """
+    Counters for the blocks allocated for one purpose.
+    """
+    __slots__ = ('allocations', 'frees', 'live', 'live_bytes')
+
+    def __init__(self):
+        self.allocations = 0
+        self.frees = 0
+        self.live = 0
+        self.live_bytes = 0
+
+    def __repr__(self):
+        return "<{}({} allocations, {} frees, {} live blocks, {} bytes)>".format(self.__class__.__name__,
+                                                                                 self.allocations, self.frees,
+                                                                                 self.live, self.live_bytes)
+
+
+class RMAAccount(object):
+    """
+    Allocates RMA blocks on behalf of an owner, recording what they were for.
+    """
+
+    def __init__(self, ro, owner):
+        self.ro = ro
+        self.owner = owner
+        # Live blocks: (purpose, size), keyed by the address of the block
+        self.blocks = {}
+        # RMAPurpose, keyed by the purpose name
+        self.purposes = {}
+
+    def __repr__(self):
+        return "<{}({}, {} live blocks)>".format(self.__class__.__name__, self.owner, len(self.blocks))
+
+    @classmethod
+    def get(cls, ro, owner):
+        """
+        Find the account for an owner, creating it if necessary.
+
+        Accounts persist for the life of the RISC OS instance, so that the counts are
+        retained across reinitialisation of the modules.
+        """
+        accounts = _accounts.setdefault(ro, {})
+        account = accounts.get(owner, None)
+        if not account:
+            account = cls(ro, owner)
+            accounts[owner] = account
+        return account
+
+    @staticmethod
+    def all(ro):
+        """
+        List the accounts for a RISC OS instance.
+        """
+        return [account for owner, account in sorted(_accounts.get(ro, {}).items())]
+
+    def _record(self, block, purpose, size):
+        self.blocks[block.address] = (purpose, size)
+        counts = self.purposes.get(purpose, None)
+        if not counts:
+            counts = RMAPurpose()
+            self.purposes[purpose] = counts
+        counts.allocations += 1
+        counts.live += 1
+        counts.live_bytes += size
+        return block
+
+    def allocate(self, size, purpose):
+        block = self.ro.kernel.da_rma.allocate(size)
+        return self._record(block, purpose, size)
+
+    def strdup(self, string, purpose):
+        block = self.ro.kernel.da_rma.strdup(string)
+        return self._record(block, purpose, len(string) + 1)
+
+    def free(self, block):
+        (purpose, size) = self.blocks.pop(block.address)
+        counts = self.purposes[purpose]
+        counts.frees += 1
+        counts.live -= 1
+        counts.live_bytes -= size
+        block.free()
+
+    @property
+    def live(self):
+        return len(self.blocks)
+
+    @property
+    def allocations(self):
+        return sum(counts.allocations for counts in self.purposes.values())
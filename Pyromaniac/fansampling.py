@@ -0,0 +1,90 @@
+"""
+Adaptive sampling of the fan speeds.
+
+Each fan is sampled on a period of a number of sampler ticks. While a fan's
+readings stay within its accuracy of the previous reading, its period is
+doubled (up to a limit); when the reading changes, or the fan is changed or
+reports a change of state, it returns to being sampled on every tick.
+"""
+
+
+class AdaptiveSampling(object):
+    """
+    Decides which fans are due to be sampled on each tick.
+    """
+
+    def __init__(self, max_period=64):
+        """
+        @param max_period:  largest number of ticks between the samples of a steady fan
+        """
+        self.max_period = max(1, max_period)
+        self.tick = 0
+        # Number of times a fan was sampled, or was skipped because it was steady
+        self.sampled_count = 0
+        self.skipped_count = 0
+
+    def __repr__(self):
+        return "<{}(tick={}, {} sampled, {} skipped)>".format(self.__class__.__name__, self.tick,
+                                                              self.sampled_count, self.skipped_count)
+
+    def due(self, fans):
+        """
+        Advance to the next tick, and find the fans which should be sampled.
+
+        @return: list of the fans to sample
+        """
+        self.tick += 1
+        due = []
+        for fan in fans:
+            if fan.sample_next <= self.tick:
+                due.append(fan)
+            else:
+                self.skipped_count += 1
+        return due
+
+    def sampled(self, fan, timestamp, speed):
+        """
+        Record the sample of a fan, and decide when it should next be sampled.
+        """
+        previous = fan.sample_speed
+        if previous is None:
+            steady = False
+        elif speed < 0 or previous < 0:
+            # States must be the same to be steady
+            steady = speed == previous
+        else:
+            steady = abs(speed - previous) <= fan.accuracy
+
+        if steady:
+            fan.sample_period = min(fan.sample_period * 2, self.max_period)
+        else:
+            fan.sample_period = 1
+        fan.sample_speed = speed
+        fan.sample_next = self.tick + fan.sample_period
+
+        if not fan.samples:
+            fan.sample_since = timestamp
+        fan.samples += 1
+        self.sampled_count += 1
+
+    def failed(self, fan):
+        """
+        Record that a fan could not be sampled; we try again after its current period.
+        """
+        fan.sample_next = self.tick + fan.sample_period
+
+    @staticmethod
+    def rate(fan, now):
+        """
+        Effective rate at which a fan has been sampled.
+
+        @param now:     current time, from the same clock as the sample timestamps
+
+        @return: samples per second, or 0 if not known
+        """
+        if fan.samples < 2:
+            return 0
+        elapsed = now - fan.sample_since
+        if elapsed <= 0:
+            return 0
+        return (fan.samples - 1) / elapsed
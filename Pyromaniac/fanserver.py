@@ -0,0 +1,271 @@
+"""
+Host-side server streaming FanController events over a Unix domain socket.
+
+The server runs an asyncio event loop on its own thread. The emulation thread
+only appends events to a queue and wakes the loop, so it never waits for a
+client. Each subscriber has its own bounded queue; if a subscriber cannot keep
+up, events for it are dropped and counted rather than slowing anyone else.
+
+On connecting, a client may send a line containing 'binary' to select the
+binary framing; otherwise (or if nothing is sent within a short time) events
+are sent as newline-delimited JSON objects:
+
+    {"event": "added", "fan": <id>, "location": <id>, "capabilities": <flags>}
+    {"event": "removed", "fan": <id>}
+    {"event": "state", "fan": <id>, "state": <state>}
+    {"event": "sample", "fan": <id>, "location": <id>, "speed": <speed>, "time": <ms>}
+    {"event": "dropped", "count": <events dropped since the last notice>}
+
+In the binary framing each event is a 16bit little-endian length of the
+frame body, followed by the body: an 8bit event type, then little-endian
+fields:
+
+    1 (added):      fan id (u32), location (u32), capabilities (u32)
+    2 (removed):    fan id (u32)
+    3 (state):      fan id (u32), state (s32)
+    4 (sample):     fan id (u32), location (u32), speed (s32), time in ms (u64)
+    5 (dropped):    count (u32)
+"""
+
+import asyncio
+import collections
+import json
+import os
+import struct
+import threading
+
+from riscos.errors import RISCOSSyntheticError
+
+from .constants import FanConstants
+
+
+class FanEvent(object):
+    """
+    An event to send to the subscribers.
+    """
+    __slots__ = ('kind', 'fields')
+
+    Kind_Added = 1
+    Kind_Removed = 2
+    Kind_State = 3
+    Kind_Sample = 4
+    Kind_Dropped = 5
+
+    kind_names = {
+            Kind_Added: 'added',
+            Kind_Removed: 'removed',
+            Kind_State: 'state',
+            Kind_Sample: 'sample',
+            Kind_Dropped: 'dropped',
+        }
+    # Names of the fields for each kind, and their binary encoding
+    kind_fields = {
+            Kind_Added: (('fan', 'location', 'capabilities'), struct.Struct('<BIII')),
+            Kind_Removed: (('fan',), struct.Struct('<BI')),
+            Kind_State: (('fan', 'state'), struct.Struct('<BIi')),
+            Kind_Sample: (('fan', 'location', 'speed', 'time'), struct.Struct('<BIIiQ')),
+            Kind_Dropped: (('count',), struct.Struct('<BI')),
+        }
+    length = struct.Struct('<H')
+
+    def __init__(self, kind, *fields):
+        self.kind = kind
+        self.fields = fields
+
+    def __repr__(self):
+        return "<{}({}, {})>".format(self.__class__.__name__, self.kind_names[self.kind], self.fields)
+
+    def json(self):
+        (names, _) = self.kind_fields[self.kind]
+        event = collections.OrderedDict(event=self.kind_names[self.kind])
+        event.update(zip(names, self.fields))
+        return (json.dumps(event) + '\n').encode('utf-8')
+
+    def binary(self):
+        (_, encoding) = self.kind_fields[self.kind]
+        body = encoding.pack(self.kind, *self.fields)
+        return self.length.pack(len(body)) + body
+
+
+class Subscriber(object):
+    """
+    A connected client, with its own queue of events.
+    """
+
+    def __init__(self, writer, queue_length):
+        self.writer = writer
+        self.binary = False
+        self.queue = asyncio.Queue(maxsize=queue_length)
+        self.sent = 0
+        self.dropped = 0
+        # Drops which the client has not yet been told about
+        self.unreported = 0
+
+    def __repr__(self):
+        return "<{}({} sent, {} dropped)>".format(self.__class__.__name__, self.sent, self.dropped)
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.unreported += 1
+
+    def encode(self, event):
+        return event.binary() if self.binary else event.json()
+
+
+class TelemetryServer(object):
+    """
+    Serves the FanController events to any number of subscribers.
+    """
+    # Time to wait for a client to select its format
+    handshake_timeout = 0.5
+    # Time to wait for the server to start listening
+    start_timeout = 5.0
+
+    def __init__(self, ro, path, queue_length=1024, initial=None):
+        """
+        @param ro:              RISC OS instance
+        @param path:            path of the Unix domain socket to listen on
+        @param queue_length:    number of events which may wait for each subscriber, and
+                                for the loop to distribute them
+        @param initial:         function returning the events to send to a new subscriber,
+                                called on the server thread
+        """
+        self.ro = ro
+        self.path = path
+        self.queue_length = queue_length
+        self.initial = initial
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.subscribers = set()
+        # Events published by the emulation thread, waiting for the loop to distribute them
+        self.incoming = collections.deque()
+        # Events dropped because the loop had not distributed the incoming events (counted
+        # only by the emulation thread), and how many of them the subscribers have been told about
+        self.dropped = 0
+        self.reported = 0
+        self.wake_pending = False
+        self.started = threading.Event()
+        # Exception raised when the server could not be started
+        self.error = None
+
+    def __repr__(self):
+        return "<{}({}, {} subscribers)>".format(self.__class__.__name__, self.path, len(self.subscribers))
+
+    def start(self):
+        """
+        Start the server thread, and wait for it to listen on the socket.
+        """
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        except OSError as exc:
+            self.error = exc
+        else:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.run, name='FanController telemetry server')
+            self.thread.daemon = True
+            self.thread.start()
+            if not self.started.wait(self.start_timeout):
+                self.error = "timed out"
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+        if self.error:
+            self.loop = None
+            self.thread = None
+            raise RISCOSSyntheticError(self.ro, FanConstants.ErrorNumber_InitFailed,
+                                       "Could not start the telemetry server on '{}': {}".format(self.path,
+                                                                                                self.error))
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_unix_server(self.client, path=self.path))
+        except Exception as exc:
+            # Reported by start(), on the emulation thread
+            self.error = exc
+            self.loop.close()
+            return
+        finally:
+            self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(self.server.wait_closed(), *tasks,
+                                                        return_exceptions=True))
+            self.loop.close()
+
+    def stop(self):
+        if not self.loop:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+        self.thread = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, event):
+        """
+        Queue an event for the subscribers. Called from the emulation thread; never blocks.
+        """
+        if not self.subscribers:
+            return
+        if len(self.incoming) >= self.queue_length:
+            # The loop is not keeping up, so drop the event for everyone
+            self.dropped += 1
+            return
+        self.incoming.append(event)
+        if not self.wake_pending:
+            self.wake_pending = True
+            self.loop.call_soon_threadsafe(self.distribute)
+
+    def distribute(self):
+        self.wake_pending = False
+        dropped = self.dropped
+        if dropped != self.reported:
+            unreported = dropped - self.reported
+            self.reported = dropped
+            for subscriber in self.subscribers:
+                subscriber.dropped += unreported
+                subscriber.unreported += unreported
+        incoming = self.incoming
+        while incoming:
+            event = incoming.popleft()
+            for subscriber in self.subscribers:
+                subscriber.offer(event)
+
+    async def client(self, reader, writer):
+        subscriber = Subscriber(writer, self.queue_length)
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.handshake_timeout)
+            subscriber.binary = line.strip().lower() == b'binary'
+        except asyncio.TimeoutError:
+            pass
+
+        self.subscribers.add(subscriber)
+        if self.initial:
+            for event in self.initial():
+                subscriber.offer(event)
+        try:
+            while True:
+                event = await subscriber.queue.get()
+                if subscriber.unreported:
+                    writer.write(subscriber.encode(FanEvent(FanEvent.Kind_Dropped, subscriber.unreported)))
+                    subscriber.unreported = 0
+                writer.write(subscriber.encode(event))
+                subscriber.sent += 1
+                # Only this subscriber waits for its client to catch up
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            writer.close()
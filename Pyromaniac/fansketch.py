@@ -0,0 +1,280 @@
+"""
+Quantile sketches of the fan speeds.
+
+Each sketch counts the samples in logarithmically sized bins, in the manner
+of DDSketch: a sample falls in bin ceil(log(speed) / log(gamma)), so every
+speed reported from a sketch is within the relative accuracy of a sample
+that was actually seen. Sketches with the same accuracy merge by adding
+their bin counts, and the number of bins is limited, so a sketch takes the
+same memory however many samples it holds.
+
+Speeds given as a percentage and speeds in RPM are kept in separate sketches,
+because they cannot be compared. Sketches are kept for each fan, and for the
+zone (device and location) that the fan was in when sampled, in windows of
+time; percentiles for a group of fans are found by merging the sketches of
+their zones or of the fans, rather than by sorting samples.
+"""
+
+import math
+
+from .constants import FanConstants
+
+
+class QuantileSketch(object):
+    """
+    Mergeable sketch of the distribution of a set of values.
+    """
+
+    def __init__(self, accuracy=0.01, max_bins=1024):
+        """
+        @param accuracy:    relative accuracy of the values reported
+        @param max_bins:    largest number of bins; when exceeded, the lowest bins are combined
+        """
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        # Counts of the samples in each bin, keyed by the bin index
+        self.bins = {}
+        # Samples which were zero, which have no logarithm
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def __repr__(self):
+        return "<{}({} samples, {} bins)>".format(self.__class__.__name__, self.count, len(self.bins))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[index] = self.bins.get(index, 0) + 1
+            if len(self.bins) > self.max_bins:
+                self.collapse()
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def collapse(self):
+        """
+        Combine the lowest bins, so that there are no more than max_bins.
+        """
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        if excess <= 0:
+            return
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def merge(self, other):
+        """
+        Add the samples of another sketch, with the same accuracy, to this one.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Sketches with different accuracies cannot be merged")
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+        if len(bins) > self.max_bins:
+            self.collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """
+        Find the value at a quantile.
+
+        @param q:   quantile, from 0 to 1
+
+        @return: the value, or None if there are no samples
+        """
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # The middle of the bin, in the sense that minimises the relative error
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class SpeedSketch(object):
+    """
+    Sketches of the speeds given as percentages, and of the speeds in RPM.
+    """
+    __slots__ = ('percent', 'rpm')
+
+    def __init__(self):
+        self.percent = None
+        self.rpm = None
+
+    def __repr__(self):
+        return "<{}(percent={!r}, rpm={!r})>".format(self.__class__.__name__, self.percent, self.rpm)
+
+    def add(self, speed, accuracy):
+        if speed <= 100:
+            if not self.percent:
+                self.percent = QuantileSketch(accuracy)
+            self.percent.add(speed)
+        else:
+            if not self.rpm:
+                self.rpm = QuantileSketch(accuracy)
+            self.rpm.add(speed)
+
+    def merge(self, other):
+        for name in self.__slots__:
+            sketch = getattr(other, name)
+            if sketch:
+                mine = getattr(self, name)
+                if not mine:
+                    mine = QuantileSketch(sketch.accuracy)
+                    setattr(self, name, mine)
+                mine.merge(sketch)
+
+
+class FanSketches(object):
+    """
+    Sketches of the speeds of each fan and each zone, in windows of time.
+
+    Given each sample, through its sample(fan, timestamp, speed) method.
+    """
+    # Parts of the location id that sketches may be grouped by
+    Field_Device = FanConstants.FanType_Device_Mask << FanConstants.FanType_Device_Shift
+    Field_Lateral = (FanConstants.FanType_Location_Space_LateralMask
+                     << FanConstants.FanType_Location_Space_LateralShift) << FanConstants.FanType_Location_Shift
+    Field_Longitudinal = (FanConstants.FanType_Location_Space_LongitudinalMask
+                          << FanConstants.FanType_Location_Space_LongitudinalShift) << FanConstants.FanType_Location_Shift
+    Field_Vertical = (FanConstants.FanType_Location_Space_VerticalMask
+                      << FanConstants.FanType_Location_Space_VerticalShift) << FanConstants.FanType_Location_Shift
+    Field_Sequence = FanConstants.FanType_Sequence_Mask << FanConstants.FanType_Sequence_Shift
+    field_names = {
+            'device': Field_Device,
+            'lateral': Field_Lateral,
+            'longitudinal': Field_Longitudinal,
+            'vertical': Field_Vertical,
+        }
+
+    def __init__(self, window=3600, windows=24, accuracy=0.01):
+        """
+        @param window:      length of each window, in seconds
+        @param windows:     number of windows to keep for each fan and zone
+        @param accuracy:    relative accuracy of the speeds reported
+        """
+        self.window = window
+        self.windows = windows
+        self.accuracy = accuracy
+        # SpeedSketches for each window, keyed by fan_id or by zone, and then by the window number
+        self.fans = {}
+        self.zones = {}
+        self.samples = 0
+
+    def __repr__(self):
+        return "<{}({} fans, {} zones, {} samples)>".format(self.__class__.__name__, len(self.fans),
+                                                            len(self.zones), self.samples)
+
+    @classmethod
+    def zone_key(cls, location_id):
+        return location_id & ~cls.Field_Sequence & 0xFFFFFFFF
+
+    def window_number(self, timestamp):
+        return int(timestamp // self.window)
+
+    def sketch(self, table, key, number):
+        windows = table.get(key, None)
+        if windows is None:
+            windows = {}
+            table[key] = windows
+        sketch = windows.get(number, None)
+        if sketch is None:
+            sketch = SpeedSketch()
+            windows[number] = sketch
+            # Drop the windows which are too old to keep
+            for old in [old for old in windows if old <= number - self.windows]:
+                del windows[old]
+        return sketch
+
+    def sample(self, fan, timestamp, speed):
+        speed &= 0xFFFFFFFF
+        if speed & 0x80000000 or speed == FanConstants.FanSpeed_Automatic:
+            # States, and automatic speeds, are not speeds
+            return
+        number = self.window_number(timestamp)
+        self.sketch(self.fans, fan.fan_id, number).add(speed, self.accuracy)
+        self.sketch(self.zones, self.zone_key(fan.location_id), number).add(speed, self.accuracy)
+        self.samples += 1
+
+    def forget(self, fan_id):
+        """
+        Discard the sketches of a fan which has gone; its samples remain in its zone.
+        """
+        self.fans.pop(fan_id, None)
+
+    def merged(self, windows_list, now, windows=0):
+        """
+        Merge the sketches in the latest windows.
+
+        @param windows_list:    iterable of dictionaries of SpeedSketches keyed by window number
+        @param now:             the current time
+        @param windows:         number of windows to merge, counting back from the current
+                                window, or 0 for all that are kept
+
+        @return: merged SpeedSketch
+        """
+        latest = self.window_number(now)
+        oldest = latest - (windows or self.windows) + 1
+        result = SpeedSketch()
+        for sketches in windows_list:
+            for number, sketch in sketches.items():
+                if oldest <= number <= latest:
+                    result.merge(sketch)
+        return result
+
+    def fan_sketch(self, fan_ids, now, windows=0):
+        """
+        @return: merged SpeedSketch for a number of fans
+        """
+        return self.merged((self.fans[fan_id] for fan_id in fan_ids if fan_id in self.fans),
+                           now, windows)
+
+    def location_sketch(self, value, mask, now, windows=0):
+        """
+        @return: merged SpeedSketch for the zones whose location matches a value under a mask
+        """
+        value &= mask
+        return self.merged((sketches for zone, sketches in self.zones.items() if zone & mask == value),
+                           now, windows)
+
+    def grouped(self, fields, now, windows=0):
+        """
+        Merge the sketches of the zones, grouped by parts of their location.
+
+        @param fields:  mask of the location id fields to group by
+
+        @return: dictionary of merged SpeedSketches, keyed by the grouped location
+        """
+        groups = {}
+        for zone in self.zones:
+            groups.setdefault(zone & fields, []).append(self.zones[zone])
+        return dict((key, self.merged(sketches_list, now, windows))
+                    for key, sketches_list in groups.items())
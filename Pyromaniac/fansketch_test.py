@@ -0,0 +1,115 @@
+"""
+Test that the quantile sketches report speeds within their accuracy.
+"""
+
+import random
+import unittest
+
+from .constants import FanConstants
+from .fansketch import QuantileSketch, FanSketches
+
+
+class FakeFan(object):
+
+    def __init__(self, fan_id, location_id):
+        self.fan_id = fan_id
+        self.location_id = location_id
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    quantiles = (0.01, 0.25, 0.5, 0.75, 0.9, 0.99)
+
+    def assertWithinAccuracy(self, sketch, values):
+        for q in self.quantiles:
+            expected = exact_quantile(values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - expected), expected * sketch.accuracy * 1.0001,
+                                 "quantile {}".format(q))
+
+    def test_accuracy(self):
+        rng = random.Random(1)
+        values = [rng.randint(300, 6000) for _ in range(5000)]
+        sketch = QuantileSketch(accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+        self.assertWithinAccuracy(sketch, values)
+        self.assertEqual((sketch.quantile(0), sketch.quantile(1)), (min(values), max(values)))
+
+    def test_merge(self):
+        rng = random.Random(2)
+        first = [rng.randint(1, 100) for _ in range(1000)]
+        second = [rng.randint(50, 100) for _ in range(3000)]
+        (sketch, other) = (QuantileSketch(), QuantileSketch())
+        for value in first:
+            sketch.add(value)
+        for value in second:
+            other.add(value)
+        sketch.merge(other)
+        self.assertEqual(sketch.count, 4000)
+        self.assertWithinAccuracy(sketch, first + second)
+
+        with self.assertRaises(ValueError):
+            sketch.merge(QuantileSketch(accuracy=0.05))
+
+    def test_zeros(self):
+        sketch = QuantileSketch()
+        for value in (0, 0, 0, 1000):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.quantile(1), 1000)
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+    def test_bins_limited(self):
+        sketch = QuantileSketch(max_bins=16)
+        for value in range(1, 10000, 7):
+            sketch.add(value)
+        self.assertLessEqual(len(sketch.bins), 16)
+        # The highest values keep their accuracy
+        self.assertLessEqual(abs(sketch.quantile(0.99) - 9800), 9800 * 0.0101)
+
+
+class TestFanSketches(unittest.TestCase):
+
+    def location(self, device, sequence):
+        return (device << FanConstants.FanType_Device_Shift) | (sequence << FanConstants.FanType_Sequence_Shift)
+
+    def test_zones_and_windows(self):
+        sketches = FanSketches(window=10, windows=3)
+        cpu = [FakeFan(1, self.location(FanConstants.FanType_Device_CPU, 0)),
+               FakeFan(2, self.location(FanConstants.FanType_Device_CPU, 1))]
+        gpu = FakeFan(3, self.location(FanConstants.FanType_Device_GPU, 0))
+        for second in range(40):
+            sketches.sample(cpu[0], second, 1000)
+            sketches.sample(cpu[1], second, 2000)
+            sketches.sample(gpu, second, 50)
+        # States and automatic speeds are not counted
+        sketches.sample(gpu, 39, FanConstants.FanState_Failed)
+        sketches.sample(gpu, 39, FanConstants.FanSpeed_Automatic)
+
+        grouped = sketches.grouped(FanSketches.Field_Device, 39)
+        cpu_zone = cpu[0].location_id & FanSketches.Field_Device
+        gpu_zone = gpu.location_id & FanSketches.Field_Device
+        # Only the last three windows are kept
+        self.assertEqual(grouped[cpu_zone].rpm.count, 60)
+        self.assertIsNone(grouped[cpu_zone].percent)
+        self.assertEqual(grouped[gpu_zone].percent.count, 30)
+
+        # Both CPU fans share a zone, as only their sequence differs
+        self.assertEqual(len(sketches.zones), 2)
+        merged = sketches.fan_sketch([1, 2], 39, windows=1)
+        self.assertEqual(merged.rpm.count, 20)
+        self.assertAlmostEqual(merged.rpm.quantile(0.25), 1000, delta=10)
+        self.assertAlmostEqual(merged.rpm.quantile(0.75), 2000, delta=20)
+
+        sketches.forget(1)
+        self.assertEqual(sketches.fan_sketch([1, 2], 39).rpm.count, 30)
+        self.assertEqual(sketches.location_sketch(cpu_zone, FanSketches.Field_Device, 39).rpm.count, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Immutable snapshots of the fan registry.
+
+The registry publishes a new generation whenever the set of fans (or their
+descriptions) change, and a snapshot of it is made when it is first read.
+A snapshot is never modified once it has been made, so threads other than
+the emulation thread may read it without any locking; they simply see the
+registry as it was at that generation.
+"""
+
+import collections
+import types
+
+
+FanRecord = collections.namedtuple('FanRecord', ('fan_id', 'location_id', 'capabilities', 'provider',
+                                                 'accuracy', 'maximum', 'speeds'))
+
+
+class FanSnapshot(object):
+    """
+    A consistent view of the registered fans.
+    """
+    __slots__ = ('generation', 'count', 'fans', 'records', 'by_id')
+
+    def __init__(self, generation, fans, count=None):
+        """
+        @param generation:  number which increases with each change to the fans
+        @param fans:        dictionary of the FanDescriptors, keyed by fan_id
+        @param count:       number of fans the registry had at this generation, or None
+                            for the number in the dictionary
+        """
+        self.generation = generation
+        self.count = len(fans) if count is None else count
+        # The fan descriptors, in fan_id order
+        self.fans = tuple(fan for fan_id, fan in sorted(fans.items()))
+        # Immutable records describing the fans, in fan_id order
+        self.records = tuple(FanRecord(fan.fan_id, fan.location_id, fan.capabilities, fan.provider,
+                                       fan.accuracy, fan.maximum,
+                                       tuple(fan.speeds) if fan.speeds else None)
+                             for fan in self.fans)
+        self.by_id = types.MappingProxyType(dict((record.fan_id, record) for record in self.records))
+
+    def __repr__(self):
+        return "<{}(generation={}, {} fans)>".format(self.__class__.__name__,
+                                                     self.generation, len(self.records))
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, fan_id):
+        """
+        Read the record for a fan.
+
+        @return: FanRecord, or None if the fan was not registered in this snapshot
+        """
+        return self.by_id.get(fan_id, None)
+
+    def consistent(self):
+        """
+        Check that the snapshot agrees with itself, and with the registry at its generation.
+
+        A snapshot made whilst the registry was being changed would hold a different number
+        of fans to the number the registry recorded for the generation.
+        """
+        if len(self.records) != self.count or len(self.fans) != self.count or len(self.by_id) != self.count:
+            return False
+        last_id = 0
+        for record in self.records:
+            if record.fan_id <= last_id or self.by_id.get(record.fan_id) is not record:
+                return False
+            last_id = record.fan_id
+        return True
@@ -0,0 +1,197 @@
+"""
+Statistics about the calls made to fan drivers.
+"""
+
+from .constants import FanConstants
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of call latencies, in fixed log2 buckets of microseconds.
+
+    Bucket 0 holds calls taking less than 1us, bucket n holds calls taking
+    between 2^(n-1) and 2^n us. The last bucket collects everything slower.
+    """
+    nbuckets = 24
+
+    def __init__(self):
+        self.buckets = [0] * self.nbuckets
+        self.count = 0
+        self.total = 0
+
+    def __repr__(self):
+        return "<{}({} calls, p50={}us, p99={}us)>".format(self.__class__.__name__,
+                                                           self.count,
+                                                           self.percentile(50),
+                                                           self.percentile(99))
+
+    def add(self, duration_us):
+        bucket = int(duration_us).bit_length()
+        if bucket >= self.nbuckets:
+            bucket = self.nbuckets - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += duration_us
+
+    def reset(self):
+        self.buckets = [0] * self.nbuckets
+        self.count = 0
+        self.total = 0
+
+    @staticmethod
+    def bucket_limit(bucket):
+        """
+        Upper limit of a bucket, in microseconds.
+        """
+        return 1 << bucket
+
+    def percentile(self, pct):
+        """
+        Upper bound of the latency, in us, below which `pct` percent of the calls fell.
+        """
+        if not self.count:
+            return 0
+        want = (self.count * pct + 99) // 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= want:
+                return self.bucket_limit(bucket)
+        return self.bucket_limit(self.nbuckets - 1)
+
+    def estimate(self, pct):
+        """
+        Latency, in us, below which `pct` percent of the calls fell, interpolated within
+        its bucket as if the calls in the bucket were spread evenly across it.
+        """
+        if not self.count:
+            return 0
+        want = self.count * pct / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            if count and seen + count >= want:
+                low = self.bucket_limit(bucket - 1) if bucket else 0
+                high = self.bucket_limit(bucket)
+                return low + (high - low) * (want - seen) / count
+            seen += count
+        return self.bucket_limit(self.nbuckets - 1)
+
+    def mean(self):
+        if not self.count:
+            return 0
+        return self.total / self.count
+
+
+class CallStats(object):
+    """
+    Counters for the calls made to a driver (or a single fan of a driver).
+    """
+    nreasons = FanConstants.FanDriver_SetSpeeds + 1
+
+    def __init__(self):
+        self.calls = [0] * self.nreasons
+        self.other_calls = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    def __repr__(self):
+        return "<{}({} calls, {} errors)>".format(self.__class__.__name__,
+                                                  self.total_calls, self.errors)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls) + self.other_calls
+
+    def record(self, reason, duration_us, failed):
+        if 0 <= reason < self.nreasons:
+            self.calls[reason] += 1
+        else:
+            self.other_calls += 1
+        if failed:
+            self.errors += 1
+        self.latency.add(duration_us)
+
+    def reset(self):
+        self.calls = [0] * self.nreasons
+        self.other_calls = 0
+        self.errors = 0
+        self.latency.reset()
+
+    def words(self):
+        """
+        Encode the statistics as a list of words, as returned by FanController_DriverStats.
+
+        The layout is:
+            +0      number of reason counts (n)
+            +4      n words of call counts, indexed by driver reason
+            ...     count of calls with unrecognised reasons
+            ...     count of errors
+            ...     number of histogram buckets (m)
+            ...     m words of bucket counts
+        """
+        words = [self.nreasons]
+        words.extend(self.calls)
+        words.append(self.other_calls)
+        words.append(self.errors)
+        words.append(self.latency.nbuckets)
+        words.extend(self.latency.buckets)
+        return words
+
+
+class DriverStats(CallStats):
+    """
+    Counters for all the calls made to a single driver.
+    """
+    # How many calls we make between checks of the tail latency
+    check_interval = 64
+
+    def __init__(self, driver, driver_ws, slow_threshold=0):
+        super(DriverStats, self).__init__()
+        self.driver = driver
+        self.driver_ws = driver_ws
+        # The fans provided by this driver, keyed by their fan_id
+        self.fans = {}
+        # p99 latency (in us) above which the driver is considered slow, or 0 to never be slow
+        self.slow_threshold = slow_threshold
+        self.slow = False
+        # DriverHealth for the driver (assigned by the registry)
+        self.health = None
+        # Latencies since the last check, so that the slow state follows recent behaviour
+        self.window = LatencyHistogram()
+
+    def __repr__(self):
+        return "<{}(driver=&{:08x}, ws=&{:08x}, {} calls, {} errors{})>".format(self.__class__.__name__,
+                                                                               self.driver,
+                                                                               self.driver_ws,
+                                                                               self.total_calls,
+                                                                               self.errors,
+                                                                               ', slow' if self.slow else '')
+
+    def record(self, reason, duration_us, failed):
+        super(DriverStats, self).record(reason, duration_us, failed)
+        self.window.add(duration_us)
+
+    def check_slow(self):
+        """
+        Check whether the driver's tail latency has crossed the slow threshold.
+
+        @return: True if the slow state changed, False if it did not
+        """
+        if self.window.count < self.check_interval:
+            return False
+        # The upper limit of the bucket could be up to twice the real latency, so a threshold
+        # would in effect be rounded down to a power of two.
+        p99 = self.window.estimate(99)
+        self.window.reset()
+
+        if not self.slow_threshold:
+            slow = False
+        elif self.slow:
+            # Only recover when comfortably under the threshold, so we don't flap.
+            slow = p99 > self.slow_threshold // 2
+        else:
+            slow = p99 > self.slow_threshold
+        if slow == self.slow:
+            return False
+        self.slow = slow
+        return True
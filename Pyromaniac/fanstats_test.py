@@ -0,0 +1,73 @@
+"""
+Test that the statistics of the driver calls find slow drivers properly.
+"""
+
+import unittest
+
+from .fanstats import LatencyHistogram, DriverStats
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_estimate(self):
+        histogram = LatencyHistogram()
+        # All of these fall in the bucket from 1024us to 2048us
+        for duration in range(1100, 2000, 9):
+            histogram.add(duration)
+        self.assertEqual(histogram.percentile(50), 2048)
+        self.assertAlmostEqual(histogram.estimate(50), 1536)
+        self.assertAlmostEqual(histogram.estimate(99), 1024 + 1024 * 0.99)
+
+    def test_estimate_across_buckets(self):
+        histogram = LatencyHistogram()
+        for _ in range(50):
+            histogram.add(0)
+        for _ in range(50):
+            histogram.add(100)
+        # Half the calls are in the first bucket; the rest are spread over 64us to 128us
+        self.assertAlmostEqual(histogram.estimate(50), 1)
+        self.assertAlmostEqual(histogram.estimate(75), 96)
+        self.assertEqual(LatencyHistogram().estimate(99), 0)
+
+
+class TestDriverStats(unittest.TestCase):
+
+    def record(self, stats, duration_us, calls=None):
+        for _ in range(calls or DriverStats.check_interval):
+            stats.record(0, duration_us, False)
+
+    def test_threshold_within_bucket(self):
+        # A threshold which is not a power of two is not rounded to the bucket limit; a few calls
+        # just over 2048us do not count as being as slow as 4096us.
+        stats = DriverStats(0, 0, slow_threshold=3500)
+        self.record(stats, 1000, calls=98)
+        self.record(stats, 3000, calls=2)
+        self.assertFalse(stats.check_slow())
+        self.assertFalse(stats.slow)
+
+        self.record(stats, 1000, calls=90)
+        self.record(stats, 3000, calls=10)
+        self.assertTrue(stats.check_slow())
+        self.assertTrue(stats.slow)
+
+    def test_recovery(self):
+        stats = DriverStats(0, 0, slow_threshold=3000)
+        self.record(stats, 4000)
+        self.assertTrue(stats.check_slow())
+        # Not yet comfortably under the threshold
+        self.record(stats, 2000)
+        self.assertFalse(stats.check_slow())
+        self.record(stats, 1000)
+        self.assertTrue(stats.check_slow())
+        self.assertFalse(stats.slow)
+
+    def test_checked_after_interval(self):
+        stats = DriverStats(0, 0, slow_threshold=3000)
+        self.record(stats, 4000, calls=DriverStats.check_interval - 1)
+        self.assertFalse(stats.check_slow())
+        self.record(stats, 4000, calls=1)
+        self.assertTrue(stats.check_slow())
+
+
+if __name__ == '__main__':
+    unittest.main()
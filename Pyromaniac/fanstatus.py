@@ -0,0 +1,191 @@
+"""
+Status table of the fans, published in a dynamic area.
+
+The dynamic area is read-only to user mode. Clients find it with
+FanController_StatusTable, and may then read the state of the fans directly
+from memory without calling any SWIs. All values are little-endian words.
+
+Header (at the base of the area):
+    +0      magic 'FanS' (&536E6146)
+    +4      table sequence number
+    +8      generation; incremented each time the set of fans changes
+    +12     number of records in use
+    +16     size of each record (32)
+    +20     number of records the area can hold
+    +24     reserved
+    +28     reserved
+
+Records (from +32, in fan id order):
+    +0      record sequence number
+    +4      fan id
+    +8      location id
+    +12     capabilities
+    +16     last speed read, or -1 if not known
+    +20     fan state: 0 if OK, or a negative FanState value
+    +24     control mode, or -1 if not known
+    +28     OS_ReadMonotonicTime when the speed was read, or 0 if never read
+
+The table is updated with a sequence lock protocol. A writer makes the
+sequence number odd before it changes anything, and even again once it has
+finished. To read a consistent record, a reader should:
+
+    1. Read the record sequence number. If it is odd, go back to 1.
+    2. Read the fields that are wanted.
+    3. Read the record sequence number again. If it has changed, go back to 1.
+
+The table sequence number protects the header and the set of records in the
+same way; a reader wanting to walk the whole table reads the table sequence
+number, the header and the records, and then checks that the table sequence
+number has not changed.
+"""
+
+from .constants import FanConstants
+from .fanclock import Clock
+
+
+class FanStatusTable(object):
+    """
+    Maintains the status table in a dynamic area.
+    """
+    magic = 0x536E6146
+    header_size = 32
+    record_size = 32
+    area_name = "Fan status"
+
+    # Offsets in the header
+    header_sequence = 4
+    header_generation = 8
+    header_count = 12
+    # Offsets in each record
+    record_sequence = 0
+
+    def __init__(self, ro, capacity=256):
+        self.ro = ro
+        self.capacity = capacity
+        self.area = None
+        self.base = None
+        self.rma = None
+        self.name_block = None
+        self.table_sequence = 0
+        self.generation = None
+        # Index of the record for each fan, keyed by fan_id
+        self.index = {}
+        # Sequence numbers of the records, by index
+        self.sequences = [0] * capacity
+        # OS_ReadMonotonicTime, and the time from the fan clock, when the area was created
+        self.monotonic_base = 0
+        self.time_base = 0
+        self.writes = 0
+
+    def __repr__(self):
+        return "<{}(area={}, {} of {} records)>".format(self.__class__.__name__, self.area,
+                                                        len(self.index), self.capacity)
+
+    @property
+    def size(self):
+        return self.header_size + self.record_size * self.capacity
+
+    def create(self, rma):
+        """
+        Create the dynamic area.
+
+        @param rma:     RMAAccount to allocate the area name in
+        """
+        self.rma = rma
+        self.name_block = rma.strdup(self.area_name, 'status area name')
+        rout = self.ro.kernel.api.swi(FanConstants.SWIOS_DynamicArea,
+                                      regs={0: FanConstants.OSDynamicArea_Create,
+                                            1: -1,
+                                            2: self.size,
+                                            3: -1,
+                                            4: FanConstants.OSDynamicArea_UserReadOnly |
+                                               FanConstants.OSDynamicArea_NotDraggable,
+                                            5: self.size,
+                                            6: 0,
+                                            7: 0,
+                                            8: self.name_block.address})
+        self.area = rout[1]
+        self.base = rout[3]
+
+        rout = self.ro.kernel.api.swi(FanConstants.SWIOS_ReadMonotonicTime, regs={})
+        self.monotonic_base = rout[0]
+        self.time_base = Clock.get(self.ro).time()
+        self.write_header(0)
+
+    def remove(self):
+        if self.area is not None:
+            self.ro.kernel.api.swi(FanConstants.SWIOS_DynamicArea,
+                                   regs={0: FanConstants.OSDynamicArea_Remove,
+                                         1: self.area})
+            self.area = None
+            self.base = None
+        if self.name_block:
+            self.rma.free(self.name_block)
+            self.name_block = None
+
+    def write_header(self, count):
+        """
+        Write the header, leaving the table sequence number until last.
+        """
+        memory = self.ro.memory
+        memory[self.base + 0].word = self.magic
+        memory[self.base + self.header_generation].word = (self.generation or 0) & 0xFFFFFFFF
+        memory[self.base + self.header_count].word = count
+        memory[self.base + 16].word = self.record_size
+        memory[self.base + 20].word = self.capacity
+        memory[self.base + 24].word = 0
+        memory[self.base + 28].word = 0
+        memory[self.base + self.header_sequence].word = self.table_sequence
+
+    def write_record(self, index, fan):
+        """
+        Write the record for a fan, using the record sequence lock.
+        """
+        address = self.base + self.header_size + index * self.record_size
+        memory = self.ro.memory
+        sequence = (self.sequences[index] + 1) & 0xFFFFFFFF
+        memory[address + self.record_sequence].word = sequence
+
+        if fan.last_sample_time is None:
+            monotonic = 0
+        else:
+            monotonic = self.monotonic_base + int((fan.last_sample_time - self.time_base) * 100)
+        speed = -1 if fan.last_speed is None else fan.last_speed
+        values = (fan.fan_id, fan.location_id, fan.capabilities,
+                  speed, fan.state, fan.control_mode, monotonic)
+        for offset, value in enumerate(values, 1):
+            memory[address + offset * 4].word = value & 0xFFFFFFFF
+
+        sequence = (sequence + 1) & 0xFFFFFFFF
+        memory[address + self.record_sequence].word = sequence
+        self.sequences[index] = sequence
+        self.writes += 1
+
+    def rebuild(self, snapshot):
+        """
+        Rewrite the whole table from a snapshot of the registry, if the fans have changed.
+        """
+        if self.base is None or snapshot.generation == self.generation:
+            return
+        self.table_sequence = (self.table_sequence + 1) & 0xFFFFFFFF
+        self.ro.memory[self.base + self.header_sequence].word = self.table_sequence
+
+        self.generation = snapshot.generation
+        fans = snapshot.fans[:self.capacity]
+        self.index = dict((fan.fan_id, index) for index, fan in enumerate(fans))
+        for index, fan in enumerate(fans):
+            self.write_record(index, fan)
+
+        self.table_sequence = (self.table_sequence + 1) & 0xFFFFFFFF
+        self.write_header(len(fans))
+
+    def update(self, fan):
+        """
+        Update the record for a fan in place.
+        """
+        index = self.index.get(fan.fan_id, None)
+        if index is not None:
+            self.write_record(index, fan)
+
+    def sample(self, fan, timestamp, speed):
+        self.update(fan)
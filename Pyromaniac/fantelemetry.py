@@ -0,0 +1,535 @@
+"""
+Persistent store of fan telemetry on the host filesystem.
+
+Samples are held in segment files, one series of segments for each tier of
+resolution. Tier 0 holds the raw samples; the other tiers hold the minimum,
+maximum and mean of the samples in each interval of the tier.
+
+Each segment file starts with a header:
+
+    +0      magic 'FanTelem'
+    +8      format version
+    +12     tier interval in seconds (0 for raw samples)
+    +16     timestamp (ms) of the first record in the segment
+    +24     number of bytes of the file in use (including this header)
+
+and is followed by the records. Segments are named by their tier and the
+timestamp of their first record; a run which starts while the segment for
+that time exists (such as the hourly segment, after a restart within the
+hour) adds its records to the end of it.
+
+Each record is a varint of the series number, then zig-zag varints of the
+differences between the timestamp and values of this record and those of the
+previous record for that series in the same segment.
+Raw records have a single value (the speed, or a negative state); aggregated
+records have three (min, max and mean) of the speeds, so states and automatic
+speeds are left out of them.
+
+Fan ids are only unique within a run of FanController, so the samples of
+each fan in each run are recorded as a separate series, numbered uniquely
+within the store. The series are described in 'fans.jsonl' in the same
+directory; each line is a JSON object of the form:
+
+    {"fan": {"series": <series>, "run": <run>, "id": <fan id>, "since": <ms>,
+             "location": <id>, "capabilities": <flags>,
+             "accuracy": <accuracy>, "maximum": <maximum>,
+             "speeds": [<speed>, ...] or null}}
+
+Runs are numbered from 1 each time the store is opened. A series is described
+again whenever its description changes (such as when the fan is moved); each
+description applies to the records of the series from its 'since' timestamp.
+Stores written before series were introduced have no 'series' or 'run', and
+their records are keyed by the fan id.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+from .constants import FanConstants
+
+
+def encode_varint(value, out):
+    """
+    Append an unsigned varint to a bytearray.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    """
+    Decode an unsigned varint.
+
+    @return: tuple of (value, new position)
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+class Segment(object):
+    """
+    A segment file being written, through a memory map.
+
+    A segment which already exists (because an earlier run wrote to a segment for the same
+    time) is added to, after its last complete record.
+    """
+    header = struct.Struct('<8sIIQI')
+    magic = b'FanTelem'
+    version = 2
+    # Largest record we might write: fan id, timestamp and 3 values, each up to 10 bytes
+    max_record_size = 5 * 10
+
+    def __init__(self, filename, tier, base_ms, size):
+        self.filename = filename
+        self.tier = tier
+        self.base_ms = base_ms
+        self.used = self.header.size
+        # Previous (timestamp, values) for each series, for the delta encoding
+        self.previous = {}
+        if os.path.exists(filename):
+            self.fh = open(filename, 'r+b')
+            self.resume()
+        else:
+            self.fh = open(filename, 'w+b')
+        # A full segment is still given room for a record, so that it can always be written to
+        self.size = max(size, self.used + self.max_record_size)
+        self.fh.truncate(self.size)
+        self.mm = mmap.mmap(self.fh.fileno(), self.size)
+        self.write_header()
+
+    def __repr__(self):
+        return "<{}({}, {} of {} bytes)>".format(self.__class__.__name__,
+                                                 self.filename, self.used, self.size)
+
+    def resume(self):
+        """
+        Read the records already in the segment file, so that we can add to them.
+
+        A file which is not a segment for our tier is replaced.
+        """
+        data = self.fh.read()
+        if len(data) < self.header.size:
+            return
+        (magic, version, tier, base_ms, used) = self.header.unpack_from(data, 0)
+        if magic != self.magic or version != self.version or tier != self.tier:
+            return
+        self.base_ms = base_ms
+        for (series, timestamp_ms, values, end) in decode_records(data, base_ms, min(used, len(data)),
+                                                                 TelemetryStore.nvalues(tier)):
+            self.previous[series] = (timestamp_ms, values)
+            self.used = end
+
+    def write_header(self):
+        self.header.pack_into(self.mm, 0, self.magic, self.version, self.tier, self.base_ms, self.used)
+
+    def encode(self, series, timestamp_ms, values, out):
+        """
+        Encode a record relative to the previous record for the series.
+        """
+        previous = self.previous.get(series, None)
+        if previous:
+            last_ts, last_values = previous
+        else:
+            last_ts = self.base_ms
+            last_values = (0,) * len(values)
+        encode_varint(series, out)
+        encode_varint(zigzag(timestamp_ms - last_ts), out)
+        for value, last in zip(values, last_values):
+            encode_varint(zigzag(value - last), out)
+        self.previous[series] = (timestamp_ms, values)
+
+    def write(self, data):
+        end = self.used + len(data)
+        self.mm[self.used:end] = data
+        self.used = end
+        self.write_header()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.fh.truncate(self.used)
+        self.fh.close()
+
+
+def decode_records(data, base_ms, used, nvalues):
+    """
+    Decode the records of a segment, stopping at a record which is incomplete.
+
+    @param data:        contents of the segment
+    @param base_ms:     timestamp of the first record, from the header
+    @param used:        number of bytes of the segment in use, from the header
+    @param nvalues:     number of values in each record
+
+    @return: generator of (series, timestamp_ms, values, offset of the end of the record)
+    """
+    previous = {}
+    pos = Segment.header.size
+    while pos < used:
+        try:
+            (series, pos) = decode_varint(data, pos)
+            last = previous.get(series, None)
+            if last:
+                last_ts, last_values = last
+            else:
+                last_ts = base_ms
+                last_values = (0,) * nvalues
+            (delta, pos) = decode_varint(data, pos)
+            timestamp_ms = last_ts + unzigzag(delta)
+            values = []
+            for last_value in last_values:
+                (delta, pos) = decode_varint(data, pos)
+                values.append(last_value + unzigzag(delta))
+        except IndexError:
+            return
+        if pos > used:
+            return
+        values = tuple(values)
+        previous[series] = (timestamp_ms, values)
+        yield (series, timestamp_ms, values, pos)
+
+
+def read_segment(filename, nvalues):
+    """
+    Decode the records in a segment file, without reading the whole file.
+
+    @param filename:    segment file to read
+    @param nvalues:     number of values in each record
+
+    @return: generator of (series, timestamp_ms, values)
+    """
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < Segment.header.size:
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, tier, base_ms, used) = Segment.header.unpack_from(mm, 0)
+            if magic != Segment.magic or version != Segment.version:
+                return
+            for (series, timestamp_ms, values, _) in decode_records(mm, base_ms, min(used, len(mm)), nvalues):
+                yield (series, timestamp_ms, values)
+        finally:
+            mm.close()
+
+
+class TierWriter(object):
+    """
+    Writes the records for a single tier into a series of segments.
+    """
+
+    def __init__(self, directory, tier, segment_size, batch_size):
+        self.directory = directory
+        self.tier = tier
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.segment = None
+        # Records encoded but not yet written to the segment
+        self.pending = bytearray()
+
+    def __repr__(self):
+        return "<{}(tier={}, {!r})>".format(self.__class__.__name__, self.tier, self.segment)
+
+    def add(self, series, timestamp_ms, values):
+        if self.segment and \
+           self.segment.used + len(self.pending) + Segment.max_record_size > self.segment.size:
+            self.flush()
+            self.segment.close()
+            self.segment = None
+
+        if not self.segment:
+            filename = os.path.join(self.directory, TelemetryStore.segment_name(self.tier, timestamp_ms))
+            self.segment = Segment(filename, self.tier, timestamp_ms, self.segment_size)
+
+        self.segment.encode(series, timestamp_ms, values, self.pending)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.segment.write(self.pending)
+            self.pending = bytearray()
+
+    def close(self):
+        if self.segment:
+            self.flush()
+            self.segment.close()
+            self.segment = None
+
+
+class Aggregate(object):
+    """
+    Min, max and mean of the samples in one interval.
+    """
+    __slots__ = ('start_ms', 'minimum', 'maximum', 'total', 'count')
+
+    def __init__(self, start_ms, value):
+        self.start_ms = start_ms
+        self.minimum = value
+        self.maximum = value
+        self.total = value
+        self.count = 1
+
+    def add(self, value):
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.count += 1
+
+    def values(self):
+        return (self.minimum, self.maximum, int(round(self.total / self.count)))
+
+
+class TelemetryStore(object):
+    """
+    Tiered store of fan samples, recorded in a series for each fan in each run.
+    """
+    tiers = (0, 1, 60, 3600)
+    segment_prefix = 'tier'
+    segment_suffix = '.seg'
+    fans_leafname = 'fans.jsonl'
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, batch_size=64 * 1024):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.writers = dict((tier, TierWriter(directory, tier, segment_size, batch_size))
+                            for tier in self.tiers)
+        # Current aggregate for each (tier, series)
+        self.aggregates = {}
+        # This run, and the next series number, follow on from those already in the store
+        self.run = 1
+        self.next_series = 1
+        for description in self.read_fans(directory):
+            self.run = max(self.run, description.get('run', 0) + 1)
+            self.next_series = max(self.next_series, self.series_number(description) + 1)
+        # Series of the fans in this run, and the descriptions we have written for them,
+        # keyed by fan_id
+        self.series = {}
+        self.described = {}
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, self.directory)
+
+    @classmethod
+    def segment_name(cls, tier, base_ms):
+        return "{}{:05d}-{:013d}{}".format(cls.segment_prefix, tier, base_ms, cls.segment_suffix)
+
+    @staticmethod
+    def nvalues(tier):
+        return 1 if tier == 0 else 3
+
+    @staticmethod
+    def series_number(description):
+        """
+        @return: the series that a description is for
+        """
+        # Stores written before there were series recorded the fans by their id
+        return description.get('series', description.get('id', 0))
+
+    @classmethod
+    def read_fans(cls, directory):
+        """
+        Read the descriptions of the fans recorded in a store.
+
+        @return: generator of dictionaries describing each fan
+        """
+        filename = os.path.join(directory, cls.fans_leafname)
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)['fan']
+
+    def series_for(self, fan_id, timestamp_ms):
+        """
+        Find the series recording a fan in this run, starting one if needed.
+
+        A new series is recorded in the descriptions straight away, even if the fan has not
+        been described, so that its number is not used again by a later run.
+
+        @return: the series number
+        """
+        series = self.series.get(fan_id, None)
+        if series is None:
+            series = self.new_series(fan_id)
+            self.write_description({'series': series, 'run': self.run, 'id': fan_id, 'since': timestamp_ms})
+        return series
+
+    def new_series(self, fan_id):
+        series = self.next_series
+        self.next_series += 1
+        self.series[fan_id] = series
+        return series
+
+    def write_description(self, description):
+        with open(os.path.join(self.directory, self.fans_leafname), 'a') as fh:
+            fh.write(json.dumps({'fan': description}) + '\n')
+
+    @classmethod
+    def read_series(cls, directory):
+        """
+        Read the descriptions of the series recorded in a store.
+
+        @return: dictionary of the lists of descriptions of each series, in the order they
+                 were given, keyed by the series
+        """
+        series = {}
+        for description in cls.read_fans(directory):
+            series.setdefault(cls.series_number(description), []).append(description)
+        return series
+
+    def describe(self, fan_id, location_id, capabilities, accuracy, maximum, speeds, timestamp_ms=0):
+        """
+        Record the description of a fan, if it has changed.
+
+        @param timestamp_ms:    timestamp of the first sample that the description applies to
+        """
+        series = self.series.get(fan_id, None)
+        if series is None:
+            # The description records the new series
+            series = self.new_series(fan_id)
+        description = {
+                'series': series,
+                'run': self.run,
+                'id': fan_id,
+                'location': location_id,
+                'capabilities': capabilities,
+                'accuracy': accuracy,
+                'maximum': maximum,
+                'speeds': list(speeds) if speeds else None,
+            }
+        if self.described.get(fan_id, None) == description:
+            return
+        self.described[fan_id] = description
+        self.write_description(dict(description, since=timestamp_ms))
+
+    def sample(self, fan_id, timestamp_ms, speed):
+        """
+        Record a sample of a fan's speed.
+
+        @param speed:   the speed, or a negative state, as a signed value
+        """
+        series = self.series_for(fan_id, timestamp_ms)
+        self.writers[0].add(series, timestamp_ms, (speed,))
+        if speed < 0 or speed == FanConstants.FanSpeed_Automatic:
+            # States, and automatic speeds, are not speeds to be aggregated
+            return
+        for tier in self.tiers[1:]:
+            interval_ms = tier * 1000
+            start_ms = timestamp_ms - (timestamp_ms % interval_ms)
+            key = (tier, series)
+            aggregate = self.aggregates.get(key, None)
+            if aggregate and aggregate.start_ms == start_ms:
+                aggregate.add(speed)
+                continue
+            if aggregate:
+                self.writers[tier].add(series, aggregate.start_ms, aggregate.values())
+            self.aggregates[key] = Aggregate(start_ms, speed)
+
+    def forget(self, fan_id):
+        """
+        Write out the partial intervals of a fan which has gone away, and end its series.
+        """
+        series = self.series.pop(fan_id, None)
+        self.described.pop(fan_id, None)
+        if series is None:
+            return
+        for tier in self.tiers[1:]:
+            aggregate = self.aggregates.pop((tier, series), None)
+            if aggregate:
+                self.writers[tier].add(series, aggregate.start_ms, aggregate.values())
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        # Write out the partial intervals, so that they aren't lost
+        for (tier, series), aggregate in sorted(self.aggregates.items()):
+            self.writers[tier].add(series, aggregate.start_ms, aggregate.values())
+        self.aggregates = {}
+        for writer in self.writers.values():
+            writer.close()
+
+    @classmethod
+    def list_segments(cls, directory, tier):
+        """
+        List the segments for a tier in a store directory.
+
+        @return: list of (base_ms, filename) in time order
+        """
+        prefix = "{}{:05d}-".format(cls.segment_prefix, tier)
+        segments = []
+        for leafname in os.listdir(directory):
+            if leafname.startswith(prefix) and leafname.endswith(cls.segment_suffix):
+                base_ms = int(leafname[len(prefix):-len(cls.segment_suffix)])
+                segments.append((base_ms, os.path.join(directory, leafname)))
+        return sorted(segments)
+
+    def segments(self, tier):
+        """
+        List the segments for a tier.
+
+        @return: list of (base_ms, filename) in time order
+        """
+        return self.list_segments(self.directory, tier)
+
+    def query(self, tier=0, series=None, start_ms=None, end_ms=None):
+        """
+        Stream the records from a tier.
+
+        @param tier:        tier interval in seconds, or 0 for the raw samples
+        @param series:      series to return records for, or None for all
+        @param start_ms:    earliest timestamp to return, or None for no limit
+        @param end_ms:      timestamp to return records before, or None for no limit
+
+        @return: generator of (series, timestamp_ms, values), where values is
+                 (speed,) for raw samples, or (min, max, mean) for the other tiers
+        """
+        if tier not in self.writers:
+            raise ValueError("Telemetry tier {} is not recognised".format(tier))
+        # Make sure that anything we've been given is visible to the reader
+        self.writers[tier].flush()
+
+        # Aggregates are written when their interval ends, so may land in the next segment
+        slack_ms = tier * 1000
+        segments = self.segments(tier)
+        nvalues = self.nvalues(tier)
+        for index, (base_ms, filename) in enumerate(segments):
+            if end_ms is not None and base_ms - slack_ms >= end_ms:
+                break
+            if start_ms is not None and index + 1 < len(segments) and \
+               segments[index + 1][0] + slack_ms <= start_ms:
+                continue
+
+            for record in read_segment(filename, nvalues):
+                if series is not None and record[0] != series:
+                    continue
+                timestamp_ms = record[1]
+                if start_ms is not None and timestamp_ms < start_ms:
+                    continue
+                if end_ms is not None and timestamp_ms >= end_ms:
+                    continue
+                yield record
@@ -0,0 +1,128 @@
+"""
+Test that the telemetry store keeps the samples it is given.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .fantelemetry import (TelemetryStore, Segment, decode_varint, encode_varint,
+                           read_segment, unzigzag, zigzag)
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 0xFFFFFFFF, 1 << 63):
+            out = bytearray()
+            encode_varint(value, out)
+            self.assertEqual(decode_varint(out, 0), (value, len(out)))
+
+    def test_zigzag(self):
+        for value in (0, 1, -1, 63, -64, 1 << 40, -(1 << 40)):
+            self.assertGreaterEqual(zigzag(value), 0)
+            self.assertEqual(unzigzag(zigzag(value)), value)
+
+
+class TestTelemetryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, **kwargs):
+        return TelemetryStore(self.directory, segment_size=4096, batch_size=64, **kwargs)
+
+    def test_query(self):
+        store = self.store()
+        for second in range(120):
+            store.sample(1, second * 1000, 1000 + second)
+            store.sample(2, second * 1000, -1 if second == 5 else 2000)
+        store.close()
+
+        # Each fan is recorded in a series, numbered in the order they were first seen
+        store = self.store()
+        raw = list(store.query(0, series=1))
+        self.assertEqual(raw, [(1, second * 1000, (1000 + second,)) for second in range(120)])
+        self.assertEqual(len(list(store.query(0, series=2))), 120)
+        minutes = list(store.query(60, series=1))
+        self.assertEqual(minutes, [(1, 0, (1000, 1059, 1030)), (1, 60000, (1060, 1119, 1090))])
+        # The state is not aggregated
+        self.assertEqual([record[2] for record in store.query(60, series=2)],
+                         [(2000, 2000, 2000)] * 2)
+
+    def test_segments_roll(self):
+        store = self.store()
+        for second in range(2000):
+            store.sample(1, second * 1000, second)
+        store.close()
+        self.assertGreater(len(store.segments(0)), 1)
+        self.assertEqual([record[2][0] for record in store.query(0)], list(range(2000)))
+
+    def test_reopen_segment(self):
+        # A restart within the hour adds to the hourly segment, rather than replacing it
+        store = self.store()
+        store.sample(1, 1000, 1000)
+        store.sample(1, 2000, 1100)
+        store.close()
+        store = self.store()
+        store.sample(1, 3000, 1200)
+        store.sample(2, 3000, 3000)
+        store.close()
+
+        # Fan 1 of the second run is a new series
+        self.assertEqual(len(store.segments(3600)), 1)
+        self.assertEqual(list(store.query(3600)),
+                         [(1, 0, (1000, 1100, 1050)), (2, 0, (1200, 1200, 1200)), (3, 0, (3000, 3000, 3000))])
+        self.assertEqual([record[1] for record in store.query(0, series=1)], [1000, 2000])
+        self.assertEqual([record[1] for record in store.query(0, series=2)], [3000])
+
+    def test_runs(self):
+        # Fan ids start again in each run, but their series do not
+        store = self.store()
+        store.describe(1, 0x100, 1, 10, 5000, None, 1000)
+        store.sample(1, 1000, 2000)
+        store.describe(1, 0x200, 1, 10, 5000, None, 2000)
+        store.sample(1, 2000, 2100)
+        store.close()
+        store = self.store()
+        self.assertEqual(store.run, 2)
+        store.describe(1, 0x300, 1, 10, 5000, None, 5000)
+        store.sample(1, 5000, 3000)
+        store.close()
+
+        series = TelemetryStore.read_series(self.directory)
+        self.assertEqual(sorted(series), [1, 2])
+        self.assertEqual([(description['run'], description['location'], description['since'])
+                          for description in series[1]], [(1, 0x100, 1000), (1, 0x200, 2000)])
+        self.assertEqual([(description['run'], description['id'], description['location'])
+                          for description in series[2]], [(2, 1, 0x300)])
+        self.assertEqual([record[2] for record in store.query(0, series=2)], [(3000,)])
+
+    def test_reopen_incomplete(self):
+        # A segment whose last record was not completely written is added to after the last
+        # record that was
+        store = self.store()
+        store.sample(1, 1000, 1000)
+        store.sample(1, 2000, 1100)
+        store.close()
+        (_, filename) = store.segments(0)[0]
+        with open(filename, 'r+b') as fh:
+            data = bytearray(fh.read())
+            # Claim a record which was cut short
+            used = len(data) + 1
+            data[24:28] = used.to_bytes(4, 'little')
+            data.append(0x81)
+            fh.seek(0)
+            fh.write(data)
+
+        segment = Segment(filename, 0, 0, 4096)
+        segment.close()
+        self.assertEqual(list(read_segment(filename, 1)), [(1, 1000, (1000,)), (1, 2000, (1100,))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Trace of the operations performed by FanController.
+"""
+
+import collections
+import struct
+
+
+TraceRecord = collections.namedtuple('TraceRecord', ('kind', 'failed', 'number', 'fan_id',
+                                                     'r0', 'r1', 'r2', 'r3',
+                                                     'duration_us', 'errnum', 'timestamp_ns'))
+
+
+class TraceBuffer(object):
+    """
+    Preallocated ring buffer of binary trace records.
+
+    Each record is a fixed size, so recording is just a pack into the buffer
+    at the next position; the oldest records are overwritten once the buffer
+    is full.
+    """
+    Kind_SWI = 0
+    Kind_Driver = 1
+    Kind_Service = 2
+
+    kind_names = {
+            Kind_SWI: 'SWI',
+            Kind_Driver: 'Driver',
+            Kind_Service: 'Service',
+        }
+
+    record_format = struct.Struct('<BBHII4IIIQ')
+    export_magic = b'FanTrace'
+    export_version = 1
+    export_header = struct.Struct('<8sIII')
+
+    def __init__(self, nrecords):
+        self.nrecords = nrecords
+        self.buffer = bytearray(self.record_format.size * nrecords)
+        # Index of the next record to write, and number of records written in total
+        self.next = 0
+        self.written = 0
+
+    def __repr__(self):
+        return "<{}({} of {} records)>".format(self.__class__.__name__,
+                                               len(self), self.nrecords)
+
+    def __len__(self):
+        return min(self.written, self.nrecords)
+
+    def record(self, kind, number, fan_id, r0, r1, r2, r3, duration_us, failed, errnum, timestamp_ns):
+        self.record_format.pack_into(self.buffer, self.next * self.record_format.size,
+                                     kind, 1 if failed else 0, 0,
+                                     number & 0xFFFFFFFF, (fan_id or 0) & 0xFFFFFFFF,
+                                     r0 & 0xFFFFFFFF, r1 & 0xFFFFFFFF, r2 & 0xFFFFFFFF, r3 & 0xFFFFFFFF,
+                                     min(duration_us, 0xFFFFFFFF), errnum & 0xFFFFFFFF, timestamp_ns)
+        self.next += 1
+        if self.next == self.nrecords:
+            self.next = 0
+        self.written += 1
+
+    def clear(self):
+        self.next = 0
+        self.written = 0
+
+    def raw_records(self):
+        """
+        Iterate over the raw bytes of each record, oldest first.
+        """
+        size = self.record_format.size
+        if self.written > self.nrecords:
+            indexes = list(range(self.next, self.nrecords)) + list(range(0, self.next))
+        else:
+            indexes = range(0, self.next)
+        view = memoryview(self.buffer)
+        for index in indexes:
+            yield view[index * size:(index + 1) * size]
+
+    def records(self, kind=None, fan_id=None, errors_only=False):
+        """
+        Iterate over the decoded records, oldest first.
+
+        @param kind:        kind of record to return, or None for all
+        @param fan_id:      fan id to return records for, or None for all
+        @param errors_only: True to only return records which failed
+        """
+        for raw in self.raw_records():
+            (rkind, flags, _, number, rfan_id,
+             r0, r1, r2, r3, duration_us, errnum, timestamp_ns) = self.record_format.unpack(raw)
+            if kind is not None and rkind != kind:
+                continue
+            if fan_id is not None and rfan_id != fan_id:
+                continue
+            if errors_only and not flags & 1:
+                continue
+            yield TraceRecord(rkind, bool(flags & 1), number, rfan_id,
+                              r0, r1, r2, r3, duration_us, errnum, timestamp_ns)
+
+    def export(self, filename):
+        """
+        Write the records, oldest first, to a host file.
+
+        The file starts with a header of the magic 'FanTrace', the format version,
+        the size of each record and the number of records. The records follow in
+        the same little-endian layout as they are held in the buffer.
+
+        @return: number of records written
+        """
+        with open(filename, 'wb') as fh:
+            fh.write(self.export_header.pack(self.export_magic, self.export_version,
+                                             self.record_format.size, len(self)))
+            for raw in self.raw_records():
+                fh.write(raw)
+        return len(self)
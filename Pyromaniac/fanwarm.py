@@ -0,0 +1,159 @@
+"""
+Warm-start persistence of the fan state.
+
+The state of each fan is saved to a compact host file when FanController is
+finalised. The state is keyed by the fan's provider name (which identifies
+its driver, as the driver's code and workspace addresses change each time it
+is loaded), the location id that the driver registered it with, and the
+fan's sequence among the fans that the driver registered at that location.
+When a driver registers a fan which was saved, the saved state can be used to
+preload the fan's caches, and to reapply the settings which had been made to
+it.
+
+The file is a header, followed by fixed-size little-endian records:
+
+    Header:
+        8 bytes     magic 'FanState'
+        4 bytes     version (2)
+        4 bytes     number of records
+    Record:
+        32 bytes    provider name, padded with NULs
+        4 bytes     location id the fan was registered with
+        4 bytes     sequence of the fan among those registered at the location
+        4 bytes     location id the fan had been moved to
+        4 bytes     last speed read, or &80000000 if not known
+        4 bytes     control mode, or -1 if not known
+        4 bytes     last speed set, or &80000000 if not set
+"""
+
+import collections
+import os
+import struct
+
+
+WarmRecord = collections.namedtuple('WarmRecord', ('provider', 'registered_location_id', 'sequence',
+                                                   'location_id', 'speed', 'control', 'applied_speed'))
+
+
+class WarmStart(object):
+    """
+    The saved state of the fans, keyed by (provider, registered location id, sequence).
+    """
+    magic = b'FanState'
+    version = 2
+    header = struct.Struct('<8sII')
+    record = struct.Struct('<32sIIIiii')
+    # Value stored for speeds which were not known
+    unknown = -0x80000000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = {}
+        # Sequences used by the registered fans, keyed by (provider, registered location id)
+        self.sequences = {}
+
+    def __repr__(self):
+        return "<{}({}, {} records)>".format(self.__class__.__name__, self.filename, len(self.records))
+
+    def load(self):
+        """
+        Read the saved state, ignoring a file which is missing or not understood.
+
+        @return: number of records read
+        """
+        self.records = {}
+        try:
+            with open(self.filename, 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return 0
+
+        if len(data) < self.header.size:
+            return 0
+        (magic, version, count) = self.header.unpack_from(data, 0)
+        if magic != self.magic or version != self.version or \
+           len(data) < self.header.size + count * self.record.size:
+            return 0
+
+        for (provider, registered_location_id, sequence, location_id, speed, control, applied_speed) in \
+                self.record.iter_unpack(data[self.header.size:self.header.size + count * self.record.size]):
+            provider = provider.rstrip(b'\0').decode('latin-1')
+            record = WarmRecord(provider, registered_location_id, sequence, location_id,
+                                None if speed == self.unknown else speed,
+                                control,
+                                None if applied_speed == self.unknown else applied_speed)
+            self.records[(provider, registered_location_id, sequence)] = record
+        return count
+
+    def save(self):
+        """
+        Write the saved state, replacing the file in one go.
+        """
+        data = [self.header.pack(self.magic, self.version, len(self.records))]
+        for key, record in sorted(self.records.items()):
+            data.append(self.record.pack(record.provider.encode('latin-1', 'replace'),
+                                         record.registered_location_id & 0xFFFFFFFF,
+                                         record.sequence,
+                                         record.location_id & 0xFFFFFFFF,
+                                         self.unknown if record.speed is None else record.speed,
+                                         record.control,
+                                         self.unknown if record.applied_speed is None else record.applied_speed))
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as fh:
+            fh.write(b''.join(data))
+        os.replace(temp_filename, self.filename)
+
+    def key(self, fan):
+        """
+        @return: the key of a registered fan's saved state
+        """
+        # Providers are stored in a fixed size field, so only that much of the name is used
+        provider = fan.provider.encode('latin-1', 'replace')[:32].decode('latin-1')
+        return (provider, fan.registered_location_id, fan.warm_sequence)
+
+    def registered(self, fan):
+        """
+        Give a newly registered fan its sequence among the fans registered at its location.
+        """
+        used = self.sequences.setdefault((fan.provider, fan.registered_location_id), set())
+        sequence = 0
+        while sequence in used:
+            sequence += 1
+        used.add(sequence)
+        fan.warm_sequence = sequence
+
+    def deregistered(self, fan):
+        """
+        Release the sequence of a fan which has gone away, recording its current state.
+        """
+        self.remember(fan)
+        used = self.sequences.get((fan.provider, fan.registered_location_id), None)
+        if used is not None:
+            used.discard(fan.warm_sequence)
+            if not used:
+                del self.sequences[(fan.provider, fan.registered_location_id)]
+
+    def remember(self, fan):
+        """
+        Record the current state of a fan.
+
+        A fan with leases is recorded with the settings it had before it was leased, as the
+        leases are not saved and nothing would return the fan from the leased settings.
+        """
+        speed = fan.last_speed
+        if speed is not None:
+            speed &= 0xFFFFFFFF
+            if speed & 0x80000000:
+                speed -= 0x100000000
+        (control, applied_speed) = fan.lease_saved or (fan.control_mode, fan.applied_speed)
+        key = self.key(fan)
+        self.records[key] = WarmRecord(key[0], fan.registered_location_id, fan.warm_sequence, fan.location_id,
+                                       speed, control, applied_speed)
+
+    def get(self, fan):
+        """
+        Find the saved state for a newly registered fan.
+
+        @return: WarmRecord, or None if nothing was saved for the fan
+        """
+        return self.records.get(self.key(fan), None)
@@ -0,0 +1,112 @@
+"""
+Test that the saved fan state is read back properly.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .constants import FanConstants
+from .fanwarm import WarmStart
+
+
+class FakeFan(object):
+    """
+    The parts of a FanDescriptor which are saved.
+    """
+
+    def __init__(self, provider, location_id):
+        self.provider = provider
+        self.location_id = location_id
+        self.registered_location_id = location_id
+        self.warm_sequence = 0
+        self.last_speed = None
+        self.control_mode = FanConstants.FanControl_Invalid
+        self.applied_speed = None
+        self.lease_saved = None
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'FanState')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def register(self, warm, fans):
+        for fan in fans:
+            warm.registered(fan)
+
+    def test_round_trip(self):
+        warm = WarmStart(self.filename)
+        fans = [FakeFan('Driver', 0x10000), FakeFan('Driver', 0x10000), FakeFan('Other', 0x10000)]
+        self.register(warm, fans)
+        self.assertEqual([fan.warm_sequence for fan in fans], [0, 1, 0])
+
+        fans[0].last_speed = 2400
+        fans[0].control_mode = FanConstants.FanControl_Manual
+        fans[0].applied_speed = 2500
+        fans[1].last_speed = FanConstants.FanState_Failed
+        fans[1].location_id = 0x10203
+        fans[2].control_mode = FanConstants.FanControl_AutomaticNoise
+        for fan in fans:
+            warm.remember(fan)
+        warm.save()
+
+        loaded = WarmStart(self.filename)
+        self.assertEqual(loaded.load(), 3)
+        again = [FakeFan('Driver', 0x10000), FakeFan('Driver', 0x10000), FakeFan('Other', 0x10000)]
+        self.register(loaded, again)
+
+        record = loaded.get(again[0])
+        self.assertEqual((record.speed, record.control, record.applied_speed),
+                         (2400, FanConstants.FanControl_Manual, 2500))
+        record = loaded.get(again[1])
+        self.assertEqual((record.speed, record.location_id, record.applied_speed),
+                         (FanConstants.FanState_Failed, 0x10203, None))
+        record = loaded.get(again[2])
+        self.assertEqual((record.speed, record.control), (None, FanConstants.FanControl_AutomaticNoise))
+
+    def test_sequence_reused(self):
+        warm = WarmStart(self.filename)
+        fans = [FakeFan('Driver', 0x10000), FakeFan('Driver', 0x10000)]
+        self.register(warm, fans)
+        fans[0].last_speed = 1000
+        warm.deregistered(fans[0])
+
+        # A fan registered in its place takes its sequence, and its state
+        replacement = FakeFan('Driver', 0x10000)
+        warm.registered(replacement)
+        self.assertEqual(replacement.warm_sequence, 0)
+        self.assertEqual(warm.get(replacement).speed, 1000)
+
+    def test_leased_fan(self):
+        # A leased fan is saved with the settings it had before the lease
+        warm = WarmStart(self.filename)
+        fan = FakeFan('Driver', 0x10000)
+        warm.registered(fan)
+        fan.control_mode = FanConstants.FanControl_Managed
+        fan.applied_speed = 4000
+        fan.lease_saved = (FanConstants.FanControl_AutomaticNoise, None)
+        warm.remember(fan)
+        warm.save()
+
+        loaded = WarmStart(self.filename)
+        loaded.load()
+        loaded.registered(fan)
+        record = loaded.get(fan)
+        self.assertEqual((record.control, record.applied_speed), (FanConstants.FanControl_AutomaticNoise, None))
+
+    def test_bad_file(self):
+        with open(self.filename, 'wb') as fh:
+            fh.write(b'FanState\x01\x00\x00\x00')
+        warm = WarmStart(self.filename)
+        self.assertEqual(warm.load(), 0)
+        self.assertEqual(WarmStart(os.path.join(self.directory, 'Missing')).load(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Live view of the fans, redrawing only the rows which have changed.
+"""
+
+
+class FanWatch(object):
+    """
+    Builds the VDU output to bring a table of fans up to date.
+
+    The table is drawn at the top of the text window, clipped to the window's
+    size. If there are more fans than fit in the window they are shown a page
+    at a time, with a line below the table saying which fans are shown. The
+    first refresh (and any refresh after the fans shown or the window have
+    changed) clears the window and draws every row. Later refreshes move the
+    cursor to each changed row with VDU 31 and overwrite it. Nothing is written
+    below the window's last line, so the window never scrolls.
+
+    The output never contains a NUL, so may be written in one go with OS_Write0.
+    """
+    vdu_cls = '\x0c'
+    vdu_tab = '\x1f'
+    vdu_cr = '\x0d'
+
+    def __init__(self, header, format_row):
+        """
+        @param header:      text of the heading line
+        @param format_row:  function called with a fan, returning a tuple of the row's key
+                            (which changes when the row should be redrawn) and its text
+        """
+        self.header = header
+        self.format_row = format_row
+        # The fan_ids in the order they are displayed, or None if nothing is displayed
+        self.fan_ids = None
+        # (key, text) for each row displayed, keyed by fan_id
+        self.rows = {}
+        # Size of the window, as (columns, rows), and the page line, when the table was drawn
+        self.window = None
+        self.footer = None
+
+        # Page of the fans displayed, and the number of pages at the last refresh
+        self.page = 0
+        self.pages = 1
+
+        self.refreshes = 0
+        self.redrawn = 0
+
+    def __repr__(self):
+        return "<{}({} rows, {} refreshes, {} rows redrawn)>".format(self.__class__.__name__,
+                                                                     len(self.rows),
+                                                                     self.refreshes, self.redrawn)
+
+    def next_page(self):
+        """
+        Move on to the next page of fans (or back to the first) at the next refresh.
+        """
+        self.page = (self.page + 1) % self.pages
+
+    def refresh(self, fans, columns, rows):
+        """
+        Work out the output to update the display.
+
+        @param fans:    the fans to display, in order
+        @param columns: width of the text window
+        @param rows:    height of the text window
+
+        @return: string to write, which may be empty if nothing has changed
+        """
+        self.refreshes += 1
+        fans = list(fans)
+        # The heading is on the first row, then the fans, the page line and the row the cursor is left on
+        per_page = max(1, rows - 3)
+        self.pages = max(1, (len(fans) + per_page - 1) // per_page)
+        self.page = min(self.page, self.pages - 1)
+        first = self.page * per_page
+        shown = fans[first:first + per_page]
+        footer = None
+        if self.pages > 1:
+            footer = "Fans {}-{} of {}; press Space for the next page".format(first + 1, first + len(shown),
+                                                                            len(fans))
+
+        fan_ids = [fan.fan_id for fan in shown]
+        window = (columns, rows)
+        if fan_ids != self.fan_ids or window != self.window or footer != self.footer:
+            return self.redraw(shown, fan_ids, window, footer)
+
+        output = []
+        for index, fan in enumerate(shown):
+            (key, text) = self.format_row(fan)
+            (old_key, old_text) = self.rows[fan.fan_id]
+            if key == old_key:
+                continue
+
+            # Heading is on row 0, so the fans start on row 1
+            output.append(self.move_to(index + 1))
+            # Pad to the old length, so that nothing is left from the old row
+            output.append(self.clip(text.ljust(len(old_text))))
+            self.rows[fan.fan_id] = (key, text)
+            self.redrawn += 1
+
+        if output:
+            output.append(self.park())
+        return ''.join(output)
+
+    def redraw(self, fans, fan_ids, window, footer):
+        self.fan_ids = fan_ids
+        self.window = window
+        self.footer = footer
+        self.rows = {}
+        output = [self.vdu_cls, self.clip(self.header)]
+        for index, fan in enumerate(fans):
+            (key, text) = self.format_row(fan)
+            self.rows[fan.fan_id] = (key, text)
+            output.append(self.move_to(index + 1) + self.clip(text))
+            self.redrawn += 1
+        if footer:
+            output.append(self.move_to(len(fans) + 1) + self.clip(footer))
+        output.append(self.park())
+        return ''.join(output)
+
+    def clip(self, text):
+        """
+        Clip text to the width of the window, leaving the last column empty so that it cannot wrap.
+        """
+        return text[:max(1, self.window[0] - 1)]
+
+    def move_to(self, row):
+        """
+        Output to move the cursor to the start of a row of the window, other than the first.
+
+        VDU 31 is given column 1, and VDU 13 then moves to column 0, as a column 0
+        argument would be a NUL.
+        """
+        return self.vdu_tab + chr(1) + chr(row) + self.vdu_cr
+
+    def park(self):
+        """
+        Output to leave the cursor at the start of the line below the table.
+        """
+        return self.move_to(len(self.fan_ids) + (2 if self.footer else 1))
@@ -0,0 +1,108 @@
+"""
+Write-behind of fan speed changes.
+"""
+
+from riscos.errors import RISCOSError
+
+
+class WriteBehind(object):
+    """
+    Coalesces speed changes so that only the last requested speed is written.
+
+    Requests record a pending speed for the fan; when flushed, the pending speed
+    is written to the driver unless it is within the deadband of the speed that
+    was last written.
+    """
+
+    def __init__(self, deadband=0):
+        """
+        @param deadband:    difference from the last written speed within which a
+                            write is dropped (0 drops only writes of the same speed)
+        """
+        self.deadband = deadband
+        # Fans with a speed waiting to be written, keyed by fan_id
+        self.pending = {}
+
+        self.requested = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return "<{}({} pending, {} requested, {} written)>".format(self.__class__.__name__,
+                                                                   len(self.pending),
+                                                                   self.requested,
+                                                                   self.written)
+
+    @property
+    def saved(self):
+        """
+        Number of writes which did not need to be made to the drivers.
+        """
+        return self.coalesced + self.dropped
+
+    def request(self, fan, speed):
+        """
+        Request that a fan's speed be changed when we are next flushed.
+
+        @return: True if this is the first pending request, so a flush is needed
+        """
+        fan.check_speed(speed)
+        self.requested += 1
+        if fan.pending_speed is not None:
+            self.coalesced += 1
+        fan.pending_speed = speed
+        first = not self.pending
+        self.pending[fan.fan_id] = fan
+        return first
+
+    def discard(self, fan):
+        """
+        Forget any pending speed for a fan.
+        """
+        if self.pending.pop(fan.fan_id, None):
+            fan.pending_speed = None
+
+    def flush(self):
+        """
+        Write the pending speeds to the drivers.
+        """
+        self.write(self.take())
+
+    def take(self):
+        """
+        Take the fans with pending speeds, to be written later.
+
+        Their speeds stay pending, so that further requests for them are coalesced
+        until they are written.
+
+        @return: list of the fans, in fan_id order
+        """
+        pending = self.pending
+        self.pending = {}
+        return [fan for fan_id, fan in sorted(pending.items())]
+
+    def write(self, fans):
+        """
+        Write the pending speeds of some fans to their drivers.
+        """
+        for fan in fans:
+            speed = fan.pending_speed
+            if speed is None:
+                # Already written, by an earlier write of the same fan or by a direct write
+                continue
+            fan.pending_speed = None
+            if fan.calibrating:
+                # Requested before the calibration started, which puts back the speed it found
+                self.dropped += 1
+                continue
+            if fan.applied_speed is not None and abs(speed - fan.applied_speed) <= self.deadband:
+                self.dropped += 1
+                continue
+            try:
+                fan.set_speed(speed, checked=True)
+                self.written += 1
+            except RISCOSError:
+                # The failure is recorded in the driver statistics; there's nobody to report it to.
+                self.failed += 1
@@ -0,0 +1,109 @@
+"""
+Test that speed changes written behind are coalesced properly.
+"""
+
+import unittest
+
+try:
+    from riscos.errors import RISCOSError
+except ImportError:
+    RISCOSError = None
+
+if RISCOSError:
+    from .fanwrites import WriteBehind
+
+    class FakeError(RISCOSError):
+        """
+        An error from a driver, without the RISC OS instance a real error would report through.
+        """
+
+        def __init__(self, message):
+            Exception.__init__(self, message)
+
+
+class FakeFan(object):
+    """
+    The parts of a FanDescriptor which are written behind.
+    """
+
+    def __init__(self, fan_id, fail=False):
+        self.fan_id = fan_id
+        self.pending_speed = None
+        self.applied_speed = None
+        self.calibrating = False
+        self.fail = fail
+        self.writes = []
+
+    def check_speed(self, speed):
+        pass
+
+    def set_speed(self, speed, checked=False):
+        self.pending_speed = None
+        if self.fail:
+            raise FakeError("Fan {} failed".format(self.fan_id))
+        self.writes.append(speed)
+        self.applied_speed = speed
+        return speed
+
+
+@unittest.skipUnless(RISCOSError, "The RISC OS classes are not installed")
+class TestWriteBehind(unittest.TestCase):
+
+    def test_coalesced(self):
+        writes = WriteBehind()
+        fans = [FakeFan(2), FakeFan(1)]
+        self.assertTrue(writes.request(fans[0], 1000))
+        self.assertFalse(writes.request(fans[0], 2000))
+        self.assertFalse(writes.request(fans[1], 3000))
+        writes.flush()
+        self.assertEqual([fan.writes for fan in fans], [[2000], [3000]])
+        self.assertEqual((writes.requested, writes.coalesced, writes.written), (3, 1, 2))
+        self.assertEqual(writes.pending, {})
+
+    def test_deadband(self):
+        writes = WriteBehind(deadband=50)
+        fan = FakeFan(1)
+        fan.applied_speed = 2000
+        writes.request(fan, 2040)
+        writes.flush()
+        writes.request(fan, 2100)
+        writes.flush()
+        self.assertEqual(fan.writes, [2100])
+        self.assertEqual((writes.dropped, writes.saved), (1, 1))
+
+    def test_taken_then_written(self):
+        # Requests made after the fans were taken are still coalesced into the write
+        writes = WriteBehind()
+        fan = FakeFan(1)
+        writes.request(fan, 1000)
+        taken = writes.take()
+        writes.request(fan, 1500)
+        writes.write(taken)
+        self.assertEqual(fan.writes, [1500])
+        # The fan was requested again, but its speed has already been written
+        writes.flush()
+        self.assertEqual(fan.writes, [1500])
+
+    def test_calibrating_and_failed(self):
+        writes = WriteBehind()
+        calibrating = FakeFan(1)
+        failing = FakeFan(2, fail=True)
+        writes.request(calibrating, 1000)
+        writes.request(failing, 1000)
+        calibrating.calibrating = True
+        writes.flush()
+        self.assertEqual(calibrating.writes, [])
+        self.assertEqual((writes.dropped, writes.failed, writes.written), (1, 1, 0))
+
+    def test_discard(self):
+        writes = WriteBehind()
+        fan = FakeFan(1)
+        writes.request(fan, 1000)
+        writes.discard(fan)
+        self.assertIsNone(fan.pending_speed)
+        writes.flush()
+        self.assertEqual(fan.writes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()